@@ -1,8 +1,15 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Response
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Response, Query, Request
+from fastapi.responses import StreamingResponse, HTMLResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import CursorType, ReturnDocument, UpdateOne, ReplaceOne
+from pymongo.errors import DuplicateKeyError
+from bson import encode as bson_encode, decode as bson_decode
+from bson.codec_options import CodecOptions
+from gridfs.errors import NoFile
+from collections import Counter, OrderedDict
 import certifi
 import os
 import ssl
@@ -17,19 +24,37 @@ def _create_tls12_context():
     return ctx
 ssl.create_default_context = _create_tls12_context
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Annotated, List, Optional
 from contextlib import asynccontextmanager
 import uuid
-from datetime import datetime, timezone
+import copy
+import asyncio
+import json
+import time
+import csv
+import io
+import re
+import multiprocessing
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import accumulate
+from datetime import datetime, timezone, date, timedelta
 import jwt
 import hashlib
+import gzip
+import heapq
+from array import array
+from bisect import bisect_left
 from io import BytesIO
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.units import mm
 from reportlab.platypus import BaseDocTemplate, Frame, PageTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.pdfbase.pdfmetrics import stringWidth
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
+from jinja2 import Environment, FileSystemLoader
 import urllib.request
 
 ROOT_DIR = Path(__file__).parent
@@ -41,6 +66,7 @@ client = AsyncIOMotorClient(
     mongo_url,
     tlsCAFile=certifi.where(),
     serverSelectionTimeoutMS=30000,
+    tz_aware=True,
 )
 db = client[os.environ['DB_NAME']]
 
@@ -48,14 +74,78 @@ db = client[os.environ['DB_NAME']]
 JWT_SECRET = os.environ.get('JWT_SECRET', 'rheumacare-secret-key-2024')
 JWT_ALGORITHM = "HS256"
 
+# A full snapshot is stored every N revisions so rebuilding any version replays at most N patches
+REVISION_SNAPSHOT_INTERVAL = int(os.environ.get('REVISION_SNAPSHOT_INTERVAL', 10))
+
+# Number of most recent visits kept on each patient summary
+PATIENT_VISIT_HISTORY = 100
+
+# Seconds an analytics result is served from the in-process cache
+ANALYTICS_CACHE_TTL = int(os.environ.get('ANALYTICS_CACHE_TTL', 300))
+
+# Prescriptions created more than this many days ago are moved to the archive by the archiver
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Startup: init doctors. Shutdown: close Mongo client."""
+    """Startup: init doctors and indexes. Shutdown: close Mongo client."""
     try:
         await init_doctors()
     except Exception as e:
         logger.warning("Startup init_doctors failed (app will still serve): %s", e)
+    # Both log and cache a load failure; saves then go through unchecked
+    await asyncio.to_thread(icd_catalog)
+    drug_checker()
+    try:
+        await init_indexes()
+    except Exception as e:
+        logger.warning("Startup init_indexes failed (app will still serve): %s", e)
+    try:
+        await init_rollups()
+    except Exception as e:
+        logger.warning("Startup init_rollups failed (app will still serve): %s", e)
+    try:
+        await init_change_seqs()
+    except Exception as e:
+        logger.warning("Startup init_change_seqs failed (app will still serve): %s", e)
+    try:
+        await init_vitals()
+    except Exception as e:
+        logger.warning("Startup init_vitals failed (app will still serve): %s", e)
+    try:
+        await init_timestamp_migration()
+    except Exception as e:
+        logger.warning("Startup init_timestamp_migration failed (app will still serve): %s", e)
+    try:
+        await init_drug_migration()
+    except Exception as e:
+        logger.warning("Startup init_drug_migration failed (app will still serve): %s", e)
+    try:
+        await init_schema_writeback()
+    except Exception as e:
+        logger.warning("Startup init_schema_writeback failed (app will still serve): %s", e)
+    try:
+        await init_archiver()
+    except Exception as e:
+        logger.warning("Startup init_archiver failed (app will still serve): %s", e)
+    if PDF_PRERENDER:
+        start_pdf_render_queue()
+    change_events.start()
     yield
+    change_events.stop()
+    if _timestamp_migration is not None:
+        # Left marked as running, so the next start resumes it
+        _timestamp_migration.cancel()
+    if _drug_migration is not None:
+        _drug_migration.cancel()
+    if _schema_writeback is not None:
+        _schema_writeback.cancel()
+    if _archiver is not None:
+        _archiver.cancel()
+    if _pdf_render_worker is not None:
+        _pdf_render_worker.cancel()
+    if _export_pool is not None:
+        _export_pool.shutdown(wait=False, cancel_futures=True)
     client.close()
 
 
@@ -65,6 +155,8 @@ app = FastAPI(lifespan=lifespan)
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
+# Event streams also accept ?token=, since browsers cannot set headers on an EventSource
+stream_security = HTTPBearer(auto_error=False)
 
 # Admin credentials (hardcoded for security)
 ADMIN_USERNAME = "admin"
@@ -167,6 +259,405 @@ DRUG_LIST = [
     "OSTEOCAL"
 ]
 
+# ICD-10 catalog - the ICD-10-CM tabular list (CDC, FY2026, public domain) as "code<TAB>description" lines,
+# loaded once into a sorted code array plus an inverted index from description words to codes
+ICD_CATALOG_PATH = ROOT_DIR / "data" / "icd10cm.tsv.gz"
+# off: accept any code; warn: accept unknown codes but flag them in X-ICD-Warning; strict: reject them (422)
+ICD_VALIDATION = os.environ.get('ICD_VALIDATION', 'warn').lower()
+_ICD_WORD = re.compile(r"[a-z0-9]+")
+_ICD_SEPARATORS = re.compile(r"[\s,;/]+")
+
+def icd_key(code: str) -> str:
+    """Comparable form of a code: upper case without the dot ('m05.9' -> 'M059')"""
+    return code.strip().upper().replace(".", "")
+
+def _prefix_range(sorted_items: list, prefix: str) -> range:
+    return range(bisect_left(sorted_items, prefix), bisect_left(sorted_items, prefix + "\uffff"))
+
+class IcdCatalog:
+    def __init__(self, path: Path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            rows = sorted((icd_key(code), code, description)
+                          for code, description in (line.rstrip("\n").split("\t", 1) for line in f))
+        self.keys = [key for key, _, _ in rows]
+        self.codes = [code for _, code, _ in rows]
+        self.descriptions = [description for _, _, description in rows]
+        # Description matches are listed by rank: shorter descriptions (the more general codes) first
+        self.by_rank = sorted(range(len(rows)), key=lambda i: (len(self.descriptions[i]), i))
+        self.description_words = [()] * len(rows)
+        postings = {}
+        for rank, i in enumerate(self.by_rank):
+            words = tuple(set(_ICD_WORD.findall(self.descriptions[i].lower())))
+            self.description_words[i] = words
+            for word in words:
+                postings.setdefault(word, array("I")).append(rank)
+        # Sorted vocabulary, so a query word matches every indexed word it is a prefix of; each
+        # posting list holds ranks in ascending order and posting_totals sizes any vocabulary span
+        self.words = sorted(postings)
+        self.postings = [postings[word] for word in self.words]
+        self.posting_totals = list(accumulate((len(p) for p in self.postings), initial=0))
+
+    def find(self, code: str) -> Optional[int]:
+        """Position of a code in the catalog, None if it is not there"""
+        key = icd_key(code)
+        i = bisect_left(self.keys, key)
+        return i if i < len(self.keys) and self.keys[i] == key else None
+
+    def _span_size(self, span: range) -> int:
+        return self.posting_totals[span.stop] - self.posting_totals[span.start]
+
+    def search(self, query: str, limit: int = 20) -> list:
+        """Codes starting with the query first, then codes with a description word starting with every query word"""
+        found = list(_prefix_range(self.keys, icd_key(query))[:limit]) if icd_key(query) else []
+        words = set(_ICD_WORD.findall(query.lower()))
+        if len(found) < limit and words:
+            # Walk the rarest word's postings in rank order and check the other words on each candidate,
+            # so only as many candidates are touched as it takes to fill the page
+            spans = sorted(((self._span_size(span), word, span) for word in words
+                            for span in [_prefix_range(self.words, word)]))
+            _, rarest, span = spans[0]
+            others = [word for _, word, _ in spans[1:]]
+            seen = set(found)
+            for rank in heapq.merge(*(self.postings[j] for j in span)):
+                i = self.by_rank[rank]
+                if i in seen:
+                    continue
+                seen.add(i)
+                if all(any(w.startswith(word) for w in self.description_words[i]) for word in others):
+                    found.append(i)
+                    if len(found) == limit:
+                        break
+        return [{"code": self.codes[i], "description": self.descriptions[i]} for i in found]
+
+@lru_cache(maxsize=1)
+def icd_catalog() -> Optional[IcdCatalog]:
+    """The ICD-10 catalog, None if it cannot be loaded (cached as well, so a bad file is only read once)"""
+    try:
+        return IcdCatalog(ICD_CATALOG_PATH)
+    except Exception as e:
+        logger.warning("Loading the ICD-10 catalog failed, ICD codes are not validated: %s", e)
+        return None
+
+def require_icd_catalog() -> IcdCatalog:
+    catalog = icd_catalog()
+    if catalog is None:
+        raise HTTPException(status_code=503, detail="ICD-10 catalog is unavailable")
+    return catalog
+
+def check_icd_codes(icd_code: str, response: Response):
+    """Apply ICD_VALIDATION to the (comma/space separated) codes of a prescription"""
+    if ICD_VALIDATION == "off" or not icd_code.strip():
+        return
+    catalog = icd_catalog()
+    if catalog is None:
+        return
+    unknown = [code for code in _ICD_SEPARATORS.split(icd_code.strip()) if code and catalog.find(code) is None]
+    if not unknown:
+        return
+    detail = f"Unknown ICD-10 code: {', '.join(unknown)}"
+    if ICD_VALIDATION == "strict":
+        raise HTTPException(status_code=422, detail=detail)
+    response.headers["X-ICD-Warning"] = detail
+
+# Drug interactions - a bundled table of brand ingredients, therapeutic classes and interacting ingredient
+# groups, compiled once into integer bitsets: each drug is a mask over ingredient ids and each ingredient
+# has a mask of the ingredients it interacts with, so checking a pair of drugs is a few AND operations
+DRUG_INTERACTIONS_PATH = ROOT_DIR / "data" / "drug_interactions.json"
+# off: save any combination; warn: save and report alerts; strict: reject prescriptions with a major alert (422)
+DRUG_CHECK = os.environ.get('DRUG_CHECK', 'warn').lower()
+DRUG_ALERT_SEVERITIES = ("major", "moderate")
+
+def drug_key(name: str) -> str:
+    """Comparable form of a drug name: upper case with single spaces ('ecosprin  av' -> 'ECOSPRIN AV')"""
+    return " ".join(name.upper().split())
+
+def _bits(mask: int):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+class DrugChecker:
+    def __init__(self, path: Path):
+        with open(path, encoding="utf-8") as f:
+            table = json.load(f)
+        self.ingredients = sorted({i for ingredients in table["drugs"].values() for i in ingredients})
+        index = {name: i for i, name in enumerate(self.ingredients)}
+        # Brands and ingredient names both resolve to an ingredient mask
+        self.masks = {drug_key(name): 1 << i for name, i in index.items()}
+        for brand, ingredients in table["drugs"].items():
+            self.masks[drug_key(brand)] = sum(1 << index[i] for i in ingredients)
+        self.class_names = list(table["classes"])
+        self.class_masks = [sum(1 << index[i] for i in table["classes"][name]) for name in self.class_names]
+        self.interactions = table["interactions"]
+        self.interacts = [0] * len(self.ingredients)
+        # (lower, higher) ingredient id -> position of its entry in the interaction table
+        self.pair_entries = {}
+        for n, entry in enumerate(self.interactions):
+            for a in entry["a"]:
+                for b in entry["b"]:
+                    i, j = sorted((index[a], index[b]))
+                    self.interacts[i] |= 1 << j
+                    self.interacts[j] |= 1 << i
+                    # A pair listed under several entries keeps the most severe one
+                    current = self.pair_entries.get((i, j))
+                    if current is None or (DRUG_ALERT_SEVERITIES.index(entry["severity"])
+                                           < DRUG_ALERT_SEVERITIES.index(self.interactions[current]["severity"])):
+                        self.pair_entries[(i, j)] = n
+        self._resolve_key = lru_cache(maxsize=4096)(self._resolve_key)
+
+    def _resolve_key(self, key: str) -> tuple:
+        words = key.split()
+        mask = next((self.masks[k] for k in (" ".join(words[:n]) for n in range(len(words), 0, -1))
+                     if k in self.masks), 0)
+        return mask, sum(1 << c for c, class_mask in enumerate(self.class_masks) if mask & class_mask)
+
+    def resolve(self, name: str) -> tuple:
+        """(ingredient mask, class mask) of a drug name; strength suffixes are dropped ('FOLITRAX 15MG')"""
+        return self._resolve_key(drug_key(name))
+
+    def check(self, names: List[str]) -> dict:
+        """Duplicate ingredients, duplicate therapeutic classes and interactions between every pair of drugs"""
+        resolved = [self.resolve(name) for name in names]
+        alerts = []
+        for j, (mask_j, classes_j) in enumerate(resolved):
+            for i in range(j):
+                mask_i, classes_i = resolved[i]
+                pair = [names[i], names[j]]
+                shared = mask_i & mask_j
+                if shared:
+                    ingredients = [self.ingredients[k] for k in _bits(shared)]
+                    alerts.append({"type": "duplicate", "severity": "major", "drugs": pair, "ingredients": ingredients,
+                                   "message": f"Both contain {', '.join(ingredients)}."})
+                for c in _bits(classes_i & classes_j):
+                    # A class shared only through a common ingredient is already reported above
+                    if not shared & self.class_masks[c]:
+                        alerts.append({"type": "duplicate", "severity": "moderate", "drugs": pair,
+                                       "message": f"Duplicate therapy: two {self.class_names[c]}s."})
+                # Ingredient pairs hitting the same entry (methotrexate with both halves of BACTRIM) make one alert
+                hits = {}
+                for a in _bits(mask_i):
+                    for b in _bits(self.interacts[a] & mask_j & ~shared):
+                        ingredients = hits.setdefault(self.pair_entries[min(a, b), max(a, b)], [])
+                        ingredients += [self.ingredients[k] for k in (a, b) if self.ingredients[k] not in ingredients]
+                for n, ingredients in hits.items():
+                    entry = self.interactions[n]
+                    alerts.append({"type": "interaction", "severity": entry["severity"], "drugs": pair,
+                                   "ingredients": ingredients, "message": entry["message"]})
+        alerts.sort(key=lambda alert: DRUG_ALERT_SEVERITIES.index(alert["severity"]))
+        return {"alerts": alerts, "unrecognized": [name for name, (mask, _) in zip(names, resolved) if not mask]}
+
+@lru_cache(maxsize=1)
+def drug_checker() -> Optional[DrugChecker]:
+    """The interaction checker, None if its table cannot be loaded (cached as well, so it is only read once)"""
+    try:
+        return DrugChecker(DRUG_INTERACTIONS_PATH)
+    except Exception as e:
+        logger.warning("Loading the drug interaction table failed, drugs are not checked: %s", e)
+        return None
+
+def check_drug_alerts(drugs: list) -> list:
+    """Apply DRUG_CHECK to the drugs of a prescription and return the alerts to store with it"""
+    checker = drug_checker()
+    if DRUG_CHECK == "off" or checker is None:
+        return []
+    alerts = checker.check([d.drug_name for d in drugs])["alerts"]
+    major = [alert for alert in alerts if alert["severity"] == "major"]
+    if DRUG_CHECK == "strict" and major:
+        raise HTTPException(status_code=422, detail="; ".join(
+            f"{' + '.join(alert['drugs'])}: {alert['message']}" for alert in major))
+    return alerts
+
+# Prescription schema - schema_version says which upgrades a stored document has had. Reads apply the
+# missing ones in order, so handlers always see the current shape; the schema write-back stores
+# upgraded documents in throttled batches, so no schema change needs a stop-the-world migration
+PRESCRIPTION_SCHEMA_VERSION = 1
+PRESCRIPTION_UPGRADES = {}
+
+def prescription_upgrade(version: int):
+    """Register the function that brings a stored prescription from version - 1 to version (in place)"""
+    def register(upgrade):
+        PRESCRIPTION_UPGRADES[version] = upgrade
+        return upgrade
+    return register
+
+@prescription_upgrade(1)
+def _fill_prescription_defaults(prescription: dict):
+    """Fields added after the first prescriptions were written; sex used to be stored as gender"""
+    if "gender" in prescription:
+        gender = prescription.pop("gender")
+        if not prescription.get("sex"):
+            prescription["sex"] = gender or ""
+    for field in ("sex", "age", "icd_code", "weight", "height", "bp", "spo2",
+                  "clinical_history", "review_after", "advice", "lab_tests"):
+        prescription.setdefault(field, "")
+    prescription.setdefault("drugs", [])
+    prescription.setdefault("doctor_id", "dr_prakashini")
+    prescription.setdefault("location", "Bangalore")
+    prescription.setdefault("drug_alerts", [])
+
+def upgrade_prescription(prescription: dict) -> dict:
+    """Apply the upgrades a stored prescription is missing (in place)"""
+    for version in range(prescription.get("schema_version", 0) + 1, PRESCRIPTION_SCHEMA_VERSION + 1):
+        PRESCRIPTION_UPGRADES[version](prescription)
+        prescription["schema_version"] = version
+    return prescription
+
+# Compact drug entries - prescriptions store each drug with short keys: a formulary code ("D12") or the
+# free-text name, and frequency, duration and unit as small integers where they are standard values.
+# Reads expand them back to DrugEntry fields; documents written before keep full entries, which pass
+# through unchanged. Frequency and unit codes are positions in these lists, so only ever append to them
+DRUG_FREQUENCIES = ["1-0-1", "1-0-0", "0-0-1", "1-1-1", "0-1-0", "1-1-0", "0-1-1", "Once weekly", "Twice weekly", "SOS"]
+DURATION_UNITS = ["Days", "Weeks", "Months"]
+# Drug codes come from a frozen table, independent of DRUG_LIST order; drugs without a code are stored by name
+FORMULARY_CODES_PATH = ROOT_DIR / "data" / "formulary_codes.json"
+FORMULARY_NAMES = json.loads(FORMULARY_CODES_PATH.read_text())["codes"]
+FORMULARY_CODES = {name: code for code, name in FORMULARY_NAMES.items()}
+_FREQUENCY_CODES = {value: i for i, value in enumerate(DRUG_FREQUENCIES)}
+_DURATION_UNIT_CODES = {value: i for i, value in enumerate(DURATION_UNITS)}
+_DURATION_NUMBER = re.compile(r"0|[1-9][0-9]{0,5}")
+_SEARCH_WORD = re.compile(r"[A-Z0-9]+")
+
+def _search_phrase(text: str) -> str:
+    return f" {' '.join(_SEARCH_WORD.findall(text.upper()))} "
+
+# Formulary names as space-delimited word sequences, so a search only picks up codes of brands named in full
+FORMULARY_PHRASES = {code: _search_phrase(name) for code, name in FORMULARY_NAMES.items()}
+
+def compact_drug(drug: dict) -> dict:
+    """Stored form of a DrugEntry; empty fields are left out"""
+    name, frequency = drug.get("drug_name", ""), drug.get("frequency", "")
+    duration, unit = drug.get("duration", ""), drug.get("duration_unit", "")
+    entry = {"d": FORMULARY_CODES[name]} if name in FORMULARY_CODES else {"n": name}
+    entry.update({
+        "q": drug.get("dosage", ""),
+        "f": _FREQUENCY_CODES.get(frequency, frequency),
+        # Only numbers that print back identically ("30", not "030") are stored as integers
+        "t": int(duration) if _DURATION_NUMBER.fullmatch(duration) else duration,
+        "u": _DURATION_UNIT_CODES.get(unit, unit),
+        "c": drug.get("comments", ""),
+    })
+    return {k: v for k, v in entry.items() if v != ""}
+
+def expand_drug(entry: dict) -> dict:
+    """DrugEntry fields of a stored drug, compact or not"""
+    if "drug_name" in entry:
+        return entry
+    frequency, duration, unit = entry.get("f", ""), entry.get("t", ""), entry.get("u", "")
+    return {
+        # An unknown code is shown as it is rather than failing the whole prescription
+        "drug_name": FORMULARY_NAMES.get(entry["d"], entry["d"]) if "d" in entry else entry.get("n", ""),
+        "dosage": entry.get("q", ""),
+        "frequency": DRUG_FREQUENCIES[frequency] if isinstance(frequency, int) else frequency,
+        "duration": str(duration),
+        "duration_unit": DURATION_UNITS[unit] if isinstance(unit, int) else unit,
+        "comments": entry.get("c", ""),
+    }
+
+def expand_prescription(prescription: Optional[dict]) -> Optional[dict]:
+    """Read path for a stored prescription (in place): schema upgrades, then full drug entries"""
+    if prescription:
+        upgrade_prescription(prescription)
+        prescription["drugs"] = [expand_drug(d) for d in prescription.get("drugs", [])]
+    return prescription
+
+def compact_prescription(prescription: dict) -> dict:
+    """Write path: a copy of the prescription with its drugs in stored form"""
+    return {**prescription, "drugs": [compact_drug(d) for d in prescription.get("drugs", [])]}
+
+# Archive - prescriptions moved out of the hot collection are kept in prescriptions_archive as gzipped
+# BSON. Only the fields lookups filter and sort on stay outside the blob, so archive entries are small
+# and the hot collection and its indexes only hold the prescriptions clinicians still open
+ARCHIVE_FIELDS = ("id", "op_no", "doctor_id", "location", "created_at", "change_seq")
+ARCHIVE_CODEC = CodecOptions(tz_aware=True)
+
+def pack_archived(prescription: dict) -> dict:
+    """Archive entry for a prescription in stored form"""
+    stored = {k: v for k, v in prescription.items() if k != "_id"}
+    return {
+        **{field: stored.get(field) for field in ARCHIVE_FIELDS},
+        "archived_at": datetime.now(timezone.utc),
+        "data": gzip.compress(bson_encode(stored)),
+    }
+
+def unpack_archived(entry: Optional[dict]) -> Optional[dict]:
+    """The stored prescription inside an archive entry"""
+    return bson_decode(gzip.decompress(entry["data"]), codec_options=ARCHIVE_CODEC) if entry else None
+
+async def load_prescription(prescription_id: str) -> Optional[dict]:
+    """A prescription by id in read form, falling back to the archive; None if it does not exist"""
+    prescription = await db.prescriptions.find_one({"id": prescription_id}, {"_id": 0})
+    if prescription is None:
+        prescription = unpack_archived(await db.prescriptions_archive.find_one({"id": prescription_id}, {"data": 1}))
+    return expand_prescription(prescription)
+
+async def prescriptions_for_op(op_no: str, limit: int) -> list:
+    """Newest prescriptions of an OP number in read form, across the hot collection and the archive"""
+    hot, archived = await asyncio.gather(
+        db.prescriptions.find({"op_no": op_no}, {"_id": 0}).sort("created_at", -1).to_list(limit),
+        db.prescriptions_archive.find({"op_no": op_no}, {"_id": 0, "id": 1, "created_at": 1, "data": 1})
+        .sort("created_at", -1).to_list(limit),
+    )
+    # An entry still in both (caught mid-archive) is read from the hot collection
+    hot_ids = {p["id"] for p in hot}
+    candidates = [(p, False) for p in hot] + [(a, True) for a in archived if a["id"] not in hot_ids]
+    # Only the entries that make the cut are decompressed
+    oldest = datetime.min.replace(tzinfo=timezone.utc)
+    newest = heapq.nlargest(limit, candidates, key=lambda c: as_datetime(c[0].get("created_at")) or oldest)
+    return [expand_prescription(unpack_archived(p) if packed else p) for p, packed in newest]
+
+async def _unarchived(entries: list) -> list:
+    """Read form of archive entries, skipping any still in the hot collection (caught mid-archive)"""
+    hot_ids = set(await db.prescriptions.distinct("id", {"id": {"$in": [e["id"] for e in entries]}}))
+    return [expand_prescription(unpack_archived(e)) for e in entries if e["id"] not in hot_ids]
+
+async def iter_prescriptions(query: dict, batch_size: int = 500):
+    """Prescriptions matching a filter on archive fields in read form, newest first within each tier"""
+    async for prescription in db.prescriptions.find(query, {"_id": 0}).sort("created_at", -1).batch_size(batch_size):
+        yield expand_prescription(prescription)
+    entries = []
+    async for entry in db.prescriptions_archive.find(query, {"id": 1, "data": 1}).sort("created_at", -1).batch_size(batch_size):
+        entries.append(entry)
+        if len(entries) == batch_size:
+            for prescription in await _unarchived(entries):
+                yield prescription
+            entries = []
+    for prescription in await _unarchived(entries):
+        yield prescription
+
+async def restore_archived(prescription_id: str) -> bool:
+    """Move an archived prescription back to the hot collection (False if it is not archived)"""
+    entry = await db.prescriptions_archive.find_one({"id": prescription_id})
+    if not entry:
+        return False
+    # Copied before the archive entry goes, like the archiver; a hot copy already there is the current one
+    await db.prescriptions.update_one(
+        {"id": prescription_id}, {"$setOnInsert": unpack_archived(entry)}, upsert=True
+    )
+    await db.prescriptions_archive.delete_one({"_id": entry["_id"]})
+    return True
+
+def drug_display_name(key: str) -> str:
+    """Drug name for a grouping key that is a formulary code, a free-text or a legacy name"""
+    return FORMULARY_NAMES.get(key, key)
+
+# Grouping key of an unwound drug: short codes for formulary drugs, names for the rest
+DRUG_GROUP_KEY = {"$ifNull": ["$drugs.d", {"$ifNull": ["$drugs.n", "$drugs.drug_name"]}]}
+# Display name of an unwound drug, worked out in the pipeline like drug_display_name
+DRUG_NAME_EXPR = {"$let": {
+    "vars": {"key": {"$ifNull": [DRUG_GROUP_KEY, ""]}, "codes": {"$literal": list(FORMULARY_NAMES)}},
+    "in": {"$cond": [
+        {"$in": ["$$key", "$$codes"]},
+        {"$arrayElemAt": [{"$literal": list(FORMULARY_NAMES.values())}, {"$indexOfArray": ["$$codes", "$$key"]}]},
+        "$$key",
+    ]},
+}}
+
+def formulary_codes_named(q: str) -> list:
+    """Codes of the formulary drugs whose full name appears in a search query (negated words aside)"""
+    searched = _search_phrase(" ".join(token for token in q.split() if not token.startswith("-")))
+    return [code for code, phrase in FORMULARY_PHRASES.items() if phrase in searched]
+
 # Models
 class DrugEntry(BaseModel):
     drug_name: str
@@ -195,6 +686,8 @@ class PrescriptionCreate(BaseModel):
     lab_tests: str = ""
     doctor_id: str = "dr_prakashini"
     location: str = "Bangalore"
+    # Version the client loaded before editing; a stale value makes the update fail with 409
+    version: Optional[int] = None
 
 class Prescription(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -216,7 +709,20 @@ class Prescription(BaseModel):
     lab_tests: str = ""
     doctor_id: str = "dr_prakashini"
     location: str = "Bangalore"
-    created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # Incremented on every edit; 0 means the document predates versioning
+    version: int = 0
+    # Position in the change feed (GET /sync); the highest one a client holds is its sync token
+    change_seq: int = 0
+    # Numeric vitals parsed from the text fields (weight_kg, height_cm, bp_systolic, bp_diastolic, spo2_pct)
+    vitals_numeric: dict = Field(default_factory=dict)
+    # Interaction and duplicate-therapy alerts found when the prescription was saved
+    drug_alerts: List[dict] = Field(default_factory=list)
+    # Upgrades applied to the stored document (see PRESCRIPTION_UPGRADES)
+    schema_version: int = PRESCRIPTION_SCHEMA_VERSION
+
+class DrugCheckRequest(BaseModel):
+    drugs: List[str]
 
 # Doctor models
 class DoctorCreate(BaseModel):
@@ -249,6 +755,28 @@ class DoctorResponse(BaseModel):
     username: str
     is_active: bool
 
+# Colours are used in ReportLab and in the HTML view's CSS, so only #RRGGBB is accepted
+PDF_LAYOUT_COLOR = r"^#[0-9A-Fa-f]{6}$"
+
+class PdfLayoutSpec(BaseModel):
+    """Pre-printed pad layout; lengths in mm, font sizes in points"""
+    header_mm: float = Field(36, ge=0)
+    footer_mm: float = Field(36, ge=0)
+    padding_mm: float = Field(4, ge=0)
+    side_margin_mm: float = Field(15, ge=0)
+    drug_columns_mm: List[Annotated[float, Field(gt=0)]] = [10, 38, 22, 35, 25, 40]
+    accent_color: str = Field("#6B9A9A", pattern=PDF_LAYOUT_COLOR)
+    text_color: str = Field("#333333", pattern=PDF_LAYOUT_COLOR)
+    grid_color: str = Field("#CCCCCC", pattern=PDF_LAYOUT_COLOR)
+    font_size: float = Field(10, gt=0, le=72)
+    table_font_size: float = Field(9, gt=0, le=72)
+    rx_font_size: float = Field(14, gt=0, le=72)
+
+class PdfLayoutCreate(PdfLayoutSpec):
+    name: str
+    scope: str = "default"  # doctor, location or default
+    key: str = ""           # doctor id or location name for scoped layouts
+
 class LoginRequest(BaseModel):
     username: str
     password: str
@@ -261,9 +789,8 @@ class LoginResponse(BaseModel):
     location: Optional[str] = None
 
 # Auth helper - returns payload with role info
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+def decode_token(token: str) -> dict:
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
         return payload
     except jwt.ExpiredSignatureError:
@@ -271,6 +798,17 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    return decode_token(credentials.credentials)
+
+def verify_stream_token(token: Optional[str] = None,
+                        credentials: Optional[HTTPAuthorizationCredentials] = Depends(stream_security)):
+    if credentials is not None:
+        return decode_token(credentials.credentials)
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return decode_token(token)
+
 # Admin check helper
 def require_admin(payload: dict = Depends(verify_token)):
     if payload.get("role") != "admin":
@@ -286,6 +824,1389 @@ async def init_doctors():
             await db.doctors.insert_one(doctor)
         logging.info(f"Initialized {len(DEFAULT_DOCTORS)} default doctors")
 
+# Drug entries are text-searched by name (legacy and free-text); compact formulary entries are matched
+# by code through their own index, since short codes would collide with ordinary words like "D3"
+PRESCRIPTION_TEXT_WEIGHTS = {"diagnosis": 10, "icd_code": 10, "drugs.drug_name": 5, "drugs.n": 5,
+                             "clinical_history": 2, "advice": 1, "lab_tests": 1}
+
+async def init_indexes():
+    """Create the indexes the API relies on (no-op when they already exist)"""
+    await db.prescription_revisions.create_index([("prescription_id", 1), ("rev", -1)], unique=True)
+    await db.prescriptions.create_index("id", unique=True)
+    await db.prescriptions.create_index([("op_no", 1), ("created_at", -1)])
+    await db.patients.create_index("op_no", unique=True)
+    await db.prescriptions.create_index([("doctor_id", 1), ("created_at", -1)])
+    await db.prescriptions.create_index([("location", 1), ("created_at", -1)])
+    await db.prescriptions.create_index([("created_at", -1)])
+    await db.change_days.create_index("day", unique=True)
+    await db.rollups_daily.create_index(
+        [("metric", 1), ("day", 1), ("doctor_id", 1), ("location", 1), ("key", 1)], unique=True
+    )
+    await db.pdf_renders.create_index("prescription_id", unique=True)
+    await db.pdf_renders.create_index("file_id")
+    await db.pdf_layouts.create_index("id", unique=True)
+    await db.pdf_layouts.create_index([("scope", 1), ("key", 1)], unique=True)
+    await db.prescriptions.create_index("change_seq")
+    await db.prescriptions.create_index("schema_version")
+    await db.prescriptions.create_index("drugs.d")
+    await db.prescriptions.create_index([("doctor_id", 1), ("change_seq", 1)])
+    await db.prescriptions_archive.create_index("id", unique=True)
+    await db.prescriptions_archive.create_index([("op_no", 1), ("created_at", -1)])
+    await db.prescriptions_archive.create_index([("created_at", -1)])
+    await db.prescriptions_archive.create_index("change_seq")
+    await db.prescriptions_archive.create_index([("doctor_id", 1), ("change_seq", 1)])
+    await db.prescription_tombstones.create_index("change_seq")
+    await db.pending_change_seqs.create_index("seq")
+    await db.pending_change_seqs.create_index("at", expireAfterSeconds=PENDING_SEQ_LEASE_SECONDS)
+    await db.prescription_tombstones.create_index([("doctor_id", 1), ("change_seq", 1)])
+    # MongoDB 5.0 is the minimum server ($dateTrunc). Deleting from a time-series collection, filtered on
+    # meta fields only, needs 5.1, so 5.0 servers keep vitals_ts as a plain collection with the same documents
+    if "vitals_ts" not in await db.list_collection_names():
+        try:
+            info = await client.server_info()
+            if info.get("versionArray", [0]) < [5, 1]:
+                raise RuntimeError(f"MongoDB {info.get('version')} cannot delete from time-series collections")
+            await db.create_collection("vitals_ts", timeseries={"timeField": "ts", "metaField": "meta", "granularity": "hours"})
+        except Exception as e:
+            logger.warning("vitals_ts created as a regular collection: %s", e)
+    await db.vitals_ts.create_index([("meta.op_no", 1), ("ts", 1)])
+    await db.vitals_ts.create_index("meta.prescription_id")
+    if "change_events" not in await db.list_collection_names():
+        try:
+            await db.create_collection("change_events", capped=True, size=EVENT_LOG_BYTES)
+        except Exception as e:
+            # Without a capped collection the fan-out polls it instead of tailing it
+            logger.warning("change_events created as a regular collection: %s", e)
+    # Full-text search; clinically specific fields rank above free-text notes
+    text_index = (await db.prescriptions.index_information()).get("prescription_text")
+    if text_index and set(text_index.get("weights", {})) != set(PRESCRIPTION_TEXT_WEIGHTS):
+        # Text index fields cannot be changed in place
+        await db.prescriptions.drop_index("prescription_text")
+    await db.prescriptions.create_index(
+        [(field, "text") for field in PRESCRIPTION_TEXT_WEIGHTS],
+        name="prescription_text",
+        weights=PRESCRIPTION_TEXT_WEIGHTS,
+    )
+
+# Revision history helpers - revisions are stored as RFC 6902 JSON patches against the previous version
+def _escape_pointer(token) -> str:
+    return str(token).replace("~", "~0").replace("/", "~1")
+
+def _unescape_pointer(token: str) -> str:
+    return token.replace("~1", "/").replace("~0", "~")
+
+def json_diff(old, new, path: str = "") -> list:
+    """Return the JSON patch operations that turn old into new"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key in old:
+            if key not in new:
+                ops.append({"op": "remove", "path": f"{path}/{_escape_pointer(key)}"})
+        for key, value in new.items():
+            child = f"{path}/{_escape_pointer(key)}"
+            if key in old:
+                ops.extend(json_diff(old[key], value, child))
+            else:
+                ops.append({"op": "add", "path": child, "value": value})
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        ops = []
+        common = min(len(old), len(new))
+        for i in range(common):
+            ops.extend(json_diff(old[i], new[i], f"{path}/{i}"))
+        for i in range(common, len(new)):
+            ops.append({"op": "add", "path": f"{path}/{i}", "value": new[i]})
+        # Remove trailing items from the end so earlier indexes stay valid
+        for i in range(len(old) - 1, common - 1, -1):
+            ops.append({"op": "remove", "path": f"{path}/{i}"})
+        return ops
+    if type(old) is type(new) and old == new:
+        return []
+    return [{"op": "replace", "path": path, "value": new}]
+
+def json_patch(doc, patch: list):
+    """Apply JSON patch operations (add/remove/replace) to a copy of doc"""
+    doc = copy.deepcopy(doc)
+    for op in patch:
+        tokens = [_unescape_pointer(t) for t in op["path"].split("/")[1:]]
+        if not tokens:
+            doc = copy.deepcopy(op["value"])
+            continue
+        target = doc
+        for token in tokens[:-1]:
+            target = target[int(token)] if isinstance(target, list) else target[token]
+        last = tokens[-1]
+        if isinstance(target, list):
+            index = len(target) if last == "-" else int(last)
+            if op["op"] == "add":
+                target.insert(index, copy.deepcopy(op["value"]))
+            elif op["op"] == "remove":
+                target.pop(index)
+            else:
+                target[index] = copy.deepcopy(op["value"])
+        elif op["op"] == "remove":
+            del target[last]
+        else:
+            target[last] = copy.deepcopy(op["value"])
+    return doc
+
+def _revision_body(prescription: dict) -> dict:
+    """Fields tracked in revisions (version is the revision number itself)"""
+    return {k: v for k, v in prescription.items() if k not in ("_id", "version", "change_seq", "vitals_numeric", "drug_alerts", "schema_version")}
+
+def make_revision(prescription_id: str, rev: int, user: Optional[str], before: Optional[dict], after: dict) -> dict:
+    revision = {
+        "prescription_id": prescription_id,
+        "rev": rev,
+        "user": user,
+        "created_at": datetime.now(timezone.utc),
+    }
+    body = _revision_body(after)
+    if before is None or rev % REVISION_SNAPSHOT_INTERVAL == 0:
+        revision["snapshot"] = body
+    else:
+        revision["patch"] = json_diff(_revision_body(before), body)
+    return revision
+
+# Prescription timestamps - created_at/updated_at are BSON dates (UTC). Documents written before that
+# hold ISO strings until the timestamp migration converts them, so readers accept both, and date
+# filters also match strings while any remain
+_legacy_timestamps = True
+
+def as_datetime(value) -> Optional[datetime]:
+    """UTC datetime from a stored timestamp (BSON date or legacy ISO string); None when missing or invalid"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def created_day(prescription: dict) -> str:
+    """UTC creation date as YYYY-MM-DD ('' when unknown)"""
+    created = as_datetime(prescription.get("created_at"))
+    return created.date().isoformat() if created else ""
+
+def _day_start(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+def created_at_filter(date_from: Optional[date], date_to: Optional[date]) -> dict:
+    """Mongo filter on created_at for an inclusive date range (empty when unbounded)"""
+    if not date_from and not date_to:
+        return {}
+    bounds, legacy_bounds = {}, {}
+    if date_from:
+        bounds["$gte"] = _day_start(date_from)
+        legacy_bounds["$gte"] = date_from.isoformat()
+    if date_to:
+        bounds["$lt"] = _day_start(date_to + timedelta(days=1))
+        legacy_bounds["$lt"] = (date_to + timedelta(days=1)).isoformat()
+    if not _legacy_timestamps:
+        return {"created_at": bounds}
+    # Range comparisons only match values of the bound's BSON type, so each branch is one index range
+    return {"$or": [{"created_at": bounds}, {"created_at": legacy_bounds}]}
+
+def date_prefix(field: str, period: str) -> dict:
+    """Aggregation expression for the YYYY-MM-DD / YYYY-MM / YYYY prefix of a date or ISO string field"""
+    date_format, length = ANALYTICS_PERIODS[period]
+    return {"$cond": [
+        {"$eq": [{"$type": field}, "date"]},
+        {"$dateToString": {"format": date_format, "date": field}},
+        {"$substrBytes": [field, 0, length]},
+    ]}
+
+# Analytics helpers - all statistics are computed by Mongo aggregation pipelines
+_analytics_cache = {}
+
+async def cached_aggregate(collection, pipeline: list) -> list:
+    """Run an aggregation pipeline, reusing the result for ANALYTICS_CACHE_TTL seconds"""
+    key = (collection.name, json.dumps(pipeline, sort_keys=True, default=str))
+    now = time.monotonic()
+    hit = _analytics_cache.get(key)
+    if hit and hit[0] > now:
+        return hit[1]
+    result = await collection.aggregate(pipeline).to_list(None)
+    if len(_analytics_cache) > 256:
+        for stale in [k for k, (expires, _) in _analytics_cache.items() if expires <= now]:
+            del _analytics_cache[stale]
+    _analytics_cache[key] = (now + ANALYTICS_CACHE_TTL, result)
+    return result
+
+# period -> ($dateToString format, length of the matching ISO string prefix)
+ANALYTICS_PERIODS = {"day": ("%Y-%m-%d", 10), "month": ("%Y-%m", 7), "year": ("%Y", 4)}
+
+def analytics_group_key(group_by: Optional[str], period: Optional[str], date_field: str = "$created_at", **fields) -> dict:
+    """Build a $group _id from the requested dimensions"""
+    key = dict(fields)
+    if group_by == "doctor":
+        key["doctor_id"] = "$doctor_id"
+    elif group_by == "location":
+        key["location"] = "$location"
+    elif group_by:
+        raise HTTPException(status_code=400, detail="group_by must be 'doctor' or 'location'")
+    if period:
+        if period not in ANALYTICS_PERIODS:
+            raise HTTPException(status_code=400, detail="period must be 'day', 'month' or 'year'")
+        key["period"] = date_prefix(date_field, period)
+    return key
+
+def analytics_match(date_from: Optional[date], date_to: Optional[date]) -> list:
+    created_range = created_at_filter(date_from, date_to)
+    return [{"$match": created_range}] if created_range else []
+
+def rollup_match(metrics: list, date_from: Optional[date], date_to: Optional[date]) -> dict:
+    match = {"metric": {"$in": metrics}}
+    if date_from or date_to:
+        match["day"] = {}
+        if date_from:
+            match["day"]["$gte"] = date_from.isoformat()
+        if date_to:
+            match["day"]["$lte"] = date_to.isoformat()
+    return {"$match": match}
+
+def flatten_groups(rows: list) -> list:
+    """Turn [{_id: {...}, count: n}] into [{..., count: n}]"""
+    return [{**(row["_id"] or {}), **{k: v for k, v in row.items() if k != "_id"}} for row in rows]
+
+# Single-flight - identical concurrent requests (same endpoint, params and data version) share one
+# execution: the first caller starts the work, later callers await the same task
+class SingleFlight:
+    def __init__(self):
+        self._inflight = {}
+        self.stats = {}
+
+    def _count(self, endpoint: str, field: str):
+        counts = self.stats.setdefault(endpoint, {"requests": 0, "executions": 0, "coalesced": 0, "failures": 0})
+        counts[field] += 1
+
+    async def do(self, key: tuple, work):
+        """Result of work() for key; key[0] names the endpoint in the metrics"""
+        endpoint = key[0]
+        self._count(endpoint, "requests")
+        task = self._inflight.get(key)
+        if task is None:
+            self._count(endpoint, "executions")
+            # A task, so a caller that disconnects does not cancel the work the others are awaiting
+            task = asyncio.ensure_future(work())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        else:
+            self._count(endpoint, "coalesced")
+        return await asyncio.shield(task)
+
+    def _finished(self, key: tuple, task: asyncio.Future):
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            self._count(key[0], "failures")
+
+    def metrics(self) -> dict:
+        in_flight = Counter(key[0] for key in self._inflight)
+        return {endpoint: {**counts, "in_flight": in_flight.get(endpoint, 0)} for endpoint, counts in self.stats.items()}
+
+single_flight = SingleFlight()
+
+# Export engine - one row per drug, streamed from the cursor through a pluggable writer
+EXPORT_FIELDS = [
+    "prescription_id", "op_no", "patient_name", "sex", "age", "icd_code", "weight", "height", "bp", "spo2",
+    "date", "drug_name", "dosage", "frequency", "duration", "comments", "advice", "lab_tests", "doctor", "location",
+]
+EXPORT_BATCH_ROWS = 5000
+
+def export_query(payload: dict, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                 doctor_id: Optional[str] = None, location: Optional[str] = None, op_no: Optional[str] = None) -> dict:
+    """Mongo filter for an export; doctors are always limited to their own prescriptions"""
+    query = {}
+    if payload.get("role") == "doctor":
+        query["doctor_id"] = payload.get("doctor_id")
+    elif doctor_id:
+        query["doctor_id"] = doctor_id
+    if location:
+        query["location"] = location
+    if op_no:
+        query["op_no"] = op_no
+    query.update(created_at_filter(date_from, date_to))
+    return query
+
+async def doctor_names() -> dict:
+    names = {d["id"]: d["name"] for d in DEFAULT_DOCTORS}
+    async for doctor in db.doctors.find({}, {"_id": 0, "id": 1, "name": 1}):
+        names[doctor["id"]] = doctor.get("name", "")
+    return names
+
+def drug_duration(drug: dict) -> str:
+    return f"{drug.get('duration', '')} {drug.get('duration_unit', '')}".strip()
+
+def export_rows(prescription: dict, names: dict):
+    """Flatten a prescription into one row per drug (a single row without drug columns if it has none)"""
+    doctor_id = prescription.get('doctor_id', 'dr_prakashini')
+    base = [
+        prescription.get('id', ''),
+        prescription.get('op_no', ''),
+        prescription.get('patient_name', ''),
+        prescription.get('sex', ''),
+        prescription.get('age', ''),
+        prescription.get('icd_code', ''),
+        prescription.get('weight', ''),
+        prescription.get('height', ''),
+        prescription.get('bp', ''),
+        prescription.get('spo2', ''),
+        created_day(prescription),
+    ]
+    tail = [
+        prescription.get('advice', ''),
+        prescription.get('lab_tests', ''),
+        names.get(doctor_id, doctor_id),
+        prescription.get('location', 'Bangalore'),
+    ]
+    drugs = prescription.get('drugs') or [{}]
+    for drug in drugs:
+        yield base + [
+            drug.get('drug_name', ''),
+            drug.get('dosage', ''),
+            drug.get('frequency', ''),
+            drug_duration(drug),
+            drug.get('comments', ''),
+        ] + tail
+
+async def iter_export_rows(query: dict):
+    names = await doctor_names()
+    async for prescription in iter_prescriptions(query):
+        for row in export_rows(prescription, names):
+            yield row
+
+async def write_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    count = 0
+    async for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % EXPORT_BATCH_ROWS == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+async def write_ndjson(rows):
+    lines = []
+    async for row in rows:
+        lines.append(json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False))
+        if len(lines) == EXPORT_BATCH_ROWS:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+            lines = []
+    if lines:
+        yield ("\n".join(lines) + "\n").encode("utf-8")
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands written bytes back to a streaming response"""
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self._position
+    
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+async def write_parquet(rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    schema = pa.schema([(name, pa.string()) for name in EXPORT_FIELDS])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    columns = [[] for _ in EXPORT_FIELDS]
+    
+    def flush_row_group():
+        writer.write_table(pa.Table.from_arrays([pa.array(c, pa.string()) for c in columns], schema=schema))
+        for column in columns:
+            column.clear()
+    
+    async for row in rows:
+        for column, value in zip(columns, row):
+            column.append(None if value is None else str(value))
+        if len(columns[0]) == EXPORT_BATCH_ROWS:
+            flush_row_group()
+            yield sink.drain()
+    if columns[0]:
+        flush_row_group()
+    writer.close()
+    yield sink.drain()
+
+# Cached export artifacts, validated against per-day change counters and the doctor names they show;
+# each worker keeps its own, bounded by the total size of the workbooks it holds
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+_export_cache = OrderedDict()
+_export_cache_bytes = 0
+
+async def touch_change_days(*prescriptions):
+    """Record that prescriptions created on these days changed (invalidates cached exports covering them)"""
+    days = {created_day(p) for p in prescriptions if p}
+    if days:
+        await db.change_days.bulk_write(
+            [UpdateOne({"day": day}, {"$inc": {"changes": 1}}, upsert=True) for day in days], ordered=False
+        )
+
+async def change_days_epoch(date_from: Optional[date], date_to: Optional[date]) -> tuple:
+    """Monotonic change counter for a date range; scans one small document per day"""
+    match = {}
+    if date_from or date_to:
+        match["day"] = {}
+        if date_from:
+            match["day"]["$gte"] = date_from.isoformat()
+        if date_to:
+            match["day"]["$lte"] = date_to.isoformat()
+    rows = await db.change_days.aggregate([
+        {"$match": match},
+        {"$group": {"_id": None, "changes": {"$sum": "$changes"}, "days": {"$sum": 1}}},
+    ]).to_list(1)
+    return (rows[0]["changes"], rows[0]["days"]) if rows else (0, 0)
+
+def export_cache_get(key: str, epoch: tuple) -> Optional[bytes]:
+    hit = _export_cache.get(key)
+    if hit and hit[0] == epoch:
+        _export_cache.move_to_end(key)
+        return hit[1]
+    return None
+
+def doctor_names_digest(names: dict) -> str:
+    """Changes whenever a doctor is added, renamed or removed"""
+    return hashlib.sha256(json.dumps(names, sort_keys=True).encode()).hexdigest()
+
+def export_cache_put(key: str, epoch: tuple, content: bytes):
+    global _export_cache_bytes
+    if len(content) > EXPORT_CACHE_MAX_BYTES:
+        return
+    if key in _export_cache:
+        _export_cache_bytes -= len(_export_cache.pop(key)[1])
+    _export_cache[key] = (epoch, content)
+    _export_cache_bytes += len(content)
+    while _export_cache_bytes > EXPORT_CACHE_MAX_BYTES:
+        _export_cache_bytes -= len(_export_cache.popitem(last=False)[1][1])
+
+# format -> (media type, file extension, writer)
+EXPORT_WRITERS = {
+    "csv": ("text/csv; charset=utf-8", "csv", write_csv),
+    "ndjson": ("application/x-ndjson", "ndjson", write_ndjson),
+    "parquet": ("application/vnd.apache.parquet", "parquet", write_parquet),
+}
+
+# Excel layout shared by the single-sheet and partitioned exports
+EXCEL_HEADERS = ["OP No", "Patient Name", "Sex", "Age", "ICD Code", "Weight", "Height", "BP", "SpO2", "Date", "Drug Name", "Dosage", "Frequency", "Duration", "Comments", "Advice", "Lab Tests", "Doctor", "Location"]
+EXCEL_COLUMN_WIDTHS = {'A': 12, 'B': 20, 'C': 10, 'D': 8, 'E': 12, 'F': 15, 'G': 12, 'H': 20, 'I': 12, 'J': 15,
+                       'K': 12, 'L': 20, 'M': 25, 'N': 25, 'O': 20, 'S': 15}
+EXCEL_PATIENT_FIELDS = ('op_no', 'patient_name', 'sex', 'age', 'icd_code', 'weight', 'height', 'bp', 'spo2')
+
+def excel_rows(prescriptions: list, names: dict) -> list:
+    """Excel rows for prescriptions, built column by column: patient columns only on each prescription's first drug row"""
+    drug_lists = [p.get('drugs') or [{}] for p in prescriptions]
+    follow_ups = [[''] * (len(drugs) - 1) for drugs in drug_lists]
+    drugs = [drug for drug_list in drug_lists for drug in drug_list]
+    
+    def patient_column(value) -> list:
+        column = []
+        for prescription, blanks in zip(prescriptions, follow_ups):
+            column.append(value(prescription))
+            column += blanks
+        return column
+    
+    def doctor_name(prescription):
+        doctor_id = prescription.get('doctor_id', 'dr_prakashini')
+        return names.get(doctor_id, doctor_id)
+    
+    columns = [patient_column(lambda p, field=field: p.get(field, '')) for field in EXCEL_PATIENT_FIELDS]
+    columns.append(patient_column(created_day))
+    columns += [[drug.get(field, '') for drug in drugs] for field in ('drug_name', 'dosage', 'frequency')]
+    columns.append([drug_duration(drug) for drug in drugs])
+    columns.append([drug.get('comments', '') for drug in drugs])
+    columns.append(patient_column(lambda p: p.get('advice', '')))
+    columns.append(patient_column(lambda p: p.get('lab_tests', '')))
+    columns.append(patient_column(doctor_name))
+    columns.append(patient_column(lambda p: p.get('location', 'Bangalore')))
+    return list(zip(*columns))
+
+# Partitioned exports write each sheet's worksheet XML in a worker process and merge the parts
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', os.cpu_count() or 1))
+EXPORT_PARALLEL_MIN_PRESCRIPTIONS = 2000
+EXPORT_PARTITIONS = ("doctor", "location", "month")
+# Prescriptions flattened per step of an Excel export; only their rows are kept
+EXCEL_EXPORT_BATCH = 5000
+# Workbooks are built in memory, so larger exports are refused in favour of the streaming formats
+EXCEL_EXPORT_MAX_ROWS = int(os.environ.get('EXCEL_EXPORT_MAX_ROWS', 250000))
+_export_pool = None
+
+def export_pool() -> ProcessPoolExecutor:
+    global _export_pool
+    if _export_pool is None:
+        # Spawned, not forked: the server process already runs Motor's threads and the event loop
+        _export_pool = ProcessPoolExecutor(max_workers=EXPORT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _export_pool
+
+def partition_prescriptions(prescriptions: list, partition: str, names: dict) -> dict:
+    """Group prescriptions (already newest first) by doctor name, location or YYYY-MM"""
+    partitions = {}
+    for prescription in prescriptions:
+        if partition == "doctor":
+            doctor_id = prescription.get('doctor_id', 'dr_prakashini')
+            key = names.get(doctor_id, doctor_id)
+        elif partition == "location":
+            key = prescription.get('location', 'Bangalore')
+        else:
+            key = created_day(prescription)[:7] or 'Undated'
+        partitions.setdefault(key, []).append(prescription)
+    return partitions
+
+def _sheet_title(key: str, used: set) -> str:
+    """Excel sheet titles: max 31 chars, no []:*?/\\ and unique"""
+    base = re.sub(r'[\[\]:*?/\\]', '-', key or 'Blank')[:31]
+    title, n = base, 2
+    while title.lower() in used:
+        suffix = f" ({n})"
+        title, n = base[:31 - len(suffix)] + suffix, n + 1
+    used.add(title.lower())
+    return title
+
+def build_excel_workbook(sheets: list, summary: Optional[list] = None) -> bytes:
+    """Write-only workbook with an optional summary sheet followed by one bordered sheet per (title, rows)"""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Border, Side, NamedStyle
+    
+    wb = Workbook(write_only=True)
+    thin = Side(style='thin')
+    wb.add_named_style(NamedStyle(name="export_cell", border=Border(left=thin, right=thin, top=thin, bottom=thin)))
+    wb.add_named_style(NamedStyle(name="export_header", font=Font(bold=True), border=Border(left=thin, right=thin, top=thin, bottom=thin)))
+    
+    def append_styled(ws, rows, style):
+        # Write-only rows are serialised as soon as they are appended, so every row reuses one styled cell per column
+        cells = []
+        for row in rows:
+            while len(cells) < len(row):
+                cell = WriteOnlyCell(ws)
+                cell.style = style
+                cells.append(cell)
+            for cell, value in zip(cells, row):
+                cell.value = value
+            ws.append(cells[:len(row)])
+    
+    if summary is not None:
+        ws = wb.create_sheet("Summary")
+        ws.column_dimensions['A'].width = 30
+        append_styled(ws, [["Sheet", "Prescriptions", "Drug Rows", "From", "To"]], "export_header")
+        for row in summary:
+            ws.append(row)
+    
+    for title, rows in sheets:
+        ws = wb.create_sheet(title)
+        for column, width in EXCEL_COLUMN_WIDTHS.items():
+            ws.column_dimensions[column].width = width
+        append_styled(ws, [EXCEL_HEADERS], "export_header")
+        append_styled(ws, rows, "export_cell")
+    
+    buffer = BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+def excel_sheet_part(rows: list) -> tuple:
+    """(styles.xml, worksheet XML) of one finished export sheet; runs in an export worker"""
+    with zipfile.ZipFile(BytesIO(build_excel_workbook([("Sheet", rows)]))) as package:
+        return package.read("xl/styles.xml"), package.read("xl/worksheets/sheet1.xml")
+
+def merge_excel_parts(skeleton: bytes, parts: list) -> bytes:
+    """Swap the sheets after the summary in a skeleton workbook for worksheets built by excel_sheet_part"""
+    # build_excel_workbook always writes a header cell before any body cell, so every workbook it builds
+    # numbers the header style 1 and the body style 2 and a part's styles.xml fits the skeleton's summary too
+    replace = {f"xl/worksheets/sheet{i}.xml": sheet for i, (_, sheet) in enumerate(parts, 2)}
+    replace["xl/styles.xml"] = parts[0][0]
+    buffer = BytesIO()
+    with zipfile.ZipFile(BytesIO(skeleton)) as source, zipfile.ZipFile(buffer, "w") as target:
+        for item in source.infolist():
+            target.writestr(item, replace.get(item.filename) or source.read(item))
+    return buffer.getvalue()
+
+def build_partitioned_workbook(sheets: dict, stats: dict, parts: Optional[list] = None) -> bytes:
+    """Assemble a workbook with a summary sheet followed by one sheet per partition, from worker parts if given"""
+    used = {"summary"}
+    titles = [_sheet_title(key, used) for key in sheets]
+    summary = [[title, *stats[key]] for title, key in zip(titles, sheets)]
+    if parts is None:
+        return build_excel_workbook(list(zip(titles, sheets.values())), summary)
+    return merge_excel_parts(build_excel_workbook([(title, []) for title in titles], summary), parts)
+
+async def excel_sheets(query: dict, partition: Optional[str]) -> tuple:
+    """Rows per sheet and [prescriptions, rows, first day, last day] per sheet, from prescriptions read in batches"""
+    names = await doctor_names()
+    sheets, stats, total = {}, {}, 0
+    batch = []
+
+    def flush():
+        nonlocal total
+        partitions = partition_prescriptions(batch, partition, names) if partition else {"Prescriptions": batch}
+        for key, chunk in partitions.items():
+            rows = excel_rows(chunk, names)
+            sheets.setdefault(key, []).extend(rows)
+            days = [day for day in map(created_day, chunk) if day]
+            count, row_count, first, last = stats.get(key, (0, 0, '', ''))
+            days += [day for day in (first, last) if day]
+            stats[key] = (count + len(chunk), row_count + len(rows), min(days, default=''), max(days, default=''))
+            total += len(rows)
+        if total > EXCEL_EXPORT_MAX_ROWS:
+            raise HTTPException(status_code=400, detail=f"Excel exports are limited to {EXCEL_EXPORT_MAX_ROWS} rows; "
+                                                        "narrow the filters or export CSV, NDJSON or Parquet")
+
+    async for prescription in iter_prescriptions(query):
+        batch.append(prescription)
+        if len(batch) == EXCEL_EXPORT_BATCH:
+            flush()
+            batch = []
+    if batch or not sheets:
+        flush()
+    return sheets, stats
+
+# Daily rollups - per (day, doctor, location) counters kept in step with every prescription write
+ROLLUP_METRICS = ("prescriptions", "drug_lines", "drug", "icd")
+
+def rollup_contributions(prescription: Optional[dict]) -> Counter:
+    """Counters a single prescription adds to rollups_daily"""
+    counts = Counter()
+    if not prescription:
+        return counts
+    dims = (
+        created_day(prescription),
+        prescription.get("doctor_id", "dr_prakashini"),
+        prescription.get("location", "Bangalore"),
+    )
+    drugs = prescription.get("drugs", [])
+    counts[dims + ("prescriptions", "")] += 1
+    counts[dims + ("drug_lines", "")] += len(drugs)
+    for drug in drugs:
+        counts[dims + ("drug", drug.get("drug_name", ""))] += 1
+    if prescription.get("icd_code"):
+        counts[dims + ("icd", prescription["icd_code"])] += 1
+    return counts
+
+def _rollup_filter(day: str, doctor_id: str, location: str, metric: str, key: str) -> dict:
+    return {"metric": metric, "day": day, "doctor_id": doctor_id, "location": location, "key": key}
+
+async def apply_rollup_delta(before: Optional[dict], after: Optional[dict]):
+    """Move rollup counters from the old state of a prescription to the new one ($inc upserts)"""
+    delta = rollup_contributions(after)
+    delta.subtract(rollup_contributions(before))
+    ops = [
+        UpdateOne(_rollup_filter(*dims), {"$inc": {"count": n}}, upsert=True)
+        for dims, n in delta.items() if n
+    ]
+    if ops:
+        await db.rollups_daily.bulk_write(ops, ordered=False)
+
+async def compute_rollups(date_from: Optional[date] = None, date_to: Optional[date] = None) -> Counter:
+    """Recompute rollup counters from the prescriptions themselves"""
+    match = analytics_match(date_from, date_to)
+    dims = {"day": date_prefix("$created_at", "day"), "doctor_id": "$doctor_id", "location": "$location"}
+    per_prescription, per_drug, per_icd = await asyncio.gather(
+        db.prescriptions.aggregate(match + [
+            {"$group": {"_id": dims, "prescriptions": {"$sum": 1}, "drug_lines": {"$sum": {"$size": {"$ifNull": ["$drugs", []]}}}}},
+        ]).to_list(None),
+        db.prescriptions.aggregate(match + [
+            {"$unwind": "$drugs"},
+            {"$group": {"_id": {**dims, "key": DRUG_GROUP_KEY}, "count": {"$sum": 1}}},
+        ]).to_list(None),
+        db.prescriptions.aggregate(match + [
+            {"$match": {"icd_code": {"$nin": ["", None]}}},
+            {"$group": {"_id": {**dims, "key": "$icd_code"}, "count": {"$sum": 1}}},
+        ]).to_list(None),
+    )
+    counts = Counter()
+    for row in per_prescription:
+        g = row["_id"]
+        base = (g["day"], g.get("doctor_id", "dr_prakashini"), g.get("location", "Bangalore"))
+        counts[base + ("prescriptions", "")] += row["prescriptions"]
+        counts[base + ("drug_lines", "")] += row["drug_lines"]
+    for metric, rows, key_name in (("drug", per_drug, drug_display_name), ("icd", per_icd, str)):
+        for row in rows:
+            g = row["_id"]
+            counts[(g["day"], g.get("doctor_id", "dr_prakashini"), g.get("location", "Bangalore"), metric, key_name(g.get("key") or ""))] += row["count"]
+    # Archived prescriptions are compressed, so they are counted here rather than by Mongo
+    async for entry in db.prescriptions_archive.find(created_at_filter(date_from, date_to), {"data": 1}):
+        counts.update(rollup_contributions(expand_prescription(unpack_archived(entry))))
+    return counts
+
+def _rollup_day_filter(date_from: Optional[date], date_to: Optional[date]) -> dict:
+    return rollup_match(list(ROLLUP_METRICS), date_from, date_to)["$match"]
+
+async def rebuild_rollups(date_from: Optional[date] = None, date_to: Optional[date] = None) -> int:
+    """Replace the rollups for a date range (everything by default) with freshly computed counters"""
+    counts = await compute_rollups(date_from, date_to)
+    await db.rollups_daily.delete_many(_rollup_day_filter(date_from, date_to))
+    docs = [{**_rollup_filter(*dims), "count": n} for dims, n in counts.items() if n]
+    for start in range(0, len(docs), 1000):
+        await db.rollups_daily.insert_many(docs[start:start + 1000], ordered=False)
+    return len(docs)
+
+async def init_rollups():
+    """Backfill rollups on first start after they were introduced"""
+    if await db.rollups_daily.count_documents({}, limit=1) == 0 and await db.prescriptions.count_documents({}, limit=1):
+        written = await rebuild_rollups()
+        logging.info(f"Backfilled {written} daily rollup counters")
+
+# Timestamp migration - converts legacy ISO string created_at/updated_at to BSON dates in throttled
+# batches, newest first: the converted documents are always the newest ones, so created_at sorts
+# (dates order after strings) stay correct while it runs. Progress lives in db.migrations, and each
+# batch only selects documents still holding strings, so a restart resumes where it stopped
+TIMESTAMP_MIGRATION_ID = "prescription_timestamps"
+TIMESTAMP_FIELDS = ("created_at", "updated_at")
+# Converted after the prescriptions; their ordering never depended on the string form
+TIMESTAMP_COLLECTIONS = ("prescription_revisions", "pdf_renders")
+LEGACY_TIMESTAMP = {"created_at": {"$type": "string"}}
+_timestamp_migration = None
+
+async def migrate_timestamps(batch_size: int, pause: float):
+    global _legacy_timestamps
+    skipped = []
+    while True:
+        batch = await db.prescriptions.find(
+            {**LEGACY_TIMESTAMP, "_id": {"$nin": skipped}},
+            {"_id": 1, "created_at": 1, "updated_at": 1},
+        ).sort("created_at", -1).to_list(batch_size)
+        if not batch:
+            break
+        ops = []
+        for doc in batch:
+            legacy = {f: doc[f] for f in TIMESTAMP_FIELDS if isinstance(doc.get(f), str)}
+            converted = {f: as_datetime(value) for f, value in legacy.items()}
+            if converted["created_at"] is None:
+                skipped.append(doc["_id"])
+                continue
+            # Matching the old strings keeps a concurrent edit's updated_at from being overwritten
+            ops.append(UpdateOne({"_id": doc["_id"], **legacy},
+                                 {"$set": {f: value for f, value in converted.items() if value is not None}}))
+        if ops:
+            await db.prescriptions.bulk_write(ops, ordered=False)
+        await db.migrations.update_one(
+            {"_id": TIMESTAMP_MIGRATION_ID},
+            {"$inc": {"converted": len(ops)}, "$set": {"skipped": len(skipped), "updated_at": datetime.now(timezone.utc)}},
+        )
+        await asyncio.sleep(pause)
+    if not skipped:
+        _legacy_timestamps = False
+    for name in TIMESTAMP_COLLECTIONS:
+        await migrate_collection_timestamps(db[name], batch_size, pause)
+    await db.migrations.update_one(
+        {"_id": TIMESTAMP_MIGRATION_ID},
+        {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc)}},
+    )
+    logging.info(f"Timestamp migration finished ({len(skipped)} unparseable created_at left as strings)")
+
+async def migrate_collection_timestamps(collection, batch_size: int, pause: float):
+    """Convert a string created_at to a date in every document of a collection (unparseable ones are skipped)"""
+    skipped = []
+    while True:
+        batch = await collection.find(
+            {**LEGACY_TIMESTAMP, "_id": {"$nin": skipped}}, {"_id": 1, "created_at": 1}
+        ).to_list(batch_size)
+        if not batch:
+            break
+        ops = []
+        for doc in batch:
+            converted = as_datetime(doc["created_at"])
+            if converted is None:
+                skipped.append(doc["_id"])
+            else:
+                ops.append(UpdateOne({"_id": doc["_id"], "created_at": doc["created_at"]}, {"$set": {"created_at": converted}}))
+        if ops:
+            await collection.bulk_write(ops, ordered=False)
+        await asyncio.sleep(pause)
+
+def start_timestamp_migration(batch_size: int, pause: float):
+    global _timestamp_migration
+    _timestamp_migration = asyncio.create_task(migrate_timestamps(batch_size, pause))
+
+def timestamp_migration_running() -> bool:
+    return _timestamp_migration is not None and not _timestamp_migration.done()
+
+async def init_timestamp_migration():
+    """Drop the legacy string branch from date filters once nothing needs it; resume an interrupted migration"""
+    global _legacy_timestamps
+    if not await db.prescriptions.count_documents(LEGACY_TIMESTAMP, limit=1):
+        _legacy_timestamps = False
+    state = await db.migrations.find_one({"_id": TIMESTAMP_MIGRATION_ID})
+    if state and state.get("status") == "running":
+        start_timestamp_migration(state["batch_size"], state["pause"])
+
+# Drug entry migration - rewrites full DrugEntry dicts in their compact stored form, in throttled
+# batches. The read path handles both forms, so it can run while the app serves; progress lives in
+# db.migrations and each batch only selects documents still holding full entries
+DRUG_MIGRATION_ID = "compact_drugs"
+LEGACY_DRUGS = {"drugs.drug_name": {"$exists": True}}
+_drug_migration = None
+
+async def migrate_drugs(batch_size: int, pause: float):
+    while True:
+        batch = await db.prescriptions.find(LEGACY_DRUGS, {"_id": 1, "drugs": 1}).to_list(batch_size)
+        if not batch:
+            break
+        # Matching the old entries keeps a concurrent edit's drugs from being overwritten
+        await db.prescriptions.bulk_write([
+            UpdateOne({"_id": doc["_id"], "drugs": doc["drugs"]},
+                      {"$set": {"drugs": [compact_drug(expand_drug(d)) for d in doc["drugs"]]}})
+            for doc in batch
+        ], ordered=False)
+        await db.migrations.update_one(
+            {"_id": DRUG_MIGRATION_ID},
+            {"$inc": {"converted": len(batch)}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        )
+        await asyncio.sleep(pause)
+    await db.migrations.update_one(
+        {"_id": DRUG_MIGRATION_ID},
+        {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc)}},
+    )
+    logging.info("Drug entry migration finished")
+
+def start_drug_migration(batch_size: int, pause: float):
+    global _drug_migration
+    _drug_migration = asyncio.create_task(migrate_drugs(batch_size, pause))
+
+def drug_migration_running() -> bool:
+    return _drug_migration is not None and not _drug_migration.done()
+
+async def init_drug_migration():
+    """Resume an interrupted drug entry migration"""
+    state = await db.migrations.find_one({"_id": DRUG_MIGRATION_ID})
+    if state and state.get("status") == "running":
+        start_drug_migration(state["batch_size"], state["pause"])
+
+# Schema write-back - stores the upgrades reads already apply, in throttled batches. Only the fields an
+# upgrade changed are written, guarded by the version the upgrade started from, so a concurrent edit
+# is never overwritten; its document is simply picked up again by a later batch
+SCHEMA_MIGRATION_ID = "prescription_schema"
+STALE_SCHEMA = {"schema_version": {"$not": {"$gte": PRESCRIPTION_SCHEMA_VERSION}}}
+_schema_writeback = None
+
+def schema_writeback_op(stored: dict) -> UpdateOne:
+    upgraded = upgrade_prescription(copy.deepcopy(stored))
+    update = {"$set": {k: v for k, v in upgraded.items() if k not in stored or stored[k] != v}}
+    removed = {k: "" for k in stored if k not in upgraded}
+    if removed:
+        update["$unset"] = removed
+    return UpdateOne({"id": stored["id"], "version": stored.get("version"),
+                      "schema_version": stored.get("schema_version")}, update)
+
+async def write_back_schema(batch_size: int, pause: float):
+    while True:
+        batch = await db.prescriptions.find(STALE_SCHEMA).to_list(batch_size)
+        if not batch:
+            break
+        result = await db.prescriptions.bulk_write([schema_writeback_op(doc) for doc in batch], ordered=False)
+        await db.migrations.update_one(
+            {"_id": SCHEMA_MIGRATION_ID},
+            {"$inc": {"converted": result.modified_count}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        )
+        await asyncio.sleep(pause)
+    await db.migrations.update_one(
+        {"_id": SCHEMA_MIGRATION_ID},
+        {"$set": {"status": "done", "schema_version": PRESCRIPTION_SCHEMA_VERSION,
+                  "finished_at": datetime.now(timezone.utc)}},
+    )
+    logging.info(f"Schema write-back finished (schema version {PRESCRIPTION_SCHEMA_VERSION})")
+
+def start_schema_writeback(batch_size: int, pause: float):
+    global _schema_writeback
+    _schema_writeback = asyncio.create_task(write_back_schema(batch_size, pause))
+
+def schema_writeback_running() -> bool:
+    return _schema_writeback is not None and not _schema_writeback.done()
+
+async def init_schema_writeback():
+    """Resume an interrupted schema write-back"""
+    state = await db.migrations.find_one({"_id": SCHEMA_MIGRATION_ID})
+    if state and state.get("status") == "running":
+        start_schema_writeback(state["batch_size"], state["pause"])
+
+# Archiver - moves prescriptions created more than older_than_days ago to prescriptions_archive in
+# throttled batches, oldest first. An entry is written before its hot copy is deleted, and the delete is
+# guarded by the version and change_seq that were packed, so a prescription edited meanwhile stays hot,
+# and the archive copy of one edited or deleted meanwhile is dropped. Progress lives in db.migrations;
+# a restart resumes the run
+ARCHIVE_JOB_ID = "archive_prescriptions"
+_archiver = None
+
+def archive_cutoff(older_than_days: int) -> dict:
+    """Hot prescriptions old enough to archive (legacy string timestamps wait for the timestamp migration)"""
+    return {"created_at": {"$lt": datetime.now(timezone.utc) - timedelta(days=older_than_days)}}
+
+async def archive_prescriptions(older_than_days: int, batch_size: int, pause: float):
+    query = archive_cutoff(older_than_days)
+    while True:
+        batch = await db.prescriptions.find(query).sort("created_at", 1).to_list(batch_size)
+        if not batch:
+            break
+        await db.prescriptions_archive.bulk_write(
+            [ReplaceOne({"id": p["id"]}, pack_archived(p), upsert=True) for p in batch], ordered=False
+        )
+        # One delete per prescription, so each one that did not match is known
+        results = await asyncio.gather(*(
+            db.prescriptions.delete_one({"_id": p["_id"], "version": p.get("version"), "change_seq": p.get("change_seq")})
+            for p in batch
+        ))
+        # Edited or deleted while being packed: the archive copy is stale either way
+        stale = [p["id"] for p, result in zip(batch, results) if not result.deleted_count]
+        if stale:
+            await db.prescriptions_archive.delete_many({"id": {"$in": stale}})
+        await db.migrations.update_one(
+            {"_id": ARCHIVE_JOB_ID},
+            {"$inc": {"archived": len(batch) - len(stale)}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        )
+        await asyncio.sleep(pause)
+    await db.migrations.update_one(
+        {"_id": ARCHIVE_JOB_ID},
+        {"$set": {"status": "done", "finished_at": datetime.now(timezone.utc)}},
+    )
+    logging.info(f"Archived prescriptions created more than {older_than_days} days ago")
+
+def start_archiver(older_than_days: int, batch_size: int, pause: float):
+    global _archiver
+    _archiver = asyncio.create_task(archive_prescriptions(older_than_days, batch_size, pause))
+
+def archiver_running() -> bool:
+    return _archiver is not None and not _archiver.done()
+
+async def init_archiver():
+    """Resume an interrupted archiver run"""
+    state = await db.migrations.find_one({"_id": ARCHIVE_JOB_ID})
+    if state and state.get("status") == "running":
+        start_archiver(state["older_than_days"], state["batch_size"], state["pause"])
+
+# Change feed - every prescription write stamps the next change_seq and every delete leaves a
+# tombstone with one, so clients can fetch only what changed since the last sequence they saw
+SYNC_PAGE_SIZE = 500
+# Every write in flight, on any worker, keeps a marker in pending_change_seqs holding a lower bound
+# of its sequence. A sync page stops below the lowest one, so a client never advances its token past
+# a write still in progress; markers left by a worker that died mid-write stop counting after the lease
+PENDING_SEQ_LEASE_SECONDS = 60
+_last_change_seq = 0
+
+async def allocate_change_seqs(count: int = 1) -> int:
+    """Reserve count sequence numbers and return the last one"""
+    global _last_change_seq
+    counter = await db.counters.find_one_and_update(
+        {"_id": "change_seq"}, {"$inc": {"seq": count}}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    _last_change_seq = max(_last_change_seq, counter["seq"])
+    return counter["seq"]
+
+@asynccontextmanager
+async def change_seq(count: int = 1):
+    """Last of count sequence numbers for a write, held back from sync readers until the write is done"""
+    # The marker goes in before the counter moves; the highest sequence this worker has seen bounds ours
+    marker = await db.pending_change_seqs.insert_one({"seq": _last_change_seq + 1, "at": datetime.now(timezone.utc)})
+    try:
+        yield await allocate_change_seqs(count)
+    finally:
+        await db.pending_change_seqs.delete_one({"_id": marker.inserted_id})
+
+async def sync_horizon() -> int:
+    """Highest sequence a sync page may include"""
+    # Counter first: every sequence it has handed out already had its marker in place
+    counter = await db.counters.find_one({"_id": "change_seq"})
+    horizon = counter["seq"] if counter else 0
+    lease_start = datetime.now(timezone.utc) - timedelta(seconds=PENDING_SEQ_LEASE_SECONDS)
+    pending = await db.pending_change_seqs.find_one({"at": {"$gt": lease_start}}, sort=[("seq", 1)])
+    return min(horizon, pending["seq"] - 1) if pending else horizon
+
+async def init_change_seqs():
+    """Stamp prescriptions written before the change feed so a full sync (since=0) returns them"""
+    global _last_change_seq
+    # Keeps this worker's first pending marker close to the sequence it will get
+    counter = await db.counters.find_one({"_id": "change_seq"})
+    _last_change_seq = counter["seq"] if counter else 0
+    stamped = 0
+    while True:
+        legacy = await db.prescriptions.find(
+            {"change_seq": {"$exists": False}}, {"_id": 0, "id": 1}
+        ).sort("created_at", 1).to_list(1000)
+        if not legacy:
+            break
+        async with change_seq(len(legacy)) as last:
+            first = last - len(legacy) + 1
+            await db.prescriptions.bulk_write([
+                UpdateOne({"id": p["id"], "change_seq": {"$exists": False}}, {"$set": {"change_seq": first + i}})
+                for i, p in enumerate(legacy)
+            ], ordered=False)
+        stamped += len(legacy)
+    if stamped:
+        logging.info(f"Backfilled change_seq on {stamped} prescriptions")
+
+# Change notifications - every prescription write, on any worker, appends one small event to the
+# capped change_events collection; a single fan-out task per worker tails it, formats each event once
+# and copies it into each matching subscriber's bounded buffer
+EVENT_BUFFER_SIZE = 100
+EVENT_HEARTBEAT_SECONDS = 15
+EVENT_LOG_BYTES = 16 * 1024 * 1024
+EVENT_POLL_SECONDS = 1
+RESYNC_EVENT = "event: resync\ndata: {}\n\n"
+
+class EventSubscription:
+    def __init__(self, doctor_id: Optional[str]):
+        # None receives every event (admin)
+        self.doctor_id = doctor_id
+        self.queue = asyncio.Queue(maxsize=EVENT_BUFFER_SIZE)
+
+    def push(self, message: str) -> bool:
+        """Buffer a message; a client that falls behind gets one resync event instead of the backlog"""
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESYNC_EVENT)
+            return False
+
+class ChangeBroadcaster:
+    def __init__(self):
+        self._task = None
+        self._subscribers = set()
+        self.stats = {"published": 0, "delivered": 0, "resyncs": 0}
+
+    def start(self):
+        self._task = asyncio.create_task(self._fan_out())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def publish(self, before: Optional[dict], after: Optional[dict]):
+        """Append the notification for a create (before=None), edit or delete (after=None) to the shared event log"""
+        current = after or before
+        data = {
+            "type": "created" if before is None else "deleted" if after is None else "updated",
+            "id": current["id"],
+            "op_no": current.get("op_no"),
+            "change_seq": current.get("change_seq"),
+        }
+        # An edit that reassigns the prescription also notifies the previous doctor
+        doctor_ids = sorted({p.get("doctor_id") for p in (before, after) if p})
+        try:
+            await db.change_events.insert_one({"doctor_ids": doctor_ids, "data": data})
+        except Exception as e:
+            # The write itself succeeded; subscribers still catch up through /sync
+            logger.warning("Change event for %s not published: %s", data["id"], e)
+
+    def subscribe(self, doctor_id: Optional[str]) -> EventSubscription:
+        subscription = EventSubscription(doctor_id)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: EventSubscription):
+        self._subscribers.discard(subscription)
+
+    def _deliver(self, event: dict):
+        data = event["data"]
+        self.stats["published"] += 1
+        message = f"event: prescription\nid: {data['change_seq']}\ndata: {json.dumps(data)}\n\n"
+        for subscription in self._subscribers:
+            if subscription.doctor_id is None or subscription.doctor_id in event["doctor_ids"]:
+                self.stats["delivered" if subscription.push(message) else "resyncs"] += 1
+
+    def _resync_all(self):
+        for subscription in self._subscribers:
+            subscription.push(RESYNC_EVENT)
+            self.stats["resyncs"] += 1
+
+    async def _fan_out(self):
+        """Tail change_events from the newest entry at start"""
+        last = None
+        while True:
+            try:
+                capped = (await db.change_events.options()).get("capped", False)
+                if last is None:
+                    newest = await db.change_events.find_one({}, sort=[("$natural", -1)])
+                    last = newest["_id"] if newest else False
+                cursor = db.change_events.find(
+                    {"_id": {"$gt": last}} if last else {},
+                    cursor_type=CursorType.TAILABLE_AWAIT if capped else CursorType.NON_TAILABLE,
+                )
+                while cursor.alive:
+                    async for event in cursor:
+                        last = event["_id"]
+                        self._deliver(event)
+                    if not capped:
+                        break
+                if capped and last:
+                    # A tailing cursor only dies if the log wrapped past it; resuming by _id may skip events
+                    self._resync_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Change event fan-out interrupted: %s", e)
+                # Events may have been missed, and ids from different workers are not strictly ordered
+                last = None
+                self._resync_all()
+            await asyncio.sleep(EVENT_POLL_SECONDS)
+
+    def metrics(self) -> dict:
+        return {**self.stats, "subscribers": len(self._subscribers)}
+
+change_events = ChangeBroadcaster()
+
+# Patient summary helpers - one document per OP No, maintained on every prescription write
+def _patient_visit(prescription: dict) -> dict:
+    return {
+        "id": prescription["id"],
+        "created_at": prescription.get("created_at"),
+        "patient_name": prescription.get("patient_name", ""),
+        "diagnosis": prescription.get("diagnosis", ""),
+        "icd_code": prescription.get("icd_code", ""),
+        "doctor_id": prescription.get("doctor_id", "dr_prakashini"),
+        "location": prescription.get("location", "Bangalore"),
+        "drug_names": [d.get("drug_name", "") for d in prescription.get("drugs", [])],
+    }
+
+def _patient_latest(prescription: dict) -> dict:
+    """Summary fields taken from the most recent visit"""
+    return {
+        "patient_name": prescription.get("patient_name", ""),
+        "sex": prescription.get("sex", ""),
+        "age": prescription.get("age", ""),
+        "icd_code": prescription.get("icd_code", ""),
+        "weight": prescription.get("weight", ""),
+        "height": prescription.get("height", ""),
+        "bp": prescription.get("bp", ""),
+        "spo2": prescription.get("spo2", ""),
+        "current_drugs": prescription.get("drugs", []),
+        "last_prescription_id": prescription["id"],
+        "last_visit": prescription.get("created_at"),
+    }
+
+async def rebuild_patient_summary(op_no: str) -> Optional[dict]:
+    """Recompute a patient summary from their prescriptions (used for backfill, deletes and OP No changes)"""
+    hot_visits, archived_visits = await asyncio.gather(
+        db.prescriptions.count_documents({"op_no": op_no}),
+        db.prescriptions_archive.count_documents({"op_no": op_no}),
+    )
+    visit_count = hot_visits + archived_visits
+    if visit_count == 0:
+        await db.patients.delete_one({"op_no": op_no})
+        return None
+    recent = await prescriptions_for_op(op_no, PATIENT_VISIT_HISTORY)
+    summary = {
+        "op_no": op_no,
+        **_patient_latest(recent[0]),
+        "visit_count": visit_count,
+        "visits": [_patient_visit(p) for p in recent],
+        "updated_at": datetime.now(timezone.utc),
+    }
+    try:
+        await db.patients.replace_one({"op_no": op_no}, summary, upsert=True)
+    except DuplicateKeyError:
+        # A concurrent first visit created the summary in between; ours was computed from the prescriptions as well
+        await db.patients.replace_one({"op_no": op_no}, summary)
+    return summary
+
+async def record_patient_visit(prescription: dict):
+    """Fold a newly created prescription into its patient summary"""
+    result = await db.patients.update_one(
+        {"op_no": prescription["op_no"]},
+        {
+            "$set": {**_patient_latest(prescription), "updated_at": datetime.now(timezone.utc)},
+            "$inc": {"visit_count": 1},
+            "$push": {"visits": {"$each": [_patient_visit(prescription)], "$position": 0, "$slice": PATIENT_VISIT_HISTORY}},
+        }
+    )
+    if result.matched_count == 0:
+        # No summary yet - the patient may have visits from before summaries existed
+        await rebuild_patient_summary(prescription["op_no"])
+
+async def update_patient_visit(before: dict, after: dict):
+    """Apply an edited prescription to the affected patient summaries"""
+    if before.get("op_no") != after["op_no"]:
+        await rebuild_patient_summary(before.get("op_no"))
+        await rebuild_patient_summary(after["op_no"])
+        return
+    now = datetime.now(timezone.utc)
+    await db.patients.bulk_write([
+        UpdateOne(
+            {"op_no": after["op_no"], "visits.id": after["id"]},
+            {"$set": {"visits.$": _patient_visit(after), "updated_at": now}}
+        ),
+        UpdateOne(
+            {"op_no": after["op_no"], "last_prescription_id": after["id"]},
+            {"$set": _patient_latest(after)}
+        ),
+    ], ordered=False)
+
+# Vitals - the free-text weight/height/BP/SpO2 fields are parsed into numbers on every write and
+# mirrored into the vitals_ts time-series collection (one measurement per visit, meta = OP No and
+# prescription id, so a measurement can be deleted by filtering on meta fields alone)
+VITAL_FIELDS = ("weight_kg", "height_cm", "bp_systolic", "bp_diastolic", "spo2_pct")
+VITALS_INTERVALS = ("day", "week", "month", "quarter", "year")
+_NUMBER = r"(\d+(?:\.\d+)?)"
+_WEIGHT = re.compile(_NUMBER + r"\s*(kgs?|kilo\w*|lbs?|pounds?)?", re.IGNORECASE)
+_HEIGHT_FEET = re.compile(r"(\d+)\s*(?:'|ft|feet|foot)\s*(?:" + _NUMBER + r"\s*(?:\"|''|in\w*)?)?", re.IGNORECASE)
+_HEIGHT = re.compile(_NUMBER + r"\s*(cm|mtrs?|m|in\w*)?", re.IGNORECASE)
+_BP = re.compile(r"(\d{2,3})\s*/\s*(\d{2,3})")
+
+def _in_range(value: Optional[float], low: float, high: float) -> Optional[float]:
+    return round(value, 1) if value is not None and low <= value <= high else None
+
+def parse_weight(text: str) -> Optional[float]:
+    """Kilograms from e.g. '60', '60.5 kg' or '132 lbs'"""
+    match = _WEIGHT.search(text or "")
+    if not match:
+        return None
+    value = float(match.group(1))
+    if (match.group(2) or "").lower().startswith(("lb", "pound")):
+        value *= 0.45359237
+    return _in_range(value, 0.5, 400)
+
+def parse_height(text: str) -> Optional[float]:
+    """Centimetres from e.g. '160', '160 cm', '1.6 m', '5 ft 4 in' or 5'4 (feet and inches)"""
+    text = text or ""
+    match = _HEIGHT_FEET.search(text)
+    if match:
+        return _in_range((int(match.group(1)) * 12 + float(match.group(2) or 0)) * 2.54, 30, 250)
+    match = _HEIGHT.search(text)
+    if not match:
+        return None
+    value, unit = float(match.group(1)), (match.group(2) or "").lower()
+    if unit.startswith("in"):
+        value *= 2.54
+    elif unit.startswith("m") or (not unit and value < 3):
+        value *= 100
+    return _in_range(value, 30, 250)
+
+def parse_bp(text: str) -> tuple:
+    """(systolic, diastolic) mmHg from e.g. '120/80'; (None, None) if it does not read as a BP"""
+    match = _BP.search(text or "")
+    if not match:
+        return None, None
+    systolic, diastolic = _in_range(float(match.group(1)), 50, 300), _in_range(float(match.group(2)), 20, 200)
+    if systolic is None or diastolic is None or diastolic >= systolic:
+        return None, None
+    return systolic, diastolic
+
+def parse_spo2(text: str) -> Optional[float]:
+    match = re.search(_NUMBER, text or "")
+    return _in_range(float(match.group(1)), 50, 100) if match else None
+
+def parse_vitals(prescription: dict) -> dict:
+    """Numeric vitals of a prescription; fields that are empty or unreadable are left out"""
+    systolic, diastolic = parse_bp(prescription.get("bp"))
+    values = {
+        "weight_kg": parse_weight(prescription.get("weight")),
+        "height_cm": parse_height(prescription.get("height")),
+        "bp_systolic": systolic,
+        "bp_diastolic": diastolic,
+        "spo2_pct": parse_spo2(prescription.get("spo2")),
+    }
+    return {k: v for k, v in values.items() if v is not None}
+
+def vitals_measurement(prescription: dict) -> Optional[dict]:
+    """vitals_ts document for a prescription (None when it has no numeric vitals)"""
+    vitals = prescription.get("vitals_numeric")
+    created = as_datetime(prescription.get("created_at"))
+    if not vitals or not created:
+        return None
+    return {"ts": created, "meta": {"op_no": prescription["op_no"], "prescription_id": prescription["id"]}, **vitals}
+
+async def sync_vitals(before: Optional[dict], after: Optional[dict]):
+    """Replace a prescription's measurement in vitals_ts when its vitals or OP No change"""
+    old, new = (vitals_measurement(p) if p else None for p in (before, after))
+    if old == new:
+        return
+    if old:
+        await db.vitals_ts.delete_many({"meta.prescription_id": old["meta"]["prescription_id"]})
+    if new:
+        await db.vitals_ts.insert_one(new)
+
+async def migrate_vitals_meta():
+    """Re-mirror measurements stored with only the OP No in meta, hot and archived prescriptions alike"""
+    legacy = {"meta.prescription_id": {"$exists": False}}
+    if not await db.vitals_ts.find_one(legacy, {"_id": 1}):
+        return
+    batch = []
+
+    async def flush():
+        # New-shape measurements go in before the old ones are deleted, so a restart simply repeats the run
+        await db.vitals_ts.delete_many({"meta.prescription_id": {"$in": [p["id"] for p in batch]}})
+        measurements = [m for m in map(vitals_measurement, batch) if m]
+        if measurements:
+            await db.vitals_ts.insert_many(measurements, ordered=False)
+
+    async for prescription in iter_prescriptions({}):
+        batch.append(prescription)
+        if len(batch) == 1000:
+            await flush()
+            batch = []
+    if batch:
+        await flush()
+    await db.vitals_ts.delete_many(legacy)
+    logging.info("Moved prescription ids of vitals_ts measurements into meta")
+
+async def init_vitals():
+    """Parse vitals of prescriptions written before they were stored numerically and backfill vitals_ts"""
+    await migrate_vitals_meta()
+    backfilled = 0
+    while True:
+        batch = await db.prescriptions.find(
+            {"vitals_numeric": {"$exists": False}},
+            {"_id": 0, "id": 1, "op_no": 1, "created_at": 1, "weight": 1, "height": 1, "bp": 1, "spo2": 1},
+        ).to_list(1000)
+        if not batch:
+            break
+        measurements = []
+        for p in batch:
+            p["vitals_numeric"] = parse_vitals(p)
+            measurements.append(vitals_measurement(p))
+        # Measurements first: a restart in between re-parses the batch, and delete_many keeps it idempotent
+        await db.vitals_ts.delete_many({"meta.prescription_id": {"$in": [p["id"] for p in batch]}})
+        measurements = [m for m in measurements if m]
+        if measurements:
+            await db.vitals_ts.insert_many(measurements, ordered=False)
+        await db.prescriptions.bulk_write([
+            UpdateOne({"id": p["id"], "vitals_numeric": {"$exists": False}}, {"$set": {"vitals_numeric": p["vitals_numeric"]}})
+            for p in batch
+        ], ordered=False)
+        backfilled += len(batch)
+    if backfilled:
+        logging.info(f"Backfilled numeric vitals on {backfilled} prescriptions")
+
+async def after_prescription_write(before: Optional[dict], after: Optional[dict]):
+    """Keep derived data in step with a prescription create (before=None), edit or delete (after=None)"""
+    if before is None:
+        summary = record_patient_visit(after)
+    elif after is None:
+        summary = rebuild_patient_summary(before["op_no"])
+    else:
+        summary = update_patient_visit(before, after)
+    await asyncio.gather(
+        summary,
+        apply_rollup_delta(before, after),
+        touch_change_days(before, after),
+        sync_vitals(before, after),
+    )
+    await change_events.publish(before, after)
+    if after is None:
+        await delete_pdf_render(before["id"])
+    elif PDF_PRERENDER:
+        enqueue_pdf_render(after["id"])
+
 # Routes
 @api_router.get("/")
 async def root():
@@ -386,10 +2307,6 @@ async def create_doctor(doctor: DoctorCreate, payload: dict = Depends(require_ad
 @api_router.put("/admin/doctors/{doctor_id}")
 async def update_doctor(doctor_id: str, doctor: DoctorUpdate, payload: dict = Depends(require_admin)):
     """Update a doctor (admin only)"""
-    existing = await db.doctors.find_one({"id": doctor_id})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Doctor not found")
-    
     update_data = {}
     if doctor.name is not None:
         update_data["name"] = doctor.name
@@ -403,7 +2320,7 @@ async def update_doctor(doctor_id: str, doctor: DoctorUpdate, payload: dict = De
         update_data["location"] = doctor.location
     if doctor.username is not None:
         # Check if new username is taken by another doctor
-        other = await db.doctors.find_one({"username": doctor.username, "id": {"$ne": doctor_id}})
+        other = await db.doctors.find_one({"username": doctor.username, "id": {"$ne": doctor_id}}, {"_id": 1})
         if other:
             raise HTTPException(status_code=400, detail="Username already taken")
         update_data["username"] = doctor.username
@@ -412,11 +2329,21 @@ async def update_doctor(doctor_id: str, doctor: DoctorUpdate, payload: dict = De
     if doctor.is_active is not None:
         update_data["is_active"] = doctor.is_active
     
+    projection = {"_id": 0, "password_hash": 0}
     if update_data:
         update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
-        await db.doctors.update_one({"id": doctor_id}, {"$set": update_data})
+        # Update and read back in a single round trip
+        updated = await db.doctors.find_one_and_update(
+            {"id": doctor_id},
+            {"$set": update_data},
+            projection=projection,
+            return_document=ReturnDocument.AFTER,
+        )
+    else:
+        updated = await db.doctors.find_one({"id": doctor_id}, projection)
     
-    updated = await db.doctors.find_one({"id": doctor_id}, {"_id": 0, "password_hash": 0})
+    if not updated:
+        raise HTTPException(status_code=404, detail="Doctor not found")
     return updated
 
 @api_router.delete("/admin/doctors/{doctor_id}")
@@ -427,6 +2354,307 @@ async def delete_doctor(doctor_id: str, payload: dict = Depends(require_admin)):
         raise HTTPException(status_code=404, detail="Doctor not found")
     return {"message": "Doctor deleted successfully"}
 
+# Prescribing analytics (Admin only)
+# source=rollup reads the daily counters (cost grows with days); source=live scans prescriptions
+ANALYTICS_SOURCES = ("rollup", "live")
+
+async def _check_source(source: str, date_from: Optional[date], date_to: Optional[date], archive_from_rollups: bool = False):
+    if source not in ANALYTICS_SOURCES:
+        raise HTTPException(status_code=400, detail="source must be 'rollup' or 'live'")
+    # Live scans only see the hot collection, so a range holding archived prescriptions is refused
+    # unless the endpoint reads those days from the rollups
+    if source == "live" and not archive_from_rollups and \
+            await db.prescriptions_archive.count_documents(created_at_filter(date_from, date_to), limit=1):
+        raise HTTPException(status_code=400, detail="This range includes archived prescriptions; use source=rollup")
+
+async def archived_days(date_from: Optional[date], date_to: Optional[date]) -> list:
+    """Days (YYYY-MM-DD) in a range with at least one archived prescription"""
+    rows = await db.prescriptions_archive.aggregate(analytics_match(date_from, date_to) + [
+        {"$group": {"_id": date_prefix("$created_at", "day")}},
+    ]).to_list(None)
+    return sorted(row["_id"] for row in rows)
+
+@api_router.get("/admin/analytics/drug-frequency")
+async def analytics_drug_frequency(
+    group_by: Optional[str] = None,
+    period: Optional[str] = None,
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    limit: int = Query(100, ge=1, le=5000),
+    source: str = "rollup",
+    payload: dict = Depends(require_admin)
+):
+    """How often each drug is prescribed, optionally per doctor/location and per day/month/year"""
+    await _check_source(source, date_from, date_to, archive_from_rollups=True)
+    rollup_key = analytics_group_key(group_by, period, "$day", drug_name="$key")
+    if source == "rollup":
+        collection = db.rollups_daily
+        pipeline = [
+            rollup_match(["drug"], date_from, date_to),
+            {"$group": {"_id": rollup_key, "count": {"$sum": "$count"}}},
+        ]
+    else:
+        # Codes are named in the pipeline, so formulary and legacy entries of a drug share a group.
+        # Days holding archived prescriptions are counted from their rollups instead of scanned
+        collection = db.prescriptions
+        days = await archived_days(date_from, date_to)
+        pipeline = analytics_match(date_from, date_to)
+        if days:
+            pipeline.append({"$match": {"$expr": {"$not": [{"$in": [date_prefix("$created_at", "day"), days]}]}}})
+        pipeline += [
+            {"$unwind": "$drugs"},
+            {"$group": {"_id": analytics_group_key(group_by, period, drug_name=DRUG_NAME_EXPR), "count": {"$sum": 1}}},
+        ]
+        if days:
+            archived = rollup_match(["drug"], date_from, date_to)
+            archived["$match"]["day"] = {"$in": days}
+            pipeline += [
+                {"$unionWith": {"coll": "rollups_daily", "pipeline": [
+                    archived,
+                    {"$group": {"_id": rollup_key, "count": {"$sum": "$count"}}},
+                ]}},
+                {"$group": {"_id": "$_id", "count": {"$sum": "$count"}}},
+            ]
+    pipeline += [{"$match": {"count": {"$gt": 0}}}, {"$sort": {"count": -1}}, {"$limit": limit}]
+    return {"results": flatten_groups(await cached_aggregate(collection, pipeline))}
+
+@api_router.get("/admin/analytics/prescriptions")
+async def analytics_prescription_counts(
+    group_by: Optional[str] = "doctor",
+    period: Optional[str] = "day",
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    source: str = "rollup",
+    payload: dict = Depends(require_admin)
+):
+    """Number of prescriptions per doctor (or location) per day (or month/year)"""
+    await _check_source(source, date_from, date_to)
+    if source == "rollup":
+        collection = db.rollups_daily
+        pipeline = [
+            rollup_match(["prescriptions"], date_from, date_to),
+            {"$group": {"_id": analytics_group_key(group_by, period, "$day"), "count": {"$sum": "$count"}}},
+        ]
+    else:
+        collection = db.prescriptions
+        pipeline = analytics_match(date_from, date_to) + [
+            {"$group": {"_id": analytics_group_key(group_by, period), "count": {"$sum": 1}}},
+        ]
+    pipeline += [{"$match": {"count": {"$gt": 0}}}, {"$sort": {"_id.period": 1}}]
+    return {"results": flatten_groups(await cached_aggregate(collection, pipeline))}
+
+@api_router.get("/admin/analytics/icd-codes")
+async def analytics_icd_codes(
+    group_by: Optional[str] = None,
+    period: Optional[str] = None,
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    limit: int = Query(100, ge=1, le=5000),
+    source: str = "rollup",
+    payload: dict = Depends(require_admin)
+):
+    """Distribution of ICD codes"""
+    await _check_source(source, date_from, date_to)
+    if source == "rollup":
+        collection = db.rollups_daily
+        pipeline = [
+            rollup_match(["icd"], date_from, date_to),
+            {"$group": {"_id": analytics_group_key(group_by, period, "$day", icd_code="$key"), "count": {"$sum": "$count"}}},
+        ]
+    else:
+        collection = db.prescriptions
+        pipeline = analytics_match(date_from, date_to) + [
+            {"$match": {"icd_code": {"$nin": ["", None]}}},
+            {"$group": {"_id": analytics_group_key(group_by, period, icd_code="$icd_code"), "count": {"$sum": 1}}},
+        ]
+    pipeline += [{"$match": {"count": {"$gt": 0}}}, {"$sort": {"count": -1}}, {"$limit": limit}]
+    return {"results": flatten_groups(await cached_aggregate(collection, pipeline))}
+
+@api_router.get("/admin/analytics/drugs-per-prescription")
+async def analytics_drugs_per_prescription(
+    group_by: Optional[str] = None,
+    period: Optional[str] = None,
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    source: str = "rollup",
+    payload: dict = Depends(require_admin)
+):
+    """Average number of drugs per prescription"""
+    await _check_source(source, date_from, date_to)
+    if source == "rollup":
+        collection = db.rollups_daily
+        pipeline = [
+            rollup_match(["prescriptions", "drug_lines"], date_from, date_to),
+            {"$group": {
+                "_id": analytics_group_key(group_by, period, "$day"),
+                "prescriptions": {"$sum": {"$cond": [{"$eq": ["$metric", "prescriptions"]}, "$count", 0]}},
+                "drug_lines": {"$sum": {"$cond": [{"$eq": ["$metric", "drug_lines"]}, "$count", 0]}},
+            }},
+            {"$match": {"prescriptions": {"$gt": 0}}},
+            {"$addFields": {"average": {"$divide": ["$drug_lines", "$prescriptions"]}}},
+        ]
+    else:
+        collection = db.prescriptions
+        drug_count = {"$size": {"$ifNull": ["$drugs", []]}}
+        pipeline = analytics_match(date_from, date_to) + [
+            {"$group": {
+                "_id": analytics_group_key(group_by, period),
+                "prescriptions": {"$sum": 1},
+                "drug_lines": {"$sum": drug_count},
+                "average": {"$avg": drug_count},
+            }},
+        ]
+    pipeline += [{"$sort": {"_id": 1}}]
+    return {"results": flatten_groups(await cached_aggregate(collection, pipeline))}
+
+@api_router.post("/admin/rollups/rebuild")
+async def rebuild_rollups_endpoint(
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    payload: dict = Depends(require_admin)
+):
+    """Recompute daily rollups from prescriptions (backfill or repair)"""
+    written = await rebuild_rollups(date_from, date_to)
+    _analytics_cache.clear()
+    return {"message": "Rollups rebuilt", "counters": written}
+
+@api_router.get("/admin/rollups/reconcile")
+async def reconcile_rollups(
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    payload: dict = Depends(require_admin)
+):
+    """Compare stored rollups with counters recomputed from prescriptions"""
+    expected, stored_docs = await asyncio.gather(
+        compute_rollups(date_from, date_to),
+        db.rollups_daily.find(_rollup_day_filter(date_from, date_to), {"_id": 0}).to_list(None),
+    )
+    stored = Counter({
+        (d["day"], d["doctor_id"], d["location"], d["metric"], d["key"]): d["count"] for d in stored_docs
+    })
+    mismatches = []
+    for dims in set(expected) | set(stored):
+        if expected[dims] != stored[dims]:
+            mismatches.append({**_rollup_filter(*dims), "expected": expected[dims], "stored": stored[dims]})
+    mismatches.sort(key=lambda m: (m["day"], m["metric"], m["key"]))
+    return {"consistent": not mismatches, "mismatch_count": len(mismatches), "mismatches": mismatches[:500]}
+
+@api_router.post("/admin/migrations/timestamps")
+async def start_timestamp_migration_endpoint(
+    batch_size: int = Query(500, ge=1, le=5000),
+    pause: float = Query(0.05, ge=0, le=10),
+    payload: dict = Depends(require_admin)
+):
+    """Start (or resume) converting string timestamps to dates; pause is seconds between batches"""
+    if not timestamp_migration_running():
+        await db.migrations.update_one(
+            {"_id": TIMESTAMP_MIGRATION_ID},
+            {"$set": {"status": "running", "batch_size": batch_size, "pause": pause,
+                      "started_at": datetime.now(timezone.utc)},
+             "$setOnInsert": {"converted": 0}},
+            upsert=True,
+        )
+        start_timestamp_migration(batch_size, pause)
+    return await timestamp_migration_status(payload)
+
+@api_router.get("/admin/migrations/timestamps")
+async def timestamp_migration_status(payload: dict = Depends(require_admin)):
+    """Progress of the timestamp migration and the documents still holding strings"""
+    state = await db.migrations.find_one({"_id": TIMESTAMP_MIGRATION_ID}, {"_id": 0}) or {"status": "not_started"}
+    remaining = await db.prescriptions.count_documents(LEGACY_TIMESTAMP)
+    remaining_other = {name: await db[name].count_documents(LEGACY_TIMESTAMP) for name in TIMESTAMP_COLLECTIONS}
+    return {**state, "remaining": remaining, "remaining_other": remaining_other, "running": timestamp_migration_running()}
+
+@api_router.post("/admin/migrations/drugs")
+async def start_drug_migration_endpoint(
+    batch_size: int = Query(500, ge=1, le=5000),
+    pause: float = Query(0.05, ge=0, le=10),
+    payload: dict = Depends(require_admin)
+):
+    """Start (or resume) rewriting drug entries in compact form; pause is seconds between batches"""
+    if not drug_migration_running():
+        await db.migrations.update_one(
+            {"_id": DRUG_MIGRATION_ID},
+            {"$set": {"status": "running", "batch_size": batch_size, "pause": pause,
+                      "started_at": datetime.now(timezone.utc)},
+             "$setOnInsert": {"converted": 0}},
+            upsert=True,
+        )
+        start_drug_migration(batch_size, pause)
+    return await drug_migration_status(payload)
+
+@api_router.get("/admin/migrations/drugs")
+async def drug_migration_status(payload: dict = Depends(require_admin)):
+    """Progress of the drug entry migration and the documents still holding full entries"""
+    state = await db.migrations.find_one({"_id": DRUG_MIGRATION_ID}, {"_id": 0}) or {"status": "not_started"}
+    remaining = await db.prescriptions.count_documents(LEGACY_DRUGS)
+    return {**state, "remaining": remaining, "running": drug_migration_running()}
+
+@api_router.post("/admin/migrations/schema")
+async def start_schema_writeback_endpoint(
+    batch_size: int = Query(500, ge=1, le=5000),
+    pause: float = Query(0.05, ge=0, le=10),
+    payload: dict = Depends(require_admin)
+):
+    """Start (or resume) storing schema upgrades on older prescriptions; pause is seconds between batches"""
+    if not schema_writeback_running():
+        await db.migrations.update_one(
+            {"_id": SCHEMA_MIGRATION_ID},
+            {"$set": {"status": "running", "batch_size": batch_size, "pause": pause,
+                      "started_at": datetime.now(timezone.utc)},
+             "$setOnInsert": {"converted": 0}},
+            upsert=True,
+        )
+        start_schema_writeback(batch_size, pause)
+    return await schema_writeback_status(payload)
+
+@api_router.get("/admin/migrations/schema")
+async def schema_writeback_status(payload: dict = Depends(require_admin)):
+    """Progress of the schema write-back and the prescriptions stored below the current schema version"""
+    state = await db.migrations.find_one({"_id": SCHEMA_MIGRATION_ID}, {"_id": 0}) or {"status": "not_started"}
+    remaining = await db.prescriptions.count_documents(STALE_SCHEMA)
+    return {**state, "current_version": PRESCRIPTION_SCHEMA_VERSION, "remaining": remaining,
+            "running": schema_writeback_running()}
+
+@api_router.post("/admin/archive")
+async def start_archiver_endpoint(
+    older_than_days: int = Query(ARCHIVE_AFTER_DAYS, ge=1),
+    batch_size: int = Query(500, ge=1, le=5000),
+    pause: float = Query(0.05, ge=0, le=10),
+    payload: dict = Depends(require_admin)
+):
+    """Start (or resume) archiving prescriptions older than older_than_days; pause is seconds between batches"""
+    if not archiver_running():
+        await db.migrations.update_one(
+            {"_id": ARCHIVE_JOB_ID},
+            {"$set": {"status": "running", "older_than_days": older_than_days, "batch_size": batch_size,
+                      "pause": pause, "started_at": datetime.now(timezone.utc)},
+             "$setOnInsert": {"archived": 0}},
+            upsert=True,
+        )
+        start_archiver(older_than_days, batch_size, pause)
+    return await archiver_status(payload)
+
+@api_router.get("/admin/archive")
+async def archiver_status(payload: dict = Depends(require_admin)):
+    """Progress of the archiver, the prescriptions still due for archiving and the archive size"""
+    state = await db.migrations.find_one({"_id": ARCHIVE_JOB_ID}, {"_id": 0}) or {"status": "not_started"}
+    remaining, archived_total = await asyncio.gather(
+        db.prescriptions.count_documents(archive_cutoff(state.get("older_than_days", ARCHIVE_AFTER_DAYS))),
+        db.prescriptions_archive.count_documents({}),
+    )
+    return {**state, "remaining": remaining, "archived_total": archived_total, "running": archiver_running()}
+
+@api_router.get("/admin/metrics/single-flight")
+async def single_flight_metrics(payload: dict = Depends(require_admin)):
+    """Requests coalesced onto an in-flight render or export, per endpoint (admin only)"""
+    return {"endpoints": single_flight.metrics()}
+
+@api_router.get("/admin/metrics/events")
+async def event_metrics(payload: dict = Depends(require_admin)):
+    """Change notification fan-out counters and current subscribers"""
+    return change_events.metrics()
+
 # Public doctors endpoint (for dropdown, returns active doctors only)
 @api_router.get("/doctors")
 async def get_doctors(payload: dict = Depends(verify_token)):
@@ -459,12 +2687,36 @@ async def get_drugs(search: Optional[str] = None, payload: dict = Depends(verify
         return {"drugs": filtered[:20]}
     return {"drugs": DRUG_LIST[:50]}
 
+@api_router.get("/icd")
+async def search_icd(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=100),
+                     payload: dict = Depends(verify_token)):
+    """ICD-10 autocomplete: code prefix (M05, m05.9) or description words (rheum arth)"""
+    return {"results": require_icd_catalog().search(q, limit)}
+
+@api_router.get("/icd/{code}")
+async def get_icd_code(code: str, payload: dict = Depends(verify_token)):
+    catalog = require_icd_catalog()
+    i = catalog.find(code)
+    if i is None:
+        raise HTTPException(status_code=404, detail="ICD-10 code not found")
+    return {"code": catalog.codes[i], "description": catalog.descriptions[i]}
+
+@api_router.post("/drugs/check")
+async def check_drugs(request: DrugCheckRequest, payload: dict = Depends(verify_token)):
+    """Interaction and duplicate-therapy alerts for a list of drug names, most severe first"""
+    checker = drug_checker()
+    if checker is None:
+        raise HTTPException(status_code=503, detail="Drug interaction table is unavailable")
+    return checker.check(request.drugs)
+
 @api_router.get("/doctor-info")
 async def get_doctor_info():
     return DOCTOR_INFO
 
 @api_router.post("/prescriptions", response_model=Prescription)
-async def create_prescription(prescription: PrescriptionCreate, payload: dict = Depends(verify_token)):
+async def create_prescription(prescription: PrescriptionCreate, response: Response, payload: dict = Depends(verify_token)):
+    check_icd_codes(prescription.icd_code, response)
+    drug_alerts = check_drug_alerts(prescription.drugs)
     # Get doctor's location if not provided
     location = prescription.location
     if payload.get("role") == "doctor":
@@ -487,179 +2739,245 @@ async def create_prescription(prescription: PrescriptionCreate, payload: dict =
         advice=prescription.advice,
         lab_tests=prescription.lab_tests,
         doctor_id=prescription.doctor_id,
-        location=location
+        location=location,
+        version=1,
+        drug_alerts=drug_alerts
     )
+    prescription_obj.vitals_numeric = parse_vitals(prescription_obj.model_dump(include={"weight", "height", "bp", "spo2"}))
     
-    doc = prescription_obj.model_dump()
-    await db.prescriptions.insert_one(doc)
+    async with change_seq() as seq:
+        prescription_obj.change_seq = seq
+        doc = prescription_obj.model_dump()
+        await db.prescriptions.insert_one(compact_prescription(doc))
+    await db.prescription_revisions.insert_one(
+        make_revision(prescription_obj.id, 1, payload.get("user"), None, doc)
+    )
+    await after_prescription_write(None, doc)
     return prescription_obj
 
+# Newest prescriptions returned by the history list
+HISTORY_PAGE_SIZE = 500
+
 @api_router.get("/prescriptions", response_model=List[Prescription])
-async def get_prescriptions(payload: dict = Depends(verify_token)):
+async def get_prescriptions(response: Response, payload: dict = Depends(verify_token)):
     # Admin sees all, doctors see only their own
     query = {}
     if payload.get("role") == "doctor":
         query["doctor_id"] = payload.get("doctor_id")
     
-    prescriptions = await db.prescriptions.find(query, {"_id": 0}).sort("created_at", -1).to_list(500)
-    return prescriptions
+    # The sync token to continue from is read before the list, so every change up to it is already
+    # in the list; later ones come through /sync, and a change the list also shows is applied twice harmlessly
+    response.headers["X-Sync-Since"] = str(await sync_horizon())
+    prescriptions = await db.prescriptions.find(query, {"_id": 0}).sort("created_at", -1).to_list(HISTORY_PAGE_SIZE)
+    return [expand_prescription(p) for p in prescriptions]
+
+async def build_excel_export(query: dict, partition: Optional[str]) -> bytes:
+    sheets, stats = await excel_sheets(query, partition)
+    if not partition:
+        return await asyncio.to_thread(build_excel_workbook, list(sheets.items()))
+    parts = None
+    if len(sheets) > 1 and sum(count for count, *_ in stats.values()) >= EXPORT_PARALLEL_MIN_PRESCRIPTIONS:
+        loop = asyncio.get_running_loop()
+        parts = await asyncio.gather(*[
+            loop.run_in_executor(export_pool(), excel_sheet_part, rows) for rows in sheets.values()
+        ])
+    return await asyncio.to_thread(build_partitioned_workbook, sheets, stats, parts)
 
 @api_router.get("/prescriptions/export/excel")
-async def export_prescriptions_excel(payload: dict = Depends(verify_token)):
-    from openpyxl import Workbook
-    from openpyxl.styles import Font, Alignment, Border, Side
+async def export_prescriptions_excel(
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    doctor_id: Optional[str] = None,
+    location: Optional[str] = None,
+    op_no: Optional[str] = None,
+    partition: Optional[str] = None,
+    payload: dict = Depends(verify_token)
+):
+    if partition and partition not in EXPORT_PARTITIONS:
+        raise HTTPException(status_code=400, detail="partition must be 'doctor', 'location' or 'month'")
     
-    # Admin sees all, doctors see only their own
-    query = {}
-    if payload.get("role") == "doctor":
-        query["doctor_id"] = payload.get("doctor_id")
+    # Filters are pushed down into the Mongo query; doctors see only their own
+    query = export_query(payload, date_from, date_to, doctor_id, location, op_no)
+    filename = f"prescriptions_{datetime.now().strftime('%Y%m%d')}.xlsx"
+    excel_headers = {"Content-Disposition": f"attachment; filename={filename}"}
+    excel_media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     
-    prescriptions = await db.prescriptions.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
+    # Serve a repeated export of the same period from cache unless prescriptions in that range or doctor names changed
+    cache_key = json.dumps({"query": query, "partition": partition}, sort_keys=True)
+    changes, names = await asyncio.gather(change_days_epoch(date_from, date_to), doctor_names())
+    epoch = (*changes, doctor_names_digest(names))
+    cached = export_cache_get(cache_key, epoch)
+    if cached is not None:
+        return Response(content=cached, media_type=excel_media_type, headers=excel_headers)
     
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Prescriptions"
+    # Concurrent identical exports of the same data share one query and workbook build
+    content = await single_flight.do(("excel", cache_key, epoch), lambda: build_excel_export(query, partition))
+    export_cache_put(cache_key, epoch, content)
     
-    # Headers - added Location column
-    headers = ["OP No", "Patient Name", "Sex", "Age", "ICD Code", "Weight", "Height", "BP", "SpO2", "Date", "Drug Name", "Dosage", "Frequency", "Duration", "Comments", "Advice", "Lab Tests", "Doctor", "Location"]
-    header_font = Font(bold=True)
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col, value=header)
-        cell.font = header_font
-        cell.border = thin_border
-    
-    # Data rows
-    row_num = 2
-    for prescription in prescriptions:
-        drugs = prescription.get('drugs', [])
-        op_no = prescription.get('op_no', '')
-        patient_name = prescription.get('patient_name', '')
-        sex = prescription.get('sex', '')
-        age = prescription.get('age', '')
-        icd_code = prescription.get('icd_code', '')
-        weight = prescription.get('weight', '')
-        height = prescription.get('height', '')
-        bp = prescription.get('bp', '')
-        spo2 = prescription.get('spo2', '')
-        created_at = prescription.get('created_at', '')[:10] if prescription.get('created_at') else ''
-        advice = prescription.get('advice', '')
-        lab_tests = prescription.get('lab_tests', '')
-        doctor_id = prescription.get('doctor_id', 'dr_prakashini')
-        doctor_name = DOCTORS.get(doctor_id, {}).get('name', 'Dr. Prakashini M V')
-        location = prescription.get('location', 'Bangalore')
-        
-        if drugs:
-            for i, drug in enumerate(drugs):
-                ws.cell(row=row_num, column=1, value=op_no if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=2, value=patient_name if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=3, value=sex if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=4, value=age if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=5, value=icd_code if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=6, value=weight if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=7, value=height if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=8, value=bp if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=9, value=spo2 if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=10, value=created_at if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=11, value=drug.get('drug_name', '')).border = thin_border
-                ws.cell(row=row_num, column=12, value=drug.get('dosage', '')).border = thin_border
-                ws.cell(row=row_num, column=13, value=drug.get('frequency', '')).border = thin_border
-                ws.cell(row=row_num, column=14, value=f"{drug.get('duration', '')} {drug.get('duration_unit', '')}").border = thin_border
-                ws.cell(row=row_num, column=15, value=drug.get('comments', '')).border = thin_border
-                ws.cell(row=row_num, column=16, value=advice if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=17, value=lab_tests if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=18, value=doctor_name if i == 0 else '').border = thin_border
-                ws.cell(row=row_num, column=19, value=location if i == 0 else '').border = thin_border
-                row_num += 1
-        else:
-            ws.cell(row=row_num, column=1, value=op_no).border = thin_border
-            ws.cell(row=row_num, column=2, value=patient_name).border = thin_border
-            ws.cell(row=row_num, column=3, value=sex).border = thin_border
-            ws.cell(row=row_num, column=4, value=age).border = thin_border
-            ws.cell(row=row_num, column=5, value=icd_code).border = thin_border
-            ws.cell(row=row_num, column=6, value=weight).border = thin_border
-            ws.cell(row=row_num, column=7, value=height).border = thin_border
-            ws.cell(row=row_num, column=8, value=bp).border = thin_border
-            ws.cell(row=row_num, column=9, value=spo2).border = thin_border
-            ws.cell(row=row_num, column=10, value=created_at).border = thin_border
-            ws.cell(row=row_num, column=11, value='').border = thin_border
-            ws.cell(row=row_num, column=12, value='').border = thin_border
-            ws.cell(row=row_num, column=13, value='').border = thin_border
-            ws.cell(row=row_num, column=14, value='').border = thin_border
-            ws.cell(row=row_num, column=15, value='').border = thin_border
-            ws.cell(row=row_num, column=16, value=advice).border = thin_border
-            ws.cell(row=row_num, column=17, value=lab_tests).border = thin_border
-            ws.cell(row=row_num, column=18, value=doctor_name).border = thin_border
-            ws.cell(row=row_num, column=19, value=location).border = thin_border
-            row_num += 1
-    
-    # Adjust column widths
-    ws.column_dimensions['A'].width = 12
-    ws.column_dimensions['B'].width = 20
-    ws.column_dimensions['C'].width = 10
-    ws.column_dimensions['D'].width = 8
-    ws.column_dimensions['E'].width = 12
-    ws.column_dimensions['F'].width = 15
-    ws.column_dimensions['G'].width = 12
-    ws.column_dimensions['S'].width = 15  # Location column
-    ws.column_dimensions['H'].width = 20
-    ws.column_dimensions['I'].width = 12
-    ws.column_dimensions['J'].width = 15
-    ws.column_dimensions['K'].width = 12
-    ws.column_dimensions['L'].width = 20
-    ws.column_dimensions['M'].width = 25
-    ws.column_dimensions['N'].width = 25
-    ws.column_dimensions['O'].width = 20
-    ws.column_dimensions['L'].width = 20
-    
-    buffer = BytesIO()
-    wb.save(buffer)
-    buffer.seek(0)
+    return Response(content=content, media_type=excel_media_type, headers=excel_headers)
+
+@api_router.get("/prescriptions/export/{export_format}")
+async def export_prescriptions(
+    export_format: str,
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    doctor_id: Optional[str] = None,
+    location: Optional[str] = None,
+    op_no: Optional[str] = None,
+    payload: dict = Depends(verify_token)
+):
+    """Stream prescriptions as CSV, NDJSON or Parquet (one row per drug)"""
+    if export_format not in EXPORT_WRITERS:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format. Use one of: excel, {', '.join(EXPORT_WRITERS)}")
+    if export_format == "parquet":
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=400, detail="Parquet export requires pyarrow to be installed on the server")
     
-    return Response(
-        content=buffer.getvalue(),
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    media_type, extension, writer = EXPORT_WRITERS[export_format]
+    query = export_query(payload, date_from, date_to, doctor_id, location, op_no)
+    return StreamingResponse(
+        writer(iter_export_rows(query)),
+        media_type=media_type,
         headers={
-            "Content-Disposition": f"attachment; filename=prescriptions_{datetime.now().strftime('%Y%m%d')}.xlsx"
+            "Content-Disposition": f"attachment; filename=prescriptions_{datetime.now().strftime('%Y%m%d')}.{extension}"
         }
     )
 
+@api_router.get("/prescriptions/search")
+async def search_prescriptions(
+    q: str = Query(..., min_length=1),
+    doctor_id: Optional[str] = None,
+    location: Optional[str] = None,
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
+    payload: dict = Depends(verify_token)
+):
+    """Full-text search over diagnosis, ICD code, drugs, clinical history, advice and lab tests.
+
+    Terms match any field by default; quote a phrase ("lupus nephritis") to require it.
+    Archived prescriptions are stored compressed and are not searched; archived_excluded
+    says whether any fall within the other filters.
+    """
+    query = {"$text": {"$search": q}}
+    codes = formulary_codes_named(q)
+    if codes:
+        # Compact entries store a named brand's code instead of its name
+        query = {"$or": [query, {"drugs.d": {"$in": codes}}]}
+    scope = created_at_filter(date_from, date_to)
+    # Admin sees all, doctors see only their own
+    if payload.get("role") == "doctor":
+        scope["doctor_id"] = payload.get("doctor_id")
+    elif doctor_id:
+        scope["doctor_id"] = doctor_id
+    if location:
+        scope["location"] = location
+    if scope:
+        # Either side may be an $or of its own
+        query = {"$and": [query, scope]}
+    
+    score = {"$meta": "textScore"}
+    cursor = db.prescriptions.find(query, {"_id": 0, "score": score}).sort(
+        [("score", score), ("created_at", -1)]
+    ).skip((page - 1) * page_size).limit(page_size)
+    results, total, archived = await asyncio.gather(
+        cursor.to_list(page_size),
+        db.prescriptions.count_documents(query),
+        db.prescriptions_archive.find_one(scope, {"_id": 1}),
+    )
+    return {"results": [expand_prescription(p) for p in results], "total": total, "page": page, "page_size": page_size,
+            "archived_excluded": archived is not None}
+
 @api_router.get("/prescriptions/{prescription_id}", response_model=Prescription)
 async def get_prescription(prescription_id: str, payload: dict = Depends(verify_token)):
-    prescription = await db.prescriptions.find_one({"id": prescription_id}, {"_id": 0})
+    prescription = await load_prescription(prescription_id)
     if not prescription:
         raise HTTPException(status_code=404, detail="Prescription not found")
     return prescription
 
 @api_router.get("/prescriptions/by-op/{op_no}")
 async def get_prescriptions_by_op(op_no: str, payload: dict = Depends(verify_token)):
-    """Get all prescriptions for a given OP number"""
-    prescriptions = await db.prescriptions.find({"op_no": op_no}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    return {"prescriptions": prescriptions}
+    """Get all prescriptions for a given OP number, archived ones included"""
+    return {"prescriptions": await prescriptions_for_op(op_no, 100)}
+
+@api_router.get("/patients/{op_no}")
+async def get_patient_summary(op_no: str, payload: dict = Depends(verify_token)):
+    """Patient summary for an OP number: latest vitals and drugs, visit count and recent visits"""
+    summary = await db.patients.find_one({"op_no": op_no}, {"_id": 0})
+    if not summary:
+        # Patients seen before summaries existed are backfilled on first lookup
+        summary = await rebuild_patient_summary(op_no)
+    if not summary:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    return summary
+
+@api_router.get("/patients/{op_no}/vitals")
+async def get_patient_vitals(
+    op_no: str,
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    interval: Optional[str] = None,
+    payload: dict = Depends(verify_token)
+):
+    """Vitals trend for an OP number: one point per visit, or averages per day/week/month/quarter/year"""
+    match = {"meta.op_no": op_no}
+    if date_from or date_to:
+        match["ts"] = {}
+        if date_from:
+            match["ts"]["$gte"] = _day_start(date_from)
+        if date_to:
+            match["ts"]["$lt"] = _day_start(date_to + timedelta(days=1))
+    if interval is None:
+        points = await db.vitals_ts.aggregate([
+            {"$match": match},
+            {"$sort": {"ts": 1}},
+            {"$project": {"_id": 0, "ts": 1, "prescription_id": "$meta.prescription_id", **dict.fromkeys(VITAL_FIELDS, 1)}},
+        ]).to_list(None)
+        return {"op_no": op_no, "interval": None, "points": points}
+    if interval not in VITALS_INTERVALS:
+        raise HTTPException(status_code=400, detail=f"interval must be one of: {', '.join(VITALS_INTERVALS)}")
+    points = await db.vitals_ts.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"$dateTrunc": {"date": "$ts", "unit": interval}},
+            "visits": {"$sum": 1},
+            **{field: {"$avg": f"${field}"} for field in VITAL_FIELDS},
+        }},
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "ts": "$_id", "visits": 1, **{field: {"$round": [f"${field}", 1]} for field in VITAL_FIELDS}}},
+    ]).to_list(None)
+    return {"op_no": op_no, "interval": interval, "points": points}
 
 @api_router.delete("/prescriptions/{prescription_id}")
 async def delete_prescription(prescription_id: str, payload: dict = Depends(verify_token)):
     """Delete a prescription by ID"""
-    result = await db.prescriptions.delete_one({"id": prescription_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Prescription not found")
+    async with change_seq() as seq:
+        # Both tiers: a prescription caught mid-archive can be in both
+        deleted, archived = await asyncio.gather(
+            db.prescriptions.find_one_and_delete({"id": prescription_id}, projection={"_id": 0}),
+            db.prescriptions_archive.find_one_and_delete({"id": prescription_id}),
+        )
+        deleted = expand_prescription(deleted or unpack_archived(archived))
+        if not deleted:
+            raise HTTPException(status_code=404, detail="Prescription not found")
+        await db.prescription_tombstones.insert_one({
+            "id": prescription_id,
+            "change_seq": seq,
+            "doctor_id": deleted.get("doctor_id"),
+            "deleted_at": datetime.now(timezone.utc),
+        })
+    # The delete is the prescription's last change
+    await after_prescription_write({**deleted, "change_seq": seq}, None)
     return {"message": "Prescription deleted successfully"}
 
 @api_router.put("/prescriptions/{prescription_id}", response_model=Prescription)
-async def update_prescription(prescription_id: str, prescription: PrescriptionCreate, payload: dict = Depends(verify_token)):
-    """Update an existing prescription"""
-    # Check if prescription exists
-    existing = await db.prescriptions.find_one({"id": prescription_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Prescription not found")
-    
-    # Update the prescription
+async def update_prescription(prescription_id: str, prescription: PrescriptionCreate, response: Response,
+                              payload: dict = Depends(verify_token)):
+    """Update an existing prescription in a single round trip (409 if the client's version is stale)"""
+    check_icd_codes(prescription.icd_code, response)
     update_data = {
         "op_no": prescription.op_no,
         "patient_name": prescription.patient_name,
@@ -677,111 +2995,390 @@ async def update_prescription(prescription_id: str, prescription: PrescriptionCr
         "advice": prescription.advice,
         "lab_tests": prescription.lab_tests,
         "doctor_id": prescription.doctor_id,
-        "updated_at": datetime.now(timezone.utc).isoformat()
+        "updated_at": datetime.now(timezone.utc)
     }
+    update_data["vitals_numeric"] = parse_vitals(update_data)
+    update_data["drug_alerts"] = check_drug_alerts(prescription.drugs)
     
-    await db.prescriptions.update_one({"id": prescription_id}, {"$set": update_data})
+    query = {"id": prescription_id}
+    if prescription.version is not None:
+        # Documents written before versioning have no version field and count as version 0
+        query["version"] = {"$in": [0, None]} if prescription.version == 0 else prescription.version
     
-    # Return updated prescription
-    updated = await db.prescriptions.find_one({"id": prescription_id}, {"_id": 0})
-    return updated
-
-@api_router.get("/prescriptions/{prescription_id}/pdf")
-async def generate_pdf(prescription_id: str, debug: bool = False, payload: dict = Depends(verify_token)):
-    prescription = await db.prescriptions.find_one({"id": prescription_id}, {"_id": 0})
-    if not prescription:
-        raise HTTPException(status_code=404, detail="Prescription not found")
+    async with change_seq() as seq:
+        # Return the previous version so the revision diff needs no extra read
+        update = {"$set": {**compact_prescription(update_data), "change_seq": seq}, "$inc": {"version": 1}}
+        before = await db.prescriptions.find_one_and_update(
+            query, update, projection={"_id": 0}, return_document=ReturnDocument.BEFORE
+        )
+        if not before and await restore_archived(prescription_id):
+            # Editing an archived prescription brings it back to the hot collection
+            before = await db.prescriptions.find_one_and_update(
+                query, update, projection={"_id": 0}, return_document=ReturnDocument.BEFORE
+            )
+        if not before:
+            # Only the failure path pays for a second round trip to tell 404 from 409
+            if prescription.version is not None and await db.prescriptions.count_documents({"id": prescription_id}, limit=1):
+                raise HTTPException(status_code=409, detail="Prescription was modified by someone else. Reload it and try again.")
+            raise HTTPException(status_code=404, detail="Prescription not found")
+        if before.get("doctor_id") != update_data["doctor_id"]:
+            # Moved to another doctor: the previous doctor's clients drop their copy
+            await db.prescription_tombstones.insert_one({
+                "id": prescription_id,
+                "change_seq": seq,
+                "doctor_id": before.get("doctor_id"),
+                "deleted_at": update_data["updated_at"],
+                "reassigned": True,
+            })
     
-    # Get doctor info (stored for history, but not printed on PDF since using pre-printed pads)
-    doctor_id = prescription.get('doctor_id', 'dr_prakashini')
-    doctor_info = DOCTORS.get(doctor_id, DOCTORS['dr_prakashini'])
+    previous_version = before.get("version", 0)
+    if before.get("schema_version", 0) < PRESCRIPTION_SCHEMA_VERSION:
+        # The edit leaves older-schema fields behind (a legacy gender, missing defaults); store the upgrade too
+        stored = {**before, **compact_prescription(update_data), "version": previous_version + 1, "change_seq": seq}
+        await db.prescriptions.bulk_write([schema_writeback_op(stored)])
+    expand_prescription(before)
+    updated = {**before, **update_data, "version": previous_version + 1, "change_seq": seq}
     
-    # Generate PDF - designed for pre-printed prescription pads
-    # Header and footer spaces are reserved but not printed
-    buffer = BytesIO()
+    revisions = []
+    if previous_version == 0:
+        # First edit of a pre-versioning document: keep its original content as revision 0
+        revisions.append(make_revision(prescription_id, 0, None, None, before))
+    revisions.append(make_revision(prescription_id, updated["version"], payload.get("user"), before, updated))
+    await db.prescription_revisions.insert_many(revisions)
+    await after_prescription_write(before, updated)
     
-    styles = getSampleStyleSheet()
+    return updated
+
+@api_router.get("/sync")
+async def sync_prescriptions(
+    since: int = Query(0, ge=0),
+    limit: int = Query(SYNC_PAGE_SIZE, ge=1, le=SYNC_PAGE_SIZE),
+    payload: dict = Depends(verify_token),
+):
+    """Prescriptions written and deleted after the since token, oldest change first"""
+    seq_range = {"$gt": since, "$lte": await sync_horizon()}
+    query = {"change_seq": seq_range}
+    tombstone_query = {"change_seq": seq_range}
+    if payload.get("role") == "doctor":
+        query["doctor_id"] = tombstone_query["doctor_id"] = payload.get("doctor_id")
+    else:
+        tombstone_query["reassigned"] = {"$ne": True}
     
-    # Custom styles
-    label_style = ParagraphStyle(
-        'Label',
-        parent=styles['Normal'],
-        fontSize=10,
-        fontName='Helvetica-Bold',
-        textColor=colors.HexColor('#333333')
+    changed, archived = await asyncio.gather(
+        db.prescriptions.find(query, {"_id": 0}).sort("change_seq", 1).to_list(limit + 1),
+        db.prescriptions_archive.find(query, {"data": 1}).sort("change_seq", 1).to_list(limit + 1),
     )
+    changed = [expand_prescription(p) for p in changed + [unpack_archived(a) for a in archived]]
+    deleted = await db.prescription_tombstones.find(
+        tombstone_query, {"_id": 0, "id": 1, "change_seq": 1}
+    ).sort("change_seq", 1).to_list(limit + 1)
     
-    content_style = ParagraphStyle(
-        'Content',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=colors.HexColor('#333333')
+    # Merge both feeds in sequence order; the page ends at the last change it includes
+    page = sorted(
+        [(p["change_seq"], p, None) for p in changed] + [(t["change_seq"], None, t["id"]) for t in deleted],
+        key=lambda change: change[0],
     )
+    has_more = len(page) > limit
+    page = page[:limit]
+    # The latest change to each prescription in the page decides whether it is current or deleted
+    latest = {}
+    for _, prescription, deleted_id in page:
+        latest[deleted_id or prescription["id"]] = prescription
+    return {
+        "prescriptions": [p for p in latest.values() if p],
+        "deleted": [prescription_id for prescription_id, p in latest.items() if p is None],
+        "since": page[-1][0] if page else since,
+        "has_more": has_more,
+    }
+
+@api_router.get("/events")
+async def prescription_events(request: Request, payload: dict = Depends(verify_stream_token)):
+    """Server-sent change notifications; doctors only hear about their own prescriptions"""
+    doctor_id = payload.get("doctor_id") if payload.get("role") == "doctor" else None
+
+    async def stream():
+        subscription = change_events.subscribe(doctor_id)
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(subscription.queue.get(), EVENT_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle stream and notices disconnected clients
+                    yield ": heartbeat\n\n"
+        finally:
+            change_events.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@api_router.get("/prescriptions/{prescription_id}/revisions")
+async def get_prescription_revisions(prescription_id: str, payload: dict = Depends(verify_token)):
+    """List the revision log of a prescription (newest first, without snapshots)"""
+    revisions = await db.prescription_revisions.find(
+        {"prescription_id": prescription_id},
+        {"_id": 0, "snapshot": 0}
+    ).sort("rev", -1).to_list(1000)
+    if not revisions:
+        raise HTTPException(status_code=404, detail="No revisions found for this prescription")
+    return {"revisions": revisions}
+
+@api_router.get("/prescriptions/{prescription_id}/revisions/{rev}")
+async def get_prescription_revision(prescription_id: str, rev: int, payload: dict = Depends(verify_token)):
+    """Rebuild a prescription as it was at the given revision"""
+    # Walk back to the nearest snapshot; at most REVISION_SNAPSHOT_INTERVAL revisions away
+    chain = await db.prescription_revisions.find(
+        {"prescription_id": prescription_id, "rev": {"$lte": rev}},
+        {"_id": 0}
+    ).sort("rev", -1).to_list(REVISION_SNAPSHOT_INTERVAL + 1)
+    if not chain or chain[0]["rev"] != rev:
+        raise HTTPException(status_code=404, detail="Revision not found")
     
-    rx_style = ParagraphStyle(
-        'Rx',
-        parent=styles['Normal'],
-        fontSize=14,
-        fontName='Helvetica-Bold',
-        textColor=colors.HexColor('#6B9A9A')
-    )
+    base_index = next((i for i, r in enumerate(chain) if "snapshot" in r), None)
+    if base_index is None:
+        raise HTTPException(status_code=500, detail="Revision history is missing a snapshot")
     
-    # Page dimensions and margins for pre-printed prescription pads
-    # Header: 36mm, Footer: 36mm, Padding: 4mm on each side
-    page_width, page_height = A4  # 210mm x 297mm
-    left_margin = 15*mm
-    right_margin = 15*mm
-    header_space = 36*mm  # Reserved for pre-printed header
-    footer_space = 36*mm  # Reserved for pre-printed footer
-    padding = 4*mm        # Padding between header/footer and content
+    doc = chain[base_index]["snapshot"]
+    for revision in reversed(chain[:base_index]):
+        doc = json_patch(doc, revision["patch"])
+    return {**doc, "version": rev, "revision_created_at": chain[0]["created_at"], "revision_user": chain[0].get("user")}
+
+# PDF pad layouts - declarative templates (per doctor, per location or default), compiled once per
+# revision into the ReportLab styles and geometry every render of that pad reuses
+PDF_LAYOUT_SCOPES = ("doctor", "location", "default")
+PDF_LAYOUT_DRUG_COLUMNS = 6  # S.No, Drug Name, Dosage, Frequency, Duration, Comments
+
+class CompiledPdfLayout:
+    """ReportLab styles, table styles and frame geometry for one layout revision"""
+    def __init__(self, spec: dict):
+        if len(spec["drug_columns_mm"]) != PDF_LAYOUT_DRUG_COLUMNS:
+            raise ValueError(f"drug_columns_mm needs {PDF_LAYOUT_DRUG_COLUMNS} widths")
+        self.spec = {field: spec[field] for field in PdfLayoutSpec.model_fields}
+        self.page_width, self.page_height = A4  # 210mm x 297mm
+        self.side_margin = spec["side_margin_mm"]*mm
+        self.header_space = spec["header_mm"]*mm  # Reserved for pre-printed header
+        self.footer_space = spec["footer_mm"]*mm  # Reserved for pre-printed footer
+        self.padding = spec["padding_mm"]*mm      # Padding between header/footer and content
+        self.header_mm, self.footer_mm = spec["header_mm"], spec["footer_mm"]
+        
+        # Total margins = header/footer space + padding; the frame is the content area between them
+        self.top_margin = self.header_space + self.padding
+        self.bottom_margin = self.footer_space + self.padding
+        self.frame_width = self.page_width - 2*self.side_margin
+        self.frame_height = self.page_height - self.top_margin - self.bottom_margin
+        if self.frame_width <= 0 or self.frame_height <= 0:
+            raise ValueError("margins leave no room for content")
+        self.drug_col_widths = [width*mm for width in spec["drug_columns_mm"]]
+        if sum(self.drug_col_widths) > self.frame_width + 0.01:
+            raise ValueError("drug_columns_mm are wider than the content area")
+        self.info_col_widths = [self.frame_width / 2] * 2
+        
+        text_color = colors.HexColor(spec["text_color"])
+        accent_color = colors.HexColor(spec["accent_color"])
+        grid_color = colors.HexColor(spec["grid_color"])
+        font_size, table_font_size = spec["font_size"], spec["table_font_size"]
+        normal = getSampleStyleSheet()['Normal']
+        self.label_style = ParagraphStyle('Label', parent=normal, fontSize=font_size, fontName='Helvetica-Bold', textColor=text_color)
+        self.content_style = ParagraphStyle('Content', parent=normal, fontSize=font_size, textColor=text_color)
+        self.right_style = ParagraphStyle('RightAlign', parent=self.content_style, alignment=TA_RIGHT)
+        self.block_style = ParagraphStyle('Block', parent=self.content_style, leading=font_size + 4)
+        self.rx_style = ParagraphStyle('Rx', parent=normal, fontSize=spec["rx_font_size"], fontName='Helvetica-Bold', textColor=accent_color)
+        # Paragraph comments wrap within their column
+        self.comment_style = ParagraphStyle('Comment', parent=self.content_style, fontSize=table_font_size,
+                                            leading=table_font_size + 2, wordWrap='CJK')
+        
+        self.header_row_padding = 3*mm
+        self.body_row_padding = 2.5*mm
+        self.info_table_style = TableStyle([
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
+        ])
+        self.drug_table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), accent_color),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+            ('ALIGN', (0, 0), (0, -1), 'CENTER'),
+            ('ALIGN', (1, 0), (-1, -1), 'LEFT'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), table_font_size),
+            ('FONTSIZE', (0, 1), (-1, -1), table_font_size),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), self.header_row_padding),
+            ('TOPPADDING', (0, 0), (-1, 0), self.header_row_padding),
+            ('BOTTOMPADDING', (0, 1), (-1, -1), self.body_row_padding),
+            ('TOPPADDING', (0, 1), (-1, -1), self.body_row_padding),
+            ('GRID', (0, 0), (-1, -1), 0.5, grid_color),
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),  # Top align for wrapped text
+        ])
+
+BUILTIN_PDF_LAYOUT = CompiledPdfLayout(PdfLayoutSpec().model_dump())
+
+_compiled_pdf_layouts = {}
+
+def compiled_pdf_layout(layout: dict) -> CompiledPdfLayout:
+    """Compiled layout for a stored layout document, rebuilt only when its revision changes"""
+    cached = _compiled_pdf_layouts.get(layout["id"])
+    if cached and cached[0] == layout["revision"]:
+        return cached[1]
+    compiled = CompiledPdfLayout(layout)
+    _compiled_pdf_layouts[layout["id"]] = (layout["revision"], compiled)
+    return compiled
+
+# Layout documents by (scope, key), so renders do not read pdf_layouts. This worker reloads them after
+# its own admin edits; edits made through other workers reach it within PDF_LAYOUT_REFRESH_SECONDS
+PDF_LAYOUT_REFRESH_SECONDS = float(os.environ.get('PDF_LAYOUT_REFRESH_SECONDS', 30))
+_pdf_layout_table = None
+
+async def pdf_layout_table() -> dict:
+    global _pdf_layout_table
+    now = time.monotonic()
+    if _pdf_layout_table is None or now - _pdf_layout_table[0] > PDF_LAYOUT_REFRESH_SECONDS:
+        layouts = await db.pdf_layouts.find({}, {"_id": 0}).to_list(None)
+        _pdf_layout_table = (now, {(l["scope"], l.get("key") or None): l for l in layouts})
+    return _pdf_layout_table[1]
+
+def invalidate_pdf_layouts():
+    global _pdf_layout_table
+    _pdf_layout_table = None
+
+async def resolve_pdf_layout(prescription: dict) -> tuple:
+    """(cache key, compiled layout) for a prescription: doctor layout, else location layout, else default"""
+    table = await pdf_layout_table()
+    for scope_key in (("doctor", prescription.get("doctor_id", "dr_prakashini")),
+                      ("location", prescription.get("location", "Bangalore")),
+                      ("default", None)):
+        layout = table.get(scope_key)
+        if layout:
+            return f"{layout['id']}:{layout['revision']}", compiled_pdf_layout(layout)
+    return "builtin", BUILTIN_PDF_LAYOUT
+
+# Drug table - rows are measured up front so ReportLab never re-wraps them when the table splits
+# across pages; only comments that actually wrap become Paragraphs
+DRUG_TABLE_HEADER = ['S.No', 'Drug Name', 'Dosage', 'Frequency', 'Duration', 'Comments']
+DRUG_TABLE_CELL_PADDING = 6   # ReportLab's default left/right cell padding
+DRUG_TABLE_CELL_LEADING = 12  # ReportLab's default cell leading (the table style sets only the font size)
+# Text a Paragraph would draw verbatim: no markup, entities, tabs, newlines or runs of spaces
+_PLAIN_CELL_TEXT = re.compile(r'[^<&\s]+( [^<&\s]+)*')
+
+@lru_cache(maxsize=4096)
+def text_width(text: str, font_name: str, font_size: float) -> float:
+    return stringWidth(text, font_name, font_size)
+
+@lru_cache(maxsize=1024)
+def wrapped_text_height(text: str, width: float, font_name: str, font_size: float, leading: float) -> float:
+    style = ParagraphStyle('Measure', fontName=font_name, fontSize=font_size, leading=leading, wordWrap='CJK')
+    return Paragraph(text, style).wrap(width, 1 << 20)[1]
+
+def drug_rows(drugs: list) -> list:
+    return [
+        [str(idx), drug['drug_name'], drug['dosage'], drug['frequency'],
+         f"{drug['duration']} {drug['duration_unit']}", drug.get('comments', '-') or '-']
+        for idx, drug in enumerate(drugs, 1)
+    ]
+
+def build_drug_table_reference(drugs: list, layout: CompiledPdfLayout) -> Table:
+    """Drug table with every comment as a Paragraph and rows sized by ReportLab (reference for layout tests)"""
+    drug_data = [DRUG_TABLE_HEADER] + [row[:-1] + [Paragraph(row[-1], layout.comment_style)] for row in drug_rows(drugs)]
+    # splitByRow=1 allows table to split between rows for better page filling
+    drug_table = Table(drug_data, colWidths=layout.drug_col_widths,
+                       repeatRows=1, splitByRow=1)  # Repeat header and allow row splitting
+    drug_table.setStyle(layout.drug_table_style)
+    return drug_table
+
+def build_drug_table(drugs: list, layout: CompiledPdfLayout) -> Table:
+    """Drug table with pre-measured rows, drawing identically to build_drug_table_reference"""
+    style = layout.comment_style
+    comment_width = layout.drug_col_widths[-1] - 2*DRUG_TABLE_CELL_PADDING
+    line = DRUG_TABLE_CELL_LEADING
+    body_padding = 2*layout.body_row_padding
     
-    # Total margins = header/footer space + padding
-    top_margin = header_space + padding      # 40mm total from top
-    bottom_margin = footer_space + padding   # 40mm total from bottom
+    drug_data = [DRUG_TABLE_HEADER]
+    row_heights = [line + 2*layout.header_row_padding]
+    plain_comment_rows = []
+    for i, row in enumerate(drug_rows(drugs), 1):
+        comment = row[-1]
+        cells_height = line * max(str(value).count('\n') + 1 for value in row[:-1])
+        if _PLAIN_CELL_TEXT.fullmatch(comment) and text_width(comment, style.fontName, style.fontSize) <= comment_width:
+            plain_comment_rows.append(i)
+            comment_height = style.leading
+        else:
+            comment_height = wrapped_text_height(comment, comment_width, style.fontName, style.fontSize, style.leading)
+            row[-1] = Paragraph(comment, style)
+        drug_data.append(row)
+        row_heights.append(max(cells_height, comment_height) + body_padding)
     
-    # Frame dimensions - content area between margins
-    frame_width = page_width - left_margin - right_margin
-    frame_height = page_height - top_margin - bottom_margin  # 217mm usable height
+    drug_table = Table(drug_data, colWidths=layout.drug_col_widths, rowHeights=row_heights,
+                       repeatRows=1, splitByRow=1)
+    drug_table.setStyle(layout.drug_table_style)
+    # Plain comments are drawn in the Paragraph colour; the baseline already matches
+    drug_table.setStyle(TableStyle([
+        ('TEXTCOLOR', (5, first), (5, last), style.textColor) for first, last in _runs(plain_comment_rows)
+    ]))
+    return drug_table
+
+def _runs(indexes: list):
+    """Consecutive runs in an ascending list of ints as (first, last) pairs"""
+    start = prev = None
+    for i in indexes:
+        if prev is not None and i == prev + 1:
+            prev = i
+            continue
+        if start is not None:
+            yield start, prev
+        start = prev = i
+    if start is not None:
+        yield start, prev
+
+def render_prescription_pdf(prescription: dict, debug: bool = False, layout: Optional[CompiledPdfLayout] = None,
+                            measure_table: bool = True) -> BytesIO:
+    """Build the prescription PDF with ReportLab (blocking - run it off the event loop)"""
+    layout = layout or BUILTIN_PDF_LAYOUT
+    
+    # Generate PDF - designed for pre-printed prescription pads
+    # Header and footer spaces are reserved but not printed
+    buffer = BytesIO()
+    page_width, page_height = layout.page_width, layout.page_height
+    content_style = layout.content_style
     
     # Define page callback for debug mode - draws margin lines on every page
     def draw_debug_margins(canvas, doc):
         if debug:
             canvas.saveState()
-            # Draw header zone (36mm from top)
+            # Draw header zone
             canvas.setStrokeColor(colors.blue)
             canvas.setLineWidth(1)
-            header_line_y = page_height - header_space
+            header_line_y = page_height - layout.header_space
             canvas.line(0, header_line_y, page_width, header_line_y)
             
-            # Draw footer zone (36mm from bottom)
-            footer_line_y = footer_space
+            # Draw footer zone
+            footer_line_y = layout.footer_space
             canvas.line(0, footer_line_y, page_width, footer_line_y)
             
-            # Draw content boundary lines (with 4mm padding)
+            # Draw content boundary lines (with padding)
             canvas.setStrokeColor(colors.red)
-            top_content_y = page_height - top_margin  # 36mm + 4mm = 40mm from top
-            bottom_content_y = bottom_margin          # 36mm + 4mm = 40mm from bottom
+            top_content_y = page_height - layout.top_margin
+            bottom_content_y = layout.bottom_margin
             canvas.line(0, top_content_y, page_width, top_content_y)
             canvas.line(0, bottom_content_y, page_width, bottom_content_y)
             
             # Add labels
             canvas.setFont('Helvetica', 7)
             canvas.setFillColor(colors.blue)
-            canvas.drawString(5, header_line_y + 2, f"HEADER: 36mm")
-            canvas.drawString(5, footer_line_y + 2, f"FOOTER: 36mm")
+            canvas.drawString(5, header_line_y + 2, f"HEADER: {layout.header_mm:g}mm")
+            canvas.drawString(5, footer_line_y + 2, f"FOOTER: {layout.footer_mm:g}mm")
             canvas.setFillColor(colors.red)
-            canvas.drawString(5, top_content_y - 10, f"CONTENT TOP (36mm + 4mm padding)")
-            canvas.drawString(5, bottom_content_y + 12, f"CONTENT BOTTOM (36mm + 4mm padding)")
+            canvas.drawString(5, top_content_y - 10, f"CONTENT TOP ({layout.header_mm:g}mm + {layout.padding / mm:g}mm padding)")
+            canvas.drawString(5, bottom_content_y + 12, f"CONTENT BOTTOM ({layout.footer_mm:g}mm + {layout.padding / mm:g}mm padding)")
             canvas.restoreState()
     
     # Create document with BaseDocTemplate for precise margin control
+    # invariant: no timestamp or random document id, so identical content gives identical bytes
     doc = BaseDocTemplate(buffer, pagesize=A4,
-                         leftMargin=left_margin, rightMargin=right_margin,
-                         topMargin=top_margin, bottomMargin=bottom_margin)
+                         leftMargin=layout.side_margin, rightMargin=layout.side_margin,
+                         topMargin=layout.top_margin, bottomMargin=layout.bottom_margin,
+                         invariant=1)
     
-    # Create frame - positioned at (left_margin, bottom_margin) with calculated dimensions
+    # Frames track their fill position during a build, so each render gets its own
     # Content will be top-aligned within this frame
-    frame = Frame(left_margin, bottom_margin, frame_width, frame_height,
+    frame = Frame(layout.side_margin, layout.bottom_margin, layout.frame_width, layout.frame_height,
                   leftPadding=0, bottomPadding=0, rightPadding=0, topPadding=0,
                   id='main')
     
@@ -792,8 +3389,7 @@ async def generate_pdf(prescription_id: str, debug: bool = False, payload: dict
     elements = []
     
     # Date and Patient Info Row - NEW LAYOUT: Patient Name on left, OP No/Sex/Age on right
-    created_date = datetime.fromisoformat(prescription['created_at'].replace('Z', '+00:00'))
-    date_str = created_date.strftime("%d-%m-%Y")
+    date_str = prescription_date_str(prescription)
     
     # First row: Patient Name on left, Date and OP No on right
     sex = prescription.get('sex', '')
@@ -803,13 +3399,10 @@ async def generate_pdf(prescription_id: str, debug: bool = False, payload: dict
     info_row = Table([
         [
             Paragraph(f"<b>Patient Name:</b> {prescription['patient_name']}", content_style),
-            Paragraph(f"<b>Date:</b> {date_str}  |  <b>OP No.:</b> {prescription['op_no']}", ParagraphStyle('RightAlign', parent=content_style, alignment=TA_RIGHT))
+            Paragraph(f"<b>Date:</b> {date_str}  |  <b>OP No.:</b> {prescription['op_no']}", layout.right_style)
         ]
-    ], colWidths=[90*mm, 90*mm])
-    info_row.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
-    ]))
+    ], colWidths=layout.info_col_widths)
+    info_row.setStyle(layout.info_table_style)
     elements.append(info_row)
     elements.append(Spacer(1, 3*mm))
     
@@ -825,13 +3418,10 @@ async def generate_pdf(prescription_id: str, debug: bool = False, payload: dict
         info_row2 = Table([
             [
                 Paragraph(f"<b>ICD Code:</b> {icd_code}" if icd_code else "", content_style),
-                Paragraph(right_text, ParagraphStyle('RightAlign', parent=content_style, alignment=TA_RIGHT))
+                Paragraph(right_text, layout.right_style)
             ]
-        ], colWidths=[90*mm, 90*mm])
-        info_row2.setStyle(TableStyle([
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('ALIGN', (1, 0), (1, 0), 'RIGHT'),
-        ]))
+        ], colWidths=layout.info_col_widths)
+        info_row2.setStyle(layout.info_table_style)
         elements.append(info_row2)
     
     # Vitals row - individual fields formatted: Wt, Ht, BP, SpO2
@@ -857,68 +3447,24 @@ async def generate_pdf(prescription_id: str, debug: bool = False, payload: dict
     elements.append(Spacer(1, 8*mm))
     
     # Diagnosis with proper spacing
-    elements.append(Paragraph("<b>Diagnosis:</b>", label_style))
+    elements.append(Paragraph("<b>Diagnosis:</b>", layout.label_style))
     elements.append(Spacer(1, 2*mm))
-    elements.append(Paragraph(f"    {prescription['diagnosis']}", ParagraphStyle('DiagContent', parent=content_style, leading=14)))
+    elements.append(Paragraph(f"    {prescription['diagnosis']}", layout.block_style))
     elements.append(Spacer(1, 8*mm))
     
     # Clinical History with proper spacing
     if prescription.get('clinical_history'):
-        elements.append(Paragraph("<b>Clinical History:</b>", label_style))
+        elements.append(Paragraph("<b>Clinical History:</b>", layout.label_style))
         elements.append(Spacer(1, 2*mm))
-        elements.append(Paragraph(f"    {prescription['clinical_history']}", ParagraphStyle('HistContent', parent=content_style, leading=14)))
+        elements.append(Paragraph(f"    {prescription['clinical_history']}", layout.block_style))
         elements.append(Spacer(1, 8*mm))
     
     # Rx with proper spacing
-    elements.append(Paragraph("Rx :", rx_style))
+    elements.append(Paragraph("Rx :", layout.rx_style))
     elements.append(Spacer(1, 5*mm))
     
-    # Drug Table - increased frequency column width
-    # Using Paragraphs for comments to enable text wrapping
-    comment_style = ParagraphStyle(
-        'Comment',
-        parent=content_style,
-        fontSize=9,
-        leading=11,
-        wordWrap='CJK'  # Enable word wrapping
-    )
-    
-    drug_header = ['S.No', 'Drug Name', 'Dosage', 'Frequency', 'Duration', 'Comments']
-    drug_data = [drug_header]
-    
-    for idx, drug in enumerate(prescription['drugs'], 1):
-        # Wrap comments in Paragraph for proper text wrapping
-        comment_text = drug.get('comments', '-') or '-'
-        comment_para = Paragraph(comment_text, comment_style)
-        
-        drug_data.append([
-            str(idx),
-            drug['drug_name'],
-            drug['dosage'],
-            drug['frequency'],
-            f"{drug['duration']} {drug['duration_unit']}",
-            comment_para
-        ])
-    
-    # Adjusted column widths - frequency column wider
-    # splitByRow=1 allows table to split between rows for better page filling
-    drug_table = Table(drug_data, colWidths=[10*mm, 38*mm, 22*mm, 35*mm, 25*mm, 40*mm],
-                       repeatRows=1, splitByRow=1)  # Repeat header and allow row splitting
-    drug_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#6B9A9A')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('ALIGN', (0, 0), (0, -1), 'CENTER'),
-        ('ALIGN', (1, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 9),
-        ('FONTSIZE', (0, 1), (-1, -1), 9),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 3*mm),
-        ('TOPPADDING', (0, 0), (-1, 0), 3*mm),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 2.5*mm),
-        ('TOPPADDING', (0, 1), (-1, -1), 2.5*mm),
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#CCCCCC')),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),  # Top align for wrapped text
-    ]))
+    # Drug Table - increased frequency column width, comments wrap within their column
+    drug_table = (build_drug_table if measure_table else build_drug_table_reference)(prescription['drugs'], layout)
     elements.append(drug_table)
     elements.append(Spacer(1, 8*mm))
     
@@ -930,17 +3476,17 @@ async def generate_pdf(prescription_id: str, debug: bool = False, payload: dict
     # Advice section
     if prescription.get('advice'):
         elements.append(Spacer(1, 3*mm))
-        elements.append(Paragraph("<b>Advice / Instructions:</b>", label_style))
+        elements.append(Paragraph("<b>Advice / Instructions:</b>", layout.label_style))
         elements.append(Spacer(1, 2*mm))
-        elements.append(Paragraph(f"    {prescription['advice']}", ParagraphStyle('AdviceContent', parent=content_style, leading=14)))
+        elements.append(Paragraph(f"    {prescription['advice']}", layout.block_style))
         elements.append(Spacer(1, 5*mm))
     
     # Lab Tests section
     if prescription.get('lab_tests'):
         elements.append(Spacer(1, 3*mm))
-        elements.append(Paragraph("<b>Lab Tests Advised:</b>", label_style))
+        elements.append(Paragraph("<b>Lab Tests Advised:</b>", layout.label_style))
         elements.append(Spacer(1, 2*mm))
-        elements.append(Paragraph(f"    {prescription['lab_tests']}", ParagraphStyle('LabContent', parent=content_style, leading=14)))
+        elements.append(Paragraph(f"    {prescription['lab_tests']}", layout.block_style))
         elements.append(Spacer(1, 5*mm))
     
     # No signature printed - using pre-printed prescription pads with doctor signature
@@ -949,17 +3495,364 @@ async def generate_pdf(prescription_id: str, debug: bool = False, payload: dict
     # Build the document - SimpleDocTemplate automatically handles 50mm margins on all pages
     doc.build(elements)
     
-    buffer.seek(0)
-    pdf_bytes = buffer.getvalue()
-    
-    return Response(
-        content=pdf_bytes,
+    return buffer
+
+def prescription_date_str(prescription: dict) -> str:
+    created = as_datetime(prescription.get('created_at'))
+    return created.strftime("%d-%m-%Y") if created else ""
+
+def pdf_filename(prescription: dict) -> str:
+    return f"prescription_{prescription['op_no']}_{prescription_date_str(prescription)}.pdf"
+
+# Print-optimised HTML of the same pad layout, for viewing and browser printing without a PDF build.
+# The template is compiled once; responses are validated by ETag (prescription version + layout + template)
+_html_templates = Environment(loader=FileSystemLoader(ROOT_DIR / "templates"), autoescape=True, auto_reload=False)
+PRESCRIPTION_HTML = _html_templates.get_template("prescription.html")
+PRESCRIPTION_HTML_DIGEST = hashlib.sha256((ROOT_DIR / "templates" / "prescription.html").read_bytes()).hexdigest()
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+def render_prescription_html(prescription: dict, layout: CompiledPdfLayout) -> str:
+    vitals = [(name, prescription.get(field)) for name, field in
+              (("Wt", "weight"), ("Ht", "height"), ("BP", "bp"), ("SpO2", "spo2")) if prescription.get(field)]
+    return PRESCRIPTION_HTML.render(p=prescription, layout=layout.spec, vitals=vitals,
+                                    date=prescription_date_str(prescription))
+
+# Rendered PDFs are kept in a content-addressed GridFS store (file name = sha256 of the bytes);
+# pdf_renders points each prescription at the blob for its current version, and each blob counts
+# the renders pointing at it in metadata.refs so deleting the last one cannot race a new one
+PDF_STREAM_CHUNK = 256 * 1024
+
+def pdf_bucket() -> AsyncIOMotorGridFSBucket:
+    return AsyncIOMotorGridFSBucket(db, bucket_name="pdf_blobs")
+
+async def store_pdf_render(prescription: dict, layout_key: str, buffer: BytesIO) -> dict:
+    """Persist a render (deduplicated by content) and point the prescription's current version at it"""
+    digest = hashlib.sha256(buffer.getbuffer()).hexdigest()
+    # Only counted blobs that are still referenced are shared
+    blob = await db["pdf_blobs.files"].find_one_and_update(
+        {"filename": digest, "metadata.refs": {"$gt": 0}}, {"$inc": {"metadata.refs": 1}}, {"_id": 1, "length": 1}
+    )
+    if blob:
+        file_id, length = blob["_id"], blob["length"]
+    else:
+        length = buffer.getbuffer().nbytes
+        buffer.seek(0)
+        file_id = await pdf_bucket().upload_from_stream(
+            digest, buffer, metadata={"contentType": "application/pdf", "refs": 1}
+        )
+    render = {
+        "prescription_id": prescription["id"],
+        "version": prescription.get("version") or 0,
+        "layout": layout_key,
+        "file_id": file_id,
+        "sha256": digest,
+        "length": length,
+        "created_at": datetime.now(timezone.utc),
+    }
+    previous = await db.pdf_renders.find_one_and_replace(
+        {"prescription_id": prescription["id"]}, render, upsert=True
+    )
+    if previous:
+        await release_pdf_blob(previous["file_id"])
+    return render
+
+async def release_pdf_blob(file_id):
+    """Drop one render's reference to a blob and delete the blob once nothing points at it"""
+    blob = await db["pdf_blobs.files"].find_one_and_update(
+        {"_id": file_id, "metadata.refs": {"$exists": True}}, {"$inc": {"metadata.refs": -1}},
+        {"metadata.refs": 1}, return_document=ReturnDocument.AFTER
+    )
+    if blob is None:
+        # Blobs stored before reference counts are never shared again, so no new render can point at one
+        if await db.pdf_renders.find_one({"file_id": file_id}, {"_id": 1}):
+            return
+    elif blob["metadata"]["refs"] > 0:
+        return
+    # Conditional on the count, so a render that took a reference in the meantime keeps the blob
+    deleted = await db["pdf_blobs.files"].delete_one({"_id": file_id, "metadata.refs": {"$not": {"$gt": 0}}})
+    if deleted.deleted_count:
+        await db["pdf_blobs.chunks"].delete_many({"files_id": file_id})
+
+async def delete_pdf_render(prescription_id: str):
+    render = await db.pdf_renders.find_one_and_delete({"prescription_id": prescription_id})
+    if render:
+        await release_pdf_blob(render["file_id"])
+
+async def find_pdf_render(prescription: dict, layout_key: str) -> Optional[dict]:
+    """Stored render of the prescription's current version with its current layout revision"""
+    return await db.pdf_renders.find_one(
+        {"prescription_id": prescription["id"], "version": prescription.get("version") or 0, "layout": layout_key},
+        {"_id": 0},
+    )
+
+def parse_byte_range(header: Optional[str], length: int) -> Optional[tuple]:
+    """First (start, end) of a "bytes=" Range header, None for the whole file; ValueError if unsatisfiable"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None  # absent, other units or multiple ranges: serve the whole file
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start, end = int(first), int(last) if last else length - 1
+        else:
+            start, end = length - int(last), length - 1
+    except ValueError:
+        return None
+    start, end = max(start, 0), min(end, length - 1)
+    if start > end or start >= length:
+        raise ValueError(header)
+    return start, end
+
+async def open_pdf_blob(render: Optional[dict]):
+    """GridFS download stream for a render, None if there is no render or its blob has gone"""
+    if render is None:
+        return None
+    try:
+        return await pdf_bucket().open_download_stream(render["file_id"])
+    except NoFile:
+        return None
+
+async def stream_pdf_blob(grid_out, start: int, end: int):
+    grid_out.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        chunk = await grid_out.read(min(PDF_STREAM_CHUNK, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+def pdf_render_response(render: dict, grid_out, filename: str, request: Request) -> Response:
+    """Stream a stored render, honouring Range (and If-Range) so interrupted downloads can resume"""
+    length = render["length"]
+    etag = f'"{render["sha256"]}"'
+    headers = {
+        "Content-Disposition": f"attachment; filename={filename}",
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+    }
+    byte_range = None
+    if request.headers.get("if-range", etag) == etag:
+        try:
+            byte_range = parse_byte_range(request.headers.get("range"), length)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{length}"})
+    start, end = byte_range or (0, length - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{length}"
+    return StreamingResponse(
+        stream_pdf_blob(grid_out, start, end),
+        status_code=206 if byte_range else 200,
         media_type="application/pdf",
-        headers={
-            "Content-Disposition": f"attachment; filename=prescription_{prescription['op_no']}_{date_str}.pdf"
-        }
+        headers=headers,
     )
 
+async def render_and_store_pdf(prescription: dict, layout_key: str, layout: CompiledPdfLayout) -> dict:
+    """Render and store the current version; concurrent calls for the same version share one render"""
+    async def render_and_store():
+        buffer = await asyncio.to_thread(render_prescription_pdf, prescription, False, layout)
+        return await store_pdf_render(prescription, layout_key, buffer)
+    key = ("pdf", prescription["id"], prescription.get("version") or 0, layout_key)
+    return await single_flight.do(key, render_and_store)
+
+# Pre-rendered PDFs (optional): every save queues a background render so the download
+# is usually already stored when it is requested
+PDF_PRERENDER = os.environ.get('PDF_PRERENDER', 'false').lower() in ('1', 'true', 'yes')
+PDF_RENDER_QUEUE_SIZE = 1000
+_pdf_render_queue = None
+_pdf_render_pending = set()
+_pdf_render_worker = None
+
+def enqueue_pdf_render(prescription_id: str):
+    """Queue a render; a full queue or an already pending render is skipped (downloads fall back to rendering)"""
+    if _pdf_render_queue is None or prescription_id in _pdf_render_pending:
+        return
+    try:
+        _pdf_render_queue.put_nowait(prescription_id)
+        _pdf_render_pending.add(prescription_id)
+    except asyncio.QueueFull:
+        logger.warning("PDF render queue full, skipping pre-render of %s", prescription_id)
+
+async def prerender_pdf(prescription_id: str):
+    prescription = await load_prescription(prescription_id)
+    if not prescription:
+        return
+    layout_key, layout = await resolve_pdf_layout(prescription)
+    if await open_pdf_blob(await find_pdf_render(prescription, layout_key)):
+        return
+    await render_and_store_pdf(prescription, layout_key, layout)
+
+async def run_pdf_render_queue():
+    """Write-behind worker: renders queued prescriptions one at a time"""
+    while True:
+        prescription_id = await _pdf_render_queue.get()
+        _pdf_render_pending.discard(prescription_id)
+        try:
+            await prerender_pdf(prescription_id)
+        except Exception as e:
+            logger.warning("Pre-render of prescription %s failed: %s", prescription_id, e)
+        finally:
+            _pdf_render_queue.task_done()
+
+def start_pdf_render_queue():
+    global _pdf_render_queue, _pdf_render_worker
+    _pdf_render_queue = asyncio.Queue(maxsize=PDF_RENDER_QUEUE_SIZE)
+    _pdf_render_worker = asyncio.create_task(run_pdf_render_queue())
+
+@api_router.get("/prescriptions/{prescription_id}/html")
+async def prescription_html(prescription_id: str, request: Request, payload: dict = Depends(verify_token)):
+    """Print-ready HTML of the prescription with the same pad margins as the PDF"""
+    prescription = await load_prescription(prescription_id)
+    if not prescription:
+        raise HTTPException(status_code=404, detail="Prescription not found")
+    
+    layout_key, layout = await resolve_pdf_layout(prescription)
+    fingerprint = f"{prescription_id}:{prescription.get('version') or 0}:{layout_key}:{PRESCRIPTION_HTML_DIGEST}"
+    etag = f'"{hashlib.sha256(fingerprint.encode()).hexdigest()[:32]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(render_prescription_html(prescription, layout), headers=headers)
+
+@api_router.get("/prescriptions/{prescription_id}/pdf")
+async def generate_pdf(prescription_id: str, request: Request, debug: bool = False, payload: dict = Depends(verify_token)):
+    prescription = await load_prescription(prescription_id)
+    if not prescription:
+        raise HTTPException(status_code=404, detail="Prescription not found")
+    
+    filename = pdf_filename(prescription)
+    layout_key, layout = await resolve_pdf_layout(prescription)
+    if debug:
+        # Margin guides are for layout checks only and are never stored
+        key = ("pdf_debug", prescription_id, prescription.get("version") or 0, layout_key)
+        buffer = await single_flight.do(key, lambda: asyncio.to_thread(render_prescription_pdf, prescription, True, layout))
+        return Response(content=buffer.getvalue(), media_type="application/pdf",
+                        headers={"Content-Disposition": f"attachment; filename={filename}"})
+    
+    # Serve the stored render of this version, rendering and storing it first if there is none yet
+    render = await find_pdf_render(prescription, layout_key)
+    grid_out = await open_pdf_blob(render)
+    if grid_out is None:
+        render = await render_and_store_pdf(prescription, layout_key, layout)
+        grid_out = await open_pdf_blob(render)
+    if grid_out is None:
+        # A newer render replaced this one and released its blob before it could be opened
+        buffer = await asyncio.to_thread(render_prescription_pdf, prescription, False, layout)
+        return Response(content=buffer.getvalue(), media_type="application/pdf",
+                        headers={"Content-Disposition": f"attachment; filename={filename}"})
+    return pdf_render_response(render, grid_out, filename, request)
+
+# PDF layout templates (Admin only) - edits bump the revision, which recompiles the layout
+# and invalidates stored renders that used the previous one
+PDF_LAYOUT_SAMPLE = {
+    "id": "layout-preview",
+    "op_no": "OP-0000",
+    "patient_name": "Sample Patient",
+    "sex": "F",
+    "age": "45",
+    "icd_code": "M05.9",
+    "weight": "62 kg",
+    "height": "158 cm",
+    "bp": "124/82",
+    "spo2": "98%",
+    "diagnosis": "Seropositive rheumatoid arthritis",
+    "clinical_history": "Symmetrical small joint pain and morning stiffness for 6 months",
+    "drugs": [
+        {"drug_name": "Methotrexate", "dosage": "15 mg", "frequency": "Once weekly", "duration": "12", "duration_unit": "Weeks", "comments": "Take on Sundays"},
+        {"drug_name": "Folic Acid", "dosage": "5 mg", "frequency": "Once weekly", "duration": "12", "duration_unit": "Weeks", "comments": "Take the day after methotrexate"},
+        {"drug_name": "HCQS", "dosage": "200 mg", "frequency": "1-0-1", "duration": "3", "duration_unit": "Months", "comments": "After food"},
+    ],
+    "review_after": "4 weeks",
+    "advice": "Regular exercise, avoid alcohol",
+    "lab_tests": "CBC, LFT, ESR, CRP",
+    "created_at": "2024-01-01T10:00:00+00:00",
+}
+
+def compile_layout_or_400(spec: dict) -> CompiledPdfLayout:
+    try:
+        return CompiledPdfLayout(spec)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid layout: {e}")
+
+def check_layout_scope(layout: PdfLayoutCreate):
+    if layout.scope not in PDF_LAYOUT_SCOPES:
+        raise HTTPException(status_code=400, detail="scope must be 'doctor', 'location' or 'default'")
+    if (layout.scope == "default") != (not layout.key):
+        raise HTTPException(status_code=400, detail="key is required for doctor and location layouts only")
+
+def preview_response(spec: dict, debug: bool) -> Response:
+    layout = compile_layout_or_400(spec)
+    buffer = render_prescription_pdf(PDF_LAYOUT_SAMPLE, debug, layout)
+    return Response(content=buffer.getvalue(), media_type="application/pdf",
+                    headers={"Content-Disposition": "inline; filename=layout_preview.pdf"})
+
+@api_router.get("/admin/pdf-layouts")
+async def get_pdf_layouts(payload: dict = Depends(require_admin)):
+    """Get all PDF layouts (admin only)"""
+    layouts = await db.pdf_layouts.find({}, {"_id": 0}).to_list(500)
+    return {"layouts": layouts, "builtin": PdfLayoutSpec().model_dump()}
+
+@api_router.post("/admin/pdf-layouts")
+async def create_pdf_layout(layout: PdfLayoutCreate, payload: dict = Depends(require_admin)):
+    """Create a PDF layout for a doctor, a location or the default pad (admin only)"""
+    check_layout_scope(layout)
+    compile_layout_or_400(layout.model_dump())
+    if await db.pdf_layouts.find_one({"scope": layout.scope, "key": layout.key}, {"_id": 1}):
+        raise HTTPException(status_code=400, detail="A layout already exists for this scope")
+    now = datetime.now(timezone.utc).isoformat()
+    layout_doc = {**layout.model_dump(), "id": str(uuid.uuid4()), "revision": 1, "created_at": now, "updated_at": now}
+    await db.pdf_layouts.insert_one(layout_doc)
+    invalidate_pdf_layouts()
+    layout_doc.pop("_id", None)
+    return layout_doc
+
+@api_router.put("/admin/pdf-layouts/{layout_id}")
+async def update_pdf_layout(layout_id: str, layout: PdfLayoutCreate, payload: dict = Depends(require_admin)):
+    """Replace a PDF layout; takes effect on the next render (admin only)"""
+    check_layout_scope(layout)
+    compile_layout_or_400(layout.model_dump())
+    other = await db.pdf_layouts.find_one({"scope": layout.scope, "key": layout.key, "id": {"$ne": layout_id}}, {"_id": 1})
+    if other:
+        raise HTTPException(status_code=400, detail="A layout already exists for this scope")
+    updated = await db.pdf_layouts.find_one_and_update(
+        {"id": layout_id},
+        {"$set": {**layout.model_dump(), "updated_at": datetime.now(timezone.utc).isoformat()}, "$inc": {"revision": 1}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not updated:
+        raise HTTPException(status_code=404, detail="Layout not found")
+    invalidate_pdf_layouts()
+    return updated
+
+@api_router.delete("/admin/pdf-layouts/{layout_id}")
+async def delete_pdf_layout(layout_id: str, payload: dict = Depends(require_admin)):
+    """Delete a PDF layout; affected prescriptions fall back to the next matching layout (admin only)"""
+    result = await db.pdf_layouts.delete_one({"id": layout_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Layout not found")
+    _compiled_pdf_layouts.pop(layout_id, None)
+    invalidate_pdf_layouts()
+    return {"message": "Layout deleted successfully"}
+
+@api_router.post("/admin/pdf-layouts/preview")
+async def preview_pdf_layout(layout: PdfLayoutSpec, debug: bool = True, payload: dict = Depends(require_admin)):
+    """Render an unsaved layout on sample data (admin only)"""
+    return await asyncio.to_thread(preview_response, layout.model_dump(), debug)
+
+@api_router.get("/admin/pdf-layouts/{layout_id}/preview")
+async def preview_saved_pdf_layout(layout_id: str, debug: bool = True, payload: dict = Depends(require_admin)):
+    """Render a saved layout on sample data (admin only)"""
+    layout = await db.pdf_layouts.find_one({"id": layout_id}, {"_id": 0})
+    if not layout:
+        raise HTTPException(status_code=404, detail="Layout not found")
+    return await asyncio.to_thread(preview_response, layout, debug)
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -969,6 +3862,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-ICD-Warning", "X-Sync-Since"],
 )
 
 # Configure logging
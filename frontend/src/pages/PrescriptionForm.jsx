@@ -67,6 +67,7 @@ const PrescriptionForm = () => {
   const isEditMode = Boolean(editId);
   const [loading, setLoading] = useState(false);
   const [initialLoading, setInitialLoading] = useState(isEditMode);
+  const [editVersion, setEditVersion] = useState(null); // Version loaded for editing (optimistic concurrency)
   const [drugList, setDrugList] = useState([]);
   const [doctors, setDoctors] = useState([]);
   const [formData, setFormData] = useState({
@@ -89,11 +90,15 @@ const PrescriptionForm = () => {
   });
   const [searchTerms, setSearchTerms] = useState([""]);
   const [showDropdowns, setShowDropdowns] = useState([false]);
+  const [icdSuggestions, setIcdSuggestions] = useState([]);
+  const [showIcdDropdown, setShowIcdDropdown] = useState(false);
+  const [drugAlerts, setDrugAlerts] = useState([]);
   const [customFreqDialog, setCustomFreqDialog] = useState({ open: false, index: null });
   const [customFreq, setCustomFreq] = useState("");
   
   // OP No lookup state
   const [existingPrescriptions, setExistingPrescriptions] = useState([]);
+  const [patientSummary, setPatientSummary] = useState(null);
   const [showExistingDialog, setShowExistingDialog] = useState(false);
   const [deleteConfirmDialog, setDeleteConfirmDialog] = useState({ open: false, id: null, opNo: '' });
   const opNoTimeoutRef = useRef(null);
@@ -135,6 +140,8 @@ const PrescriptionForm = () => {
         lab_tests: prescription.lab_tests || "",
         doctor_id: prescription.doctor_id || "dr_prakashini",
       });
+      setEditVersion(prescription.version ?? 0);
+      setDrugAlerts(prescription.drug_alerts || []);
       
       // Set search terms for drug autocomplete
       if (prescription.drugs?.length > 0) {
@@ -208,22 +215,34 @@ const PrescriptionForm = () => {
   const checkExistingPrescriptions = useCallback(async (opNo) => {
     if (!opNo || opNo.length < 2) {
       setExistingPrescriptions([]);
+      setPatientSummary(null);
       return;
     }
     
     try {
-      const response = await axios.get(`${API}/prescriptions/by-op/${encodeURIComponent(opNo)}`);
-      if (response.data.prescriptions && response.data.prescriptions.length > 0) {
-        setExistingPrescriptions(response.data.prescriptions);
-        setShowExistingDialog(true);
-      } else {
-        setExistingPrescriptions([]);
-      }
+      const response = await axios.get(`${API}/patients/${encodeURIComponent(opNo)}`);
+      setPatientSummary(response.data);
+      setExistingPrescriptions(response.data.visits || []);
+      setShowExistingDialog(true);
     } catch (error) {
-      console.error("Error checking existing prescriptions:", error);
+      setExistingPrescriptions([]);
+      setPatientSummary(null);
+      if (error.response?.status !== 404) {
+        console.error("Error checking existing prescriptions:", error);
+      }
     }
   }, []);
 
+  // Visits in the patient summary are compact; fetch the full prescription before loading it
+  const loadFullPrescription = async (id) => {
+    try {
+      const response = await axios.get(`${API}/prescriptions/${id}`);
+      loadExistingPrescription(response.data, true);
+    } catch (error) {
+      toast.error("Failed to load prescription");
+    }
+  };
+
   const handleOpNoChange = (value) => {
     setFormData({ ...formData, op_no: value });
     
@@ -286,6 +305,7 @@ const PrescriptionForm = () => {
       // Update search terms for drug autocomplete
       setSearchTerms(prescription.drugs.map(d => d.drug_name || ""));
       setShowDropdowns(prescription.drugs.map(() => false));
+      checkDrugs(updatedFormData.drugs);
       
       toast.success("Full prescription loaded. You can modify and save as new.");
     } else {
@@ -304,6 +324,21 @@ const PrescriptionForm = () => {
     }
   };
 
+  const handleIcdSearch = async (value) => {
+    handleInputChange("icd_code", value);
+    if (value.trim().length < 2) {
+      setIcdSuggestions([]);
+      return;
+    }
+    try {
+      const response = await axios.get(`${API}/icd`, { params: { q: value, limit: 10 } });
+      setIcdSuggestions(response.data.results);
+      setShowIcdDropdown(true);
+    } catch (error) {
+      console.error("Error searching ICD codes:", error);
+    }
+  };
+
   const handleInputChange = (field, value) => {
     if (field === 'op_no') {
       handleOpNoChange(value);
@@ -337,8 +372,23 @@ const PrescriptionForm = () => {
     }
   };
 
+  const checkDrugs = async (drugs) => {
+    const names = drugs.map((d) => d.drug_name).filter(Boolean);
+    if (names.length < 2) {
+      setDrugAlerts([]);
+      return;
+    }
+    try {
+      const response = await axios.post(`${API}/drugs/check`, { drugs: names });
+      setDrugAlerts(response.data.alerts);
+    } catch (error) {
+      console.error("Failed to check drug interactions:", error);
+    }
+  };
+
   const selectDrug = (index, drugName) => {
     handleDrugChange(index, "drug_name", drugName);
+    checkDrugs(formData.drugs.map((d, i) => (i === index ? { ...d, drug_name: drugName } : d)));
     const newSearchTerms = [...searchTerms];
     newSearchTerms[index] = drugName;
     setSearchTerms(newSearchTerms);
@@ -361,6 +411,7 @@ const PrescriptionForm = () => {
     setFormData({ ...formData, drugs: newDrugs });
     setSearchTerms(newSearchTerms);
     setShowDropdowns(newShowDropdowns);
+    checkDrugs(newDrugs);
   };
 
   const handleFrequencyChange = (index, value) => {
@@ -407,8 +458,11 @@ const PrescriptionForm = () => {
         const response = await axios.put(`${API}/prescriptions/${editId}`, {
           ...formData,
           drugs: validDrugs,
+          version: editVersion,
         });
         toast.success("Prescription updated successfully!");
+        if (response.headers["x-icd-warning"]) toast.warning(response.headers["x-icd-warning"]);
+        response.data.drug_alerts.forEach((alert) => toast.warning(`${alert.drugs.join(" + ")}: ${alert.message}`));
         navigate(`/prescription/${editId}`);
       } else {
         // Create new prescription
@@ -417,6 +471,8 @@ const PrescriptionForm = () => {
           drugs: validDrugs,
         });
         toast.success("Prescription created successfully!");
+        if (response.headers["x-icd-warning"]) toast.warning(response.headers["x-icd-warning"]);
+        response.data.drug_alerts.forEach((alert) => toast.warning(`${alert.drugs.join(" + ")}: ${alert.message}`));
         navigate(`/prescription/${response.data.id}`);
       }
     } catch (error) {
@@ -447,6 +503,7 @@ const PrescriptionForm = () => {
     });
     setSearchTerms([""]);
     setShowDropdowns([false]);
+    setDrugAlerts([]);
   };
 
   return (
@@ -587,18 +644,36 @@ const PrescriptionForm = () => {
 
               {/* Row 2: ICD Code on left, Sex and Age on right */}
               <div className="grid grid-cols-1 md:grid-cols-3 gap-4">
-                <div className="space-y-2">
+                <div className="space-y-2 relative">
                   <Label htmlFor="icd_code" className="text-slate-700 font-medium">
                     ICD Code
                   </Label>
                   <Input
                     id="icd_code"
                     data-testid="icd-code-input"
-                    placeholder="Enter ICD Code"
+                    placeholder="Code or diagnosis"
                     className="h-11 bg-white border-slate-200 focus:border-[#6B9A9A] focus:ring-[#6B9A9A]/20"
                     value={formData.icd_code}
-                    onChange={(e) => handleInputChange("icd_code", e.target.value)}
+                    onChange={(e) => handleIcdSearch(e.target.value)}
+                    onFocus={() => icdSuggestions.length > 0 && setShowIcdDropdown(true)}
+                    onBlur={() => setTimeout(() => setShowIcdDropdown(false), 200)}
                   />
+                  {showIcdDropdown && icdSuggestions.length > 0 && (
+                    <div className="autocomplete-dropdown" data-testid="icd-dropdown">
+                      {icdSuggestions.map((icd) => (
+                        <div
+                          key={icd.code}
+                          className="autocomplete-item"
+                          onMouseDown={() => {
+                            handleInputChange("icd_code", icd.code);
+                            setShowIcdDropdown(false);
+                          }}
+                        >
+                          <span className="font-medium">{icd.code}</span> {icd.description}
+                        </div>
+                      ))}
+                    </div>
+                  )}
                 </div>
                 <div className="space-y-2">
                   <Label htmlFor="sex" className="text-slate-700 font-medium">
@@ -885,6 +960,26 @@ const PrescriptionForm = () => {
                   ))}
                 </div>
 
+                {drugAlerts.length > 0 && (
+                  <div className="space-y-2" data-testid="drug-alerts">
+                    {drugAlerts.map((alert, i) => (
+                      <div
+                        key={i}
+                        className={`flex items-start gap-2 p-3 rounded-lg border text-sm ${
+                          alert.severity === "major"
+                            ? "bg-red-50 border-red-200 text-red-700"
+                            : "bg-amber-50 border-amber-200 text-amber-700"
+                        }`}
+                      >
+                        <AlertCircle className="w-4 h-4 mt-0.5 shrink-0" />
+                        <span>
+                          <span className="font-medium">{alert.drugs.join(" + ")}:</span> {alert.message}
+                        </span>
+                      </div>
+                    ))}
+                  </div>
+                )}
+
                 <Button
                   type="button"
                   variant="outline"
@@ -1031,7 +1126,7 @@ const PrescriptionForm = () => {
               Existing Prescriptions Found
             </DialogTitle>
             <DialogDescription>
-              Found {existingPrescriptions.length} prescription(s) for OP No: {formData.op_no}
+              Found {patientSummary?.visit_count ?? existingPrescriptions.length} prescription(s) for OP No: {formData.op_no}
             </DialogDescription>
           </DialogHeader>
           <div className="py-4 max-h-[400px] overflow-y-auto">
@@ -1057,7 +1152,7 @@ const PrescriptionForm = () => {
                       </p>
                       <p className="text-sm text-slate-500">
                         <span className="font-medium">Drugs:</span>{" "}
-                        {prescription.drugs?.map(d => d.drug_name).join(", ") || "None"}
+                        {prescription.drug_names?.join(", ") || "None"}
                       </p>
                     </div>
                     <div className="flex flex-col gap-2 ml-4">
@@ -1065,7 +1160,7 @@ const PrescriptionForm = () => {
                         variant="outline"
                         size="sm"
                         className="text-[#6B9A9A] border-[#6B9A9A]/30 hover:bg-[#6B9A9A]/5"
-                        onClick={() => loadExistingPrescription(prescription, true)}
+                        onClick={() => loadFullPrescription(prescription.id)}
                       >
                         <FileText className="w-4 h-4 mr-1" />
                         Load All
@@ -1086,7 +1181,7 @@ const PrescriptionForm = () => {
                         onClick={() => setDeleteConfirmDialog({ 
                           open: true, 
                           id: prescription.id, 
-                          opNo: prescription.op_no 
+                          opNo: formData.op_no 
                         })}
                       >
                         <Trash2 className="w-4 h-4 mr-1" />
@@ -1102,8 +1197,8 @@ const PrescriptionForm = () => {
             <Button
               variant="outline"
               onClick={() => {
-                if (existingPrescriptions.length > 0) {
-                  loadExistingPrescription(existingPrescriptions[0], false);
+                if (patientSummary) {
+                  loadExistingPrescription(patientSummary, false);
                 }
               }}
             >
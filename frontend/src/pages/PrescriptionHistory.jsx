@@ -1,8 +1,8 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { useNavigate } from "react-router-dom";
 import axios from "axios";
 import { toast } from "sonner";
-import { API, removeToken, getUserInfo, isAdmin } from "@/App";
+import { API, getToken, removeToken, getUserInfo, isAdmin } from "@/App";
 import { Button } from "@/components/ui/button";
 import { Input } from "@/components/ui/input";
 import { Card, CardContent, CardHeader, CardTitle } from "@/components/ui/card";
@@ -40,6 +40,9 @@ import {
 } from "lucide-react";
 import { format } from "date-fns";
 
+// Newest prescriptions kept in the list (the page size of GET /prescriptions)
+const HISTORY_PAGE_SIZE = 500;
+
 const PrescriptionHistory = () => {
   const navigate = useNavigate();
   const [prescriptions, setPrescriptions] = useState([]);
@@ -48,15 +51,35 @@ const PrescriptionHistory = () => {
   const [deleteDialog, setDeleteDialog] = useState({ open: false, id: null, opNo: '' });
   const userInfo = getUserInfo();
   const admin = isAdmin();
+  // Sync token the list is current to; /sync returns only what changed after it
+  const syncToken = useRef(null);
 
   useEffect(() => {
     fetchPrescriptions();
   }, []);
 
+  // Live updates: the server pushes a notification per change and the list applies the delta
+  useEffect(() => {
+    const source = new EventSource(`${API}/events?token=${encodeURIComponent(getToken())}`);
+    let timer = null;
+    const schedule = (refresh) => {
+      clearTimeout(timer);
+      timer = setTimeout(refresh, 300);
+    };
+    source.addEventListener("prescription", () => schedule(syncPrescriptions));
+    source.addEventListener("resync", () => schedule(fetchPrescriptions));
+    return () => {
+      clearTimeout(timer);
+      source.close();
+    };
+  }, []);
+
   const fetchPrescriptions = async () => {
     try {
       const response = await axios.get(`${API}/prescriptions`);
       setPrescriptions(response.data);
+      // Issued by the server, which holds it below writes still in progress
+      syncToken.current = Number(response.headers["x-sync-since"] || 0);
     } catch (error) {
       toast.error("Failed to fetch prescriptions");
     } finally {
@@ -64,6 +87,26 @@ const PrescriptionHistory = () => {
     }
   };
 
+  const syncPrescriptions = async () => {
+    if (syncToken.current === null) return; // the initial load is still running
+    try {
+      let page;
+      do {
+        page = (await axios.get(`${API}/sync`, { params: { since: syncToken.current } })).data;
+        const replaced = new Set([...page.deleted, ...page.prescriptions.map((p) => p.id)]);
+        const changed = page.prescriptions;
+        setPrescriptions((current) =>
+          [...changed, ...current.filter((p) => !replaced.has(p.id))]
+            .sort((a, b) => new Date(b.created_at) - new Date(a.created_at))
+            .slice(0, HISTORY_PAGE_SIZE)
+        );
+        syncToken.current = page.since;
+      } while (page.has_more);
+    } catch (error) {
+      fetchPrescriptions();
+    }
+  };
+
   const handleDeletePrescription = async (id) => {
     try {
       await axios.delete(`${API}/prescriptions/${id}`);
@@ -102,7 +102,7 @@ const PrescriptionView = () => {
     navigate("/login");
   };
 
-  const handlePrint = useReactToPrint({
+  const handlePagePrint = useReactToPrint({
     contentRef: printRef,
     documentTitle: `Prescription_${prescription?.op_no}_${prescription?.patient_name}`,
     pageStyle: `
@@ -135,6 +135,26 @@ const PrescriptionView = () => {
     `,
   });
 
+  // Print the server's print-ready HTML (same pad margins as the PDF); fall back to printing this page
+  const handlePrint = async () => {
+    try {
+      const response = await axios.get(`${API}/prescriptions/${id}/html`, {
+        responseType: "text",
+      });
+      const frame = document.createElement("iframe");
+      frame.style.cssText = "position:fixed;right:0;bottom:0;width:0;height:0;border:0;";
+      frame.srcdoc = response.data;
+      frame.onload = () => {
+        frame.contentWindow.onafterprint = () => frame.remove();
+        frame.contentWindow.focus();
+        frame.contentWindow.print();
+      };
+      document.body.appendChild(frame);
+    } catch (error) {
+      handlePagePrint();
+    }
+  };
+
   const handleDownloadPDF = async () => {
     setDownloading(true);
     try {
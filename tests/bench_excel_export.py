@@ -0,0 +1,101 @@
+"""
+Excel export benchmark for RheumaCare E-Prescription Portal
+Compares the original per-cell export loop with the columnar, write-only build_excel_workbook
+
+Run: python tests/bench_excel_export.py [--rows 50000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from io import BytesIO
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+import server  # noqa: E402
+
+PATIENT_FIELDS = ["op_no", "patient_name", "sex", "age", "icd_code", "weight", "height", "bp", "spo2"]
+
+
+def make_prescriptions(rows: int, seed: int = 7) -> list:
+    """Synthetic prescriptions with 0-4 drugs each, until they flatten to at least rows Excel rows"""
+    rng = random.Random(seed)
+    prescriptions, total = [], 0
+    while total < rows:
+        i = len(prescriptions)
+        drugs = [{
+            "drug_name": rng.choice(server.DRUG_LIST),
+            "dosage": f"{rng.choice([5, 10, 200, 400])}mg",
+            "frequency": rng.choice(server.DRUG_FREQUENCIES),
+            "duration": str(rng.randint(1, 90)),
+            "duration_unit": rng.choice(server.DURATION_UNITS),
+            "comments": rng.choice(["", "After food", "Before breakfast on empty stomach"]),
+        } for _ in range(rng.randint(0, 4))]
+        prescriptions.append({
+            "op_no": f"OP{i:06d}", "patient_name": f"Patient {i}", "sex": rng.choice("MF"), "age": str(rng.randint(18, 90)),
+            "icd_code": "M05.9", "weight": "60 kg", "height": "160 cm", "bp": "120/80", "spo2": "98%",
+            "created_at": "2024-01-01T10:00:00+00:00", "drugs": drugs, "advice": "Review with reports",
+            "lab_tests": "CBC, ESR", "doctor_id": "dr_prakashini", "location": "Bangalore",
+        })
+        total += max(len(drugs), 1)
+    return prescriptions
+
+
+def old_per_cell_export(prescriptions: list, names: dict) -> bytes:
+    """The export loop before columnar rows: one ws.cell() and Border per cell in a normal workbook"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Border, Side
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Prescriptions"
+    thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+    for col, header in enumerate(server.EXCEL_HEADERS, 1):
+        cell = ws.cell(row=1, column=col, value=header)
+        cell.font = Font(bold=True)
+        cell.border = thin_border
+    row_num = 2
+    for prescription in prescriptions:
+        patient = [prescription.get(field, '') for field in PATIENT_FIELDS] + [prescription['created_at'][:10]]
+        doctor_id = prescription.get('doctor_id', 'dr_prakashini')
+        tail = [prescription.get('advice', ''), prescription.get('lab_tests', ''),
+                names.get(doctor_id, doctor_id), prescription.get('location', 'Bangalore')]
+        for i, drug in enumerate(prescription['drugs'] or [{}]):
+            values = [v if i == 0 else '' for v in patient] + [
+                drug.get('drug_name', ''), drug.get('dosage', ''), drug.get('frequency', ''),
+                server.drug_duration(drug), drug.get('comments', ''),
+            ] + [v if i == 0 else '' for v in tail]
+            for col, value in enumerate(values, 1):
+                ws.cell(row=row_num, column=col, value=value).border = thin_border
+            row_num += 1
+    buffer = BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def columnar_export(prescriptions: list, names: dict) -> bytes:
+    return server.build_excel_workbook([("Prescriptions", server.excel_rows(prescriptions, names))])
+
+
+def timed(label: str, build, prescriptions: list, names: dict):
+    start = time.perf_counter()
+    content = build(prescriptions, names)
+    print(f"  {label:<40} {time.perf_counter() - start:7.1f} s  {len(content) / 1e6:6.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[1])
+    parser.add_argument("--rows", type=int, default=50000, help="minimum number of Excel data rows")
+    args = parser.parse_args()
+    prescriptions = make_prescriptions(args.rows)
+    names = {"dr_prakashini": "Dr. Prakashini M V"}
+    rows = server.excel_rows(prescriptions, names)
+    print(f"{len(prescriptions)} prescriptions flattened to {len(rows)} rows x {len(server.EXCEL_HEADERS)} columns")
+    timed("old per-cell loop (normal workbook)", old_per_cell_export, prescriptions, names)
+    timed("columnar rows + write-only, named styles", columnar_export, prescriptions, names)
+
+
+if __name__ == "__main__":
+    main()
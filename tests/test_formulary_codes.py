@@ -0,0 +1,63 @@
+"""
+Formulary code tests for RheumaCare E-Prescription Portal
+Tests: codes stored in compact drug entries keep naming the same drug
+"""
+import os
+import sys
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+import server  # noqa: E402
+
+# Codes D0, D1, ... as first issued; stored prescriptions depend on every one of them
+ISSUED_CODES = [
+    "WYSOLONE", "REFRESH TEARS", "ECOSPRIN", "ECOSPRIN AV", "GLYCOMET", "NUCOXIA", "ACTEMRA",
+    "ALLEGRA", "TRYPTOMER", "PRODEP", "GLYCOMET GP1", "MEDROL", "LIMCEE", "NEXITO", "TECZINE",
+    "NEXITO PLUS", "THYRONORM", "RISOFOS", "ROZAVEL", "MYORIL", "UPRISE D3", "OSTEOFOS",
+    "PREGABA M", "OMNACORTIL", "TELMA", "PREGALIN", "RIFAGUT", "ALTRADAY", "BENADON", "MONTEK LC",
+    "MYOSPAS", "DULANE", "BACTRIM DS", "MUVERA", "R-CINEX", "GABAWIN", "SOMPRAZ D",
+    "NEUROBION FORTE", "NERVIJEN PLUS", "SOMPRAZ", "TOFE", "MGD3", "PANTOCID", "ULTRACET",
+    "ME 12 OD", "LIVOGEN Z", "DEFCORT", "NICARDIA RETARD", "BECOSULES", "LOSAR", "NUSAM", "OMEZ",
+    "PRIXAIN GEL", "SHELCAL-M", "LONAZEP", "AZORAN", "V B7 HAIR", "ACITROM", "SHELCAL HD", "ANXIT",
+    "RETOZ", "PREDMET", "PILOMAX", "ULTRA MAGNESIUM", "GOLIMUREL", "BETRECEP", "ASSURANS",
+    "PREGABA", "PREGABA NT", "AUGMENTIN DUO", "EVION LC", "OTRIVIN NASAL SPRAY", "ACTIGUT",
+    "LIVOGEN", "UPADOZ", "SHELCAL", "NAPROSYN", "CILACAR", "HISONE", "CCM TAB", "LEVOFLOX",
+    "PREVENAR 13 VACCINE", "ZYCOLCHIN", "GABANTIN", "ZYCEL", "MICROCID", "FOL-5MG", "SHELCAL XT",
+    "GABANTIN NT", "CREMAFFIN PLUS", "FLOMIST NASAL SPRAY", "NALTOX", "EVION", "AB PHYLLINE N",
+    "D VENIZ", "IDROFOS", "VENUSIA MAX LOTION", "DABIGO", "ZINCOVIT", "APEXFER", "FOLLIHAIR NEW",
+    "PROLAGE PLUS", "AMLONG", "DOTHIP", "T BACT OINT", "METHORA PFS", "PNEUMOVAX 23 PFS VIAL",
+    "SALACTIN PAINT", "PREVENAR 20 VACCINE", "XYKAA BD", "VERTIN", "A TO Z NS+", "ENVAS",
+    "LUBRIJOINT OD", "ARISTOZYME", "SOLONEX", "SENSIVAL", "CILACAR T", "EMESET", "RESTYL",
+    "OXALGIN NANOGEL", "FERISOME", "UDILIV", "OROFER XT", "BILASURE", "BILAST", "SUPRADYN",
+    "TENVIR AF", "RABLET", "FOLLIHAIR", "DOLO", "OMALIREL", "HAEM UP GEMS", "FLEXCART", "LEVOCET",
+    "ACTON OR", "PRUTIS", "EXEMPTIA", "PREDNIWIK", "FOLINAL PLUS", "PYRIGESIC", "SEACOD",
+    "ONE M-D3", "NORMAL SALINE", "CINTODAC", "DENOSTEOREL", "AZEE", "INTACEPT", "JOGREN",
+    "PULMONEXT", "MIMOD", "ROZEL", "METHORA", "INFLUVAC TETRA", "EBUXO", "SAAZ", "PEG-NT", "IGUVIC",
+    "MMF S", "CONIMUNE M", "FOLITRAX", "STOPLOS A+", "HCQS", "MMF", "APRAIZE", "NEO-DROL",
+    "MYCOMUNE S", "MYCOMUNE", "IGURATI", "PEG SR M", "TACROMUS", "TFCT-NIB", "TACROCORD", "LEFNO",
+    "TADACT", "SAAZ DS", "PENTALOC D", "OSTEOCAL",
+]
+
+
+def test_issued_codes_never_change():
+    """Test every issued code still names the drug it was issued for"""
+    for i, name in enumerate(ISSUED_CODES):
+        assert server.FORMULARY_NAMES.get(f"D{i}") == name, f"D{i} must stay {name}"
+
+
+def test_codes_are_unique():
+    """Test no two codes name the same drug"""
+    assert len(server.FORMULARY_CODES) == len(server.FORMULARY_NAMES)
+
+
+def test_unknown_code_expands_without_error():
+    """Test a code missing from the table is shown as it is"""
+    assert server.expand_drug({"d": "D9999", "q": "10mg"})["drug_name"] == "D9999"
+
+
+def test_search_codes_need_full_brand_names():
+    """Test only brands named in full are searched by code"""
+    assert server.formulary_codes_named("vitamin D3 plus") == []
+    assert server.formulary_codes_named("nexito plus") == [server.FORMULARY_CODES["NEXITO"], server.FORMULARY_CODES["NEXITO PLUS"]]
+    assert server.formulary_codes_named("lupus -folitrax") == []
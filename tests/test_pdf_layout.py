@@ -0,0 +1,84 @@
+"""
+PDF layout tests for RheumaCare E-Prescription Portal
+Tests: measured drug table draws pixel-identical to the reference (Paragraph-per-comment) layout
+"""
+import os
+import sys
+import pytest
+
+pymupdf = pytest.importorskip("pymupdf")
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+import server  # noqa: E402
+
+# Short, long (wrapping), markup, entity, multi-space, newline and unbreakable comments
+COMMENTS = [
+    "After food",
+    "",
+    "Before breakfast on empty stomach",
+    "Take with plenty of water and avoid direct sunlight while on this medication",
+    "Stop if rash & fever",
+    "Twice  daily",
+    "Line one\nline two",
+    "<b>Important</b> monitor LFT",
+    "Supercalifragilisticexpialidocious-extended-word",
+]
+
+
+def make_prescription(drug_count):
+    return {
+        "id": "layout-test",
+        "op_no": "TEST-LAYOUT-001",
+        "patient_name": "Test Patient Layout",
+        "sex": "F",
+        "age": "40",
+        "icd_code": "M05.9",
+        "weight": "60 kg",
+        "height": "160 cm",
+        "bp": "120/80",
+        "spo2": "98%",
+        "diagnosis": "Test Diagnosis",
+        "clinical_history": "Test History",
+        "drugs": [{
+            "drug_name": f"TEST DRUG {i}",
+            "dosage": "200mg",
+            "frequency": "1-0-1",
+            "duration": "30",
+            "duration_unit": "Days",
+            "comments": COMMENTS[i % len(COMMENTS)]
+        } for i in range(drug_count)],
+        "review_after": "4 weeks",
+        "advice": "Test advice",
+        "lab_tests": "CBC",
+        "created_at": "2024-01-01T10:00:00+00:00"
+    }
+
+
+def rasterize(buffer):
+    """Render each page to RGB pixels"""
+    document = pymupdf.open(stream=buffer.getvalue(), filetype="pdf")
+    return [page.get_pixmap(dpi=100).samples for page in document]
+
+
+@pytest.mark.parametrize("drug_count", [1, 12, 55])
+def test_measured_drug_table_matches_reference(drug_count):
+    """Test pre-measured table renders the same pixels as ReportLab-sized rows, across page splits"""
+    prescription = make_prescription(drug_count)
+    measured = rasterize(server.render_prescription_pdf(prescription))
+    reference = rasterize(server.render_prescription_pdf(prescription, measure_table=False))
+    assert len(measured) == len(reference)
+    for page, (measured_page, reference_page) in enumerate(zip(measured, reference), 1):
+        assert measured_page == reference_page, f"page {page} differs"
+
+
+def test_plain_comments_skip_paragraphs():
+    """Test only comments that wrap or need markup handling become Paragraphs"""
+    table = server.build_drug_table(make_prescription(len(COMMENTS))["drugs"], server.BUILTIN_PDF_LAYOUT)
+    comments = [row[-1] for row in table._cellvalues[1:]]
+    assert comments[0] == "After food"
+    assert comments[1] == "-"
+    assert isinstance(comments[3], server.Paragraph)  # wraps
+    assert isinstance(comments[4], server.Paragraph)  # entity
+    assert None not in table._argH
@@ -6,12 +6,15 @@ import pytest
 import requests
 import os
 import uuid
+import json
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://doctorrx.preview.emergentagent.com')
 
 # Test credentials
 TEST_USERNAME = "doctor"
 TEST_PASSWORD = "rheumacare2024"
+ADMIN_USERNAME = "admin"
+ADMIN_PASSWORD = "rheumacare_admin_2024"
 
 # Test prescription ID for multi-page PDF testing
 MULTIPAGE_PRESCRIPTION_ID = "e84243a9-fb4b-4176-bc50-faf9bead4587"
@@ -135,6 +138,81 @@ class TestPrescriptionCRUD:
         assert "prescriptions" in data
         assert len(data["prescriptions"]) >= 1
 
+    
+    def test_get_patient_summary(self):
+        """Test patient summary for an OP number"""
+        response = requests.get(f"{BASE_URL}/api/patients/TEST-MULTIPAGE-001", 
+                               headers=self.headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["op_no"] == "TEST-MULTIPAGE-001"
+        assert data["visit_count"] >= 1
+        assert len(data["visits"]) >= 1
+        assert "current_drugs" in data
+    
+    def test_get_patient_summary_unknown_op_no(self):
+        """Test patient summary for an unknown OP number returns 404"""
+        response = requests.get(f"{BASE_URL}/api/patients/NO-SUCH-OP-{uuid.uuid4().hex[:8]}", 
+                               headers=self.headers)
+        assert response.status_code == 404
+    
+    def test_patient_vitals_trend(self):
+        """Test numeric vitals are parsed on save and returned as a per-visit and monthly trend"""
+        test_op_no = f"TEST-VITALS-{uuid.uuid4().hex[:8].upper()}"
+        created = requests.post(f"{BASE_URL}/api/prescriptions", json={
+            "op_no": test_op_no,
+            "patient_name": "Test Patient Vitals",
+            "weight": "62.5 kg",
+            "height": "160 cm",
+            "bp": "130/85",
+            "spo2": "97%",
+            "diagnosis": "Test Diagnosis",
+            "clinical_history": "",
+            "drugs": [],
+            "review_after": "",
+            "doctor_id": "dr_prakashini"
+        }, headers=self.headers).json()
+        assert created["vitals_numeric"]["bp_systolic"] == 130
+        
+        response = requests.get(f"{BASE_URL}/api/patients/{test_op_no}/vitals", headers=self.headers)
+        assert response.status_code == 200
+        points = response.json()["points"]
+        assert len(points) == 1
+        assert points[0]["weight_kg"] == 62.5
+        assert points[0]["bp_diastolic"] == 85
+        
+        monthly = requests.get(f"{BASE_URL}/api/patients/{test_op_no}/vitals",
+                               params={"interval": "month"}, headers=self.headers)
+        assert monthly.status_code == 200
+        assert monthly.json()["points"][0]["visits"] == 1
+        
+        requests.delete(f"{BASE_URL}/api/prescriptions/{created['id']}", headers=self.headers)
+    
+    def test_drug_entries_round_trip(self):
+        """Test formulary, free-text and non-standard drug fields read back exactly as saved"""
+        drugs = [
+            {"drug_name": "FOLITRAX", "dosage": "15 mg", "frequency": "Once weekly", "duration": "12",
+             "duration_unit": "Weeks", "comments": "Take on Sundays"},
+            {"drug_name": "TEST UNLISTED DRUG", "dosage": "", "frequency": "2-0-2", "duration": "07",
+             "duration_unit": "Years", "comments": ""},
+        ]
+        created = requests.post(f"{BASE_URL}/api/prescriptions", json={
+            "op_no": f"TEST-DRUGS-{uuid.uuid4().hex[:8].upper()}",
+            "patient_name": "Test Patient Drugs",
+            "diagnosis": "Test Diagnosis",
+            "clinical_history": "",
+            "drugs": drugs,
+            "review_after": "",
+            "doctor_id": "dr_prakashini"
+        }, headers=self.headers).json()
+        assert created["drugs"] == drugs
+        assert created["schema_version"] >= 1
+        
+        response = requests.get(f"{BASE_URL}/api/prescriptions/{created['id']}", headers=self.headers)
+        assert response.status_code == 200
+        assert response.json()["drugs"] == drugs
+        
+        requests.delete(f"{BASE_URL}/api/prescriptions/{created['id']}", headers=self.headers)
 
 class TestEditPrescription:
     """Edit prescription functionality tests - NEW FEATURE"""
@@ -308,6 +386,58 @@ class TestEditPrescription:
         assert "Rest well" in data["advice"]
         assert "CBC, ESR, CRP" in data["lab_tests"]
     
+    def test_update_stale_version_conflict(self):
+        """Test that an edit based on an outdated version returns 409"""
+        current = requests.get(f"{BASE_URL}/api/prescriptions/{self.test_prescription_id}",
+                               headers=self.headers).json()
+        update_data = {
+            "op_no": self.test_op_no,
+            "patient_name": "Test Patient Edit",
+            "diagnosis": "First Edit",
+            "clinical_history": "Original History",
+            "drugs": current["drugs"],
+            "review_after": "4 weeks",
+            "version": current["version"]
+        }
+        
+        first = requests.put(f"{BASE_URL}/api/prescriptions/{self.test_prescription_id}",
+                             json=update_data, headers=self.headers)
+        assert first.status_code == 200
+        assert first.json()["version"] == current["version"] + 1
+        
+        # Second edit still based on the old version must not overwrite the first
+        stale = requests.put(f"{BASE_URL}/api/prescriptions/{self.test_prescription_id}",
+                             json={**update_data, "diagnosis": "Stale Edit"}, headers=self.headers)
+        assert stale.status_code == 409
+        
+        fetched = requests.get(f"{BASE_URL}/api/prescriptions/{self.test_prescription_id}",
+                               headers=self.headers).json()
+        assert fetched["diagnosis"] == "First Edit"
+    
+    def test_revision_history_rebuilds_previous_version(self):
+        """Test that edits are logged and earlier versions can be rebuilt"""
+        update_data = {
+            "op_no": self.test_op_no,
+            "patient_name": "Test Patient Edit",
+            "diagnosis": "Revised Diagnosis",
+            "clinical_history": "Original History",
+            "drugs": [],
+            "review_after": "4 weeks"
+        }
+        response = requests.put(f"{BASE_URL}/api/prescriptions/{self.test_prescription_id}",
+                                json=update_data, headers=self.headers)
+        assert response.status_code == 200
+        
+        revisions = requests.get(f"{BASE_URL}/api/prescriptions/{self.test_prescription_id}/revisions",
+                                 headers=self.headers).json()["revisions"]
+        assert [r["rev"] for r in revisions] == [2, 1]
+        assert any(op["path"] == "/diagnosis" for op in revisions[0]["patch"])
+        
+        original = requests.get(f"{BASE_URL}/api/prescriptions/{self.test_prescription_id}/revisions/1",
+                                headers=self.headers).json()
+        assert original["diagnosis"] == "Original Diagnosis"
+        assert original["drugs"][0]["drug_name"] == "HCQS"
+    
     def test_update_nonexistent_prescription(self):
         """Test updating a prescription that doesn't exist returns 404"""
         fake_id = "nonexistent-id-12345"
@@ -326,6 +456,57 @@ class TestEditPrescription:
         assert response.status_code == 404
 
 
+class TestPrescriptionSearch:
+    """Full-text search tests"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Get auth token and create a prescription with a unique diagnosis term"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "username": TEST_USERNAME,
+            "password": TEST_PASSWORD
+        })
+        self.token = login_response.json()["token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+        
+        self.term = f"zqsearch{uuid.uuid4().hex[:8]}"
+        response = requests.post(f"{BASE_URL}/api/prescriptions", json={
+            "op_no": f"TEST-SEARCH-{uuid.uuid4().hex[:8].upper()}",
+            "patient_name": "Test Patient Search",
+            "diagnosis": f"Lupus nephritis {self.term}",
+            "clinical_history": "Test History",
+            "drugs": [{
+                "drug_name": "MMF",
+                "dosage": "500mg",
+                "frequency": "1-0-1",
+                "duration": "30",
+                "duration_unit": "Days",
+                "comments": ""
+            }],
+            "review_after": "4 weeks"
+        }, headers=self.headers)
+        self.prescription_id = response.json()["id"]
+        yield
+        requests.delete(f"{BASE_URL}/api/prescriptions/{self.prescription_id}", headers=self.headers)
+    
+    def test_search_finds_diagnosis_term(self):
+        """Test searching by a diagnosis term"""
+        response = requests.get(f"{BASE_URL}/api/prescriptions/search",
+                               params={"q": self.term}, headers=self.headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total"] >= 1
+        assert data["results"][0]["id"] == self.prescription_id
+    
+    def test_search_date_filter_excludes_old_range(self):
+        """Test that a date range before the prescription excludes it"""
+        response = requests.get(f"{BASE_URL}/api/prescriptions/search",
+                               params={"q": self.term, "from": "2000-01-01", "to": "2000-12-31"},
+                               headers=self.headers)
+        assert response.status_code == 200
+        assert response.json()["total"] == 0
+        assert response.json()["archived_excluded"] is False
+
 class TestPDFGeneration:
     """PDF generation tests including multi-page support"""
     
@@ -359,6 +540,145 @@ class TestPDFGeneration:
         # Check content-disposition header
         assert "attachment" in response.headers.get("content-disposition", "")
 
+    def test_pdf_range_request_resumes_download(self):
+        """Test PDF download supports byte ranges against the stored render"""
+        url = f"{BASE_URL}/api/prescriptions/{MULTIPAGE_PRESCRIPTION_ID}/pdf"
+        full = requests.get(url, headers=self.headers)
+        assert full.status_code == 200
+        assert full.headers["accept-ranges"] == "bytes"
+        assert int(full.headers["content-length"]) == len(full.content)
+
+        partial = requests.get(url, headers={**self.headers, "Range": "bytes=100-"})
+        assert partial.status_code == 206
+        assert partial.headers["content-range"] == f"bytes 100-{len(full.content) - 1}/{len(full.content)}"
+        assert partial.content == full.content[100:]
+
+        beyond = requests.get(url, headers={**self.headers, "Range": f"bytes={len(full.content)}-"})
+        assert beyond.status_code == 416
+
+    def test_html_view_revalidates_with_etag(self):
+        """Test print HTML carries the pad margins and answers 304 for a matching ETag"""
+        url = f"{BASE_URL}/api/prescriptions/{MULTIPAGE_PRESCRIPTION_ID}/html"
+        response = requests.get(url, headers=self.headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/html")
+        assert "@page" in response.text
+        assert "TEST-MULTIPAGE-001" in response.text
+
+        cached = requests.get(url, headers={**self.headers, "If-None-Match": response.headers["etag"]})
+        assert cached.status_code == 304
+
+
+class TestExportFormats:
+    """CSV / NDJSON / Parquet export tests"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Get auth token"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "username": TEST_USERNAME,
+            "password": TEST_PASSWORD
+        })
+        self.headers = {"Authorization": f"Bearer {login_response.json()['token']}"}
+    
+    def test_export_csv(self):
+        """Test CSV export has a header row and one row per drug"""
+        response = requests.get(f"{BASE_URL}/api/prescriptions/export/csv", headers=self.headers)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        lines = response.text.splitlines()
+        assert lines[0].startswith("prescription_id,op_no,patient_name")
+    
+    def test_export_ndjson_with_date_filter(self):
+        """Test NDJSON export honours the date range"""
+        response = requests.get(f"{BASE_URL}/api/prescriptions/export/ndjson",
+                               params={"from": "2024-01-01"}, headers=self.headers)
+        assert response.status_code == 200
+        for line in response.text.splitlines():
+            row = json.loads(line)
+            assert row["date"] >= "2024-01-01"
+    
+    def test_export_parquet(self):
+        """Test Parquet export returns a Parquet file"""
+        response = requests.get(f"{BASE_URL}/api/prescriptions/export/parquet", headers=self.headers)
+        assert response.status_code == 200
+        assert response.content[:4] == b"PAR1"
+    
+    def test_excel_export_filters(self):
+        """Test Excel export accepts date, doctor, location and OP No filters"""
+        response = requests.get(f"{BASE_URL}/api/prescriptions/export/excel",
+                               params={"from": "2024-01-01", "to": "2030-12-31", "op_no": "TEST-MULTIPAGE-001"},
+                               headers=self.headers)
+        assert response.status_code == 200
+        assert response.content[:2] == b"PK"  # xlsx is a zip container
+    
+    def test_excel_export_partitioned_by_month(self):
+        """Test multi-sheet Excel export partitioned by month"""
+        response = requests.get(f"{BASE_URL}/api/prescriptions/export/excel",
+                               params={"partition": "month"}, headers=self.headers)
+        assert response.status_code == 200
+        assert response.content[:2] == b"PK"
+    
+    def test_excel_export_invalid_partition(self):
+        """Test unknown partition returns 400"""
+        response = requests.get(f"{BASE_URL}/api/prescriptions/export/excel",
+                               params={"partition": "patient"}, headers=self.headers)
+        assert response.status_code == 400
+    
+    def test_export_unknown_format(self):
+        """Test unsupported export format returns 400"""
+        response = requests.get(f"{BASE_URL}/api/prescriptions/export/xml", headers=self.headers)
+        assert response.status_code == 400
+
+class TestPdfLayouts:
+    """PDF pad layout template tests"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Get admin token"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "username": ADMIN_USERNAME,
+            "password": ADMIN_PASSWORD
+        })
+        self.headers = {"Authorization": f"Bearer {login_response.json()['token']}"}
+    
+    def test_preview_unsaved_layout(self):
+        """Test preview renders a draft layout on sample data"""
+        response = requests.post(f"{BASE_URL}/api/admin/pdf-layouts/preview",
+                                 json={"header_mm": 30, "accent_color": "#224488"}, headers=self.headers)
+        assert response.status_code == 200
+        assert response.content[:4] == b'%PDF'
+    
+    def test_invalid_layout_rejected(self):
+        """Test drug columns wider than the page are rejected"""
+        response = requests.post(f"{BASE_URL}/api/admin/pdf-layouts/preview",
+                                 json={"drug_columns_mm": [50, 50, 50, 50, 50, 50]}, headers=self.headers)
+        assert response.status_code == 400
+    
+    def test_out_of_range_layout_values_rejected(self):
+        """Test zero font sizes, negative lengths and malformed colours are rejected"""
+        for bad in ({"font_size": 0}, {"table_font_size": -3}, {"header_mm": -50},
+                    {"drug_columns_mm": [10, 38, 22, 35, 25, -40]}, {"accent_color": "red; x"}):
+            response = requests.post(f"{BASE_URL}/api/admin/pdf-layouts/preview", json=bad, headers=self.headers)
+            assert response.status_code == 422, bad
+    
+    def test_location_layout_edit_bumps_revision(self):
+        """Test create, edit and delete of a location layout"""
+        layout = {"name": "TEST pad", "scope": "location", "key": f"TEST_{uuid.uuid4().hex[:8]}", "header_mm": 40}
+        created = requests.post(f"{BASE_URL}/api/admin/pdf-layouts", json=layout, headers=self.headers)
+        assert created.status_code == 200
+        layout_id = created.json()["id"]
+        assert created.json()["revision"] == 1
+        
+        updated = requests.put(f"{BASE_URL}/api/admin/pdf-layouts/{layout_id}",
+                               json={**layout, "header_mm": 45}, headers=self.headers)
+        assert updated.status_code == 200
+        assert updated.json()["revision"] == 2
+        assert updated.json()["header_mm"] == 45
+        
+        deleted = requests.delete(f"{BASE_URL}/api/admin/pdf-layouts/{layout_id}", headers=self.headers)
+        assert deleted.status_code == 200
+
 
 class TestDoctorAndDrugAPIs:
     """Tests for doctor and drug lookup APIs"""
@@ -402,6 +722,220 @@ class TestDoctorAndDrugAPIs:
         assert len(data["drugs"]) > 0
 
 
+class TestIcdCatalog:
+    """ICD-10 autocomplete and validation tests"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Get auth token"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "username": TEST_USERNAME,
+            "password": TEST_PASSWORD
+        })
+        self.token = login_response.json()["token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+    
+    def test_icd_code_prefix(self):
+        """Test autocomplete by code prefix, with or without the dot"""
+        response = requests.get(f"{BASE_URL}/api/icd", params={"q": "m05.9"}, headers=self.headers)
+        assert response.status_code == 200
+        assert response.json()["results"][0]["code"] == "M05.9"
+    
+    def test_icd_description_words(self):
+        """Test autocomplete by description word prefixes"""
+        response = requests.get(f"{BASE_URL}/api/icd", params={"q": "rheum arth"}, headers=self.headers)
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert len(results) > 0
+        assert all("rheum" in r["description"].lower() for r in results)
+    
+    def test_icd_code_lookup(self):
+        """Test looking up a single code"""
+        response = requests.get(f"{BASE_URL}/api/icd/M06.0", headers=self.headers)
+        assert response.status_code == 200
+        assert "Rheumatoid arthritis" in response.json()["description"]
+        missing = requests.get(f"{BASE_URL}/api/icd/ZZZ.99", headers=self.headers)
+        assert missing.status_code == 404
+    
+    def test_unknown_icd_code_flagged_on_save(self):
+        """Test saving an unknown ICD code reports it in X-ICD-Warning (default warn mode)"""
+        response = requests.post(f"{BASE_URL}/api/prescriptions", json={
+            "op_no": f"TEST-ICD-{uuid.uuid4().hex[:8].upper()}",
+            "patient_name": "Test Patient ICD",
+            "icd_code": "M05.9, QQ9.9",
+            "diagnosis": "Test Diagnosis",
+            "clinical_history": "",
+            "drugs": [],
+            "review_after": "",
+            "doctor_id": "dr_prakashini"
+        }, headers=self.headers)
+        assert response.status_code == 200
+        assert "QQ9.9" in response.headers["X-ICD-Warning"]
+        assert "M05.9" not in response.headers["X-ICD-Warning"]
+        requests.delete(f"{BASE_URL}/api/prescriptions/{response.json()['id']}", headers=self.headers)
+
+
+class TestDrugInteractions:
+    """Drug-interaction and duplicate-therapy check tests"""
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Get auth token"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "username": TEST_USERNAME,
+            "password": TEST_PASSWORD
+        })
+        self.token = login_response.json()["token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+
+    def check(self, drugs):
+        response = requests.post(f"{BASE_URL}/api/drugs/check", json={"drugs": drugs}, headers=self.headers)
+        assert response.status_code == 200
+        return response.json()
+
+    def test_duplicate_ingredient(self):
+        """Test two brands of the same ingredient are flagged"""
+        alerts = self.check(["ECOSPRIN", "ECOSPRIN AV"])["alerts"]
+        assert len(alerts) == 1
+        assert alerts[0]["type"] == "duplicate"
+        assert alerts[0]["ingredients"] == ["aspirin"]
+
+    def test_major_interaction(self):
+        """Test methotrexate with trimethoprim-sulfamethoxazole is a major interaction, strengths ignored"""
+        alerts = self.check(["FOLITRAX 15mg", "BACTRIM DS"])["alerts"]
+        assert len(alerts) == 1
+        assert alerts[0]["type"] == "interaction"
+        assert alerts[0]["severity"] == "major"
+        assert alerts[0]["drugs"] == ["FOLITRAX 15mg", "BACTRIM DS"]
+
+    def test_duplicate_class(self):
+        """Test two drugs of one therapeutic class are flagged"""
+        alerts = self.check(["NUCOXIA", "ZYCEL"])["alerts"]
+        assert [a["type"] for a in alerts] == ["duplicate"]
+        assert alerts[0]["severity"] == "moderate"
+
+    def test_no_alerts(self):
+        """Test a safe combination has no alerts and unknown names are reported"""
+        result = self.check(["HCQS", "FOL-5MG", "UNLISTED DRUG"])
+        assert result["alerts"] == []
+        assert result["unrecognized"] == ["UNLISTED DRUG"]
+
+    def test_alerts_stored_on_save(self):
+        """Test saving a prescription records its alerts (default warn mode)"""
+        drug = {"dosage": "1", "frequency": "1-0-0", "duration": "7", "duration_unit": "Days"}
+        response = requests.post(f"{BASE_URL}/api/prescriptions", json={
+            "op_no": f"TEST-DDI-{uuid.uuid4().hex[:8].upper()}",
+            "patient_name": "Test Patient DDI",
+            "diagnosis": "Test Diagnosis",
+            "clinical_history": "",
+            "drugs": [{"drug_name": "METHORA", **drug}, {"drug_name": "BACTRIM DS", **drug}],
+            "review_after": "",
+            "doctor_id": "dr_prakashini"
+        }, headers=self.headers)
+        assert response.status_code == 200
+        assert [a["severity"] for a in response.json()["drug_alerts"]] == ["major"]
+        requests.delete(f"{BASE_URL}/api/prescriptions/{response.json()['id']}", headers=self.headers)
+
+
+class TestAdminAnalytics:
+    """Prescribing analytics endpoint tests"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Get admin token"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "username": ADMIN_USERNAME,
+            "password": ADMIN_PASSWORD
+        })
+        self.headers = {"Authorization": f"Bearer {login_response.json()['token']}"}
+    
+    def test_drug_frequency(self):
+        """Test drug frequency grouped by doctor and month"""
+        response = requests.get(f"{BASE_URL}/api/admin/analytics/drug-frequency",
+                               params={"group_by": "doctor", "period": "month"},
+                               headers=self.headers)
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert len(results) > 0
+        assert {"drug_name", "doctor_id", "period", "count"} <= set(results[0])
+    
+    def test_drugs_per_prescription(self):
+        """Test average drugs per prescription"""
+        response = requests.get(f"{BASE_URL}/api/admin/analytics/drugs-per-prescription",
+                               headers=self.headers)
+        assert response.status_code == 200
+        result = response.json()["results"][0]
+        assert result["prescriptions"] > 0
+        assert result["average"] == pytest.approx(result["drug_lines"] / result["prescriptions"])
+    
+    def test_rollup_and_live_sources_agree(self):
+        """Test that rollup-backed counts match a live scan"""
+        params = {"group_by": "doctor", "period": "month"}
+        rollup = requests.get(f"{BASE_URL}/api/admin/analytics/prescriptions",
+                             params={**params, "source": "rollup"}, headers=self.headers)
+        live = requests.get(f"{BASE_URL}/api/admin/analytics/prescriptions",
+                           params={**params, "source": "live"}, headers=self.headers)
+        assert rollup.status_code == 200 and live.status_code == 200
+        key = lambda r: (r["doctor_id"], r["period"])
+        assert sorted(rollup.json()["results"], key=key) == sorted(live.json()["results"], key=key)
+    
+    def test_rollups_reconcile(self):
+        """Test the rollup reconciliation check"""
+        response = requests.get(f"{BASE_URL}/api/admin/rollups/reconcile", headers=self.headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["consistent"] == (data["mismatch_count"] == 0)
+        assert isinstance(data["mismatches"], list)
+    
+    def test_invalid_group_by(self):
+        """Test that an unknown grouping returns 400"""
+        response = requests.get(f"{BASE_URL}/api/admin/analytics/icd-codes",
+                               params={"group_by": "patient"}, headers=self.headers)
+        assert response.status_code == 400
+
+    def test_single_flight_metrics(self):
+        """Test coalescing metrics count every render request"""
+        requests.get(f"{BASE_URL}/api/prescriptions/{MULTIPAGE_PRESCRIPTION_ID}/pdf",
+                     params={"debug": "true"}, headers=self.headers)
+        response = requests.get(f"{BASE_URL}/api/admin/metrics/single-flight", headers=self.headers)
+        assert response.status_code == 200
+        debug_pdf = response.json()["endpoints"]["pdf_debug"]
+        assert debug_pdf["requests"] == debug_pdf["executions"] + debug_pdf["coalesced"]
+        assert debug_pdf["requests"] >= 1
+    
+    def test_timestamp_migration_status(self):
+        """Test the timestamp migration reports its progress"""
+        response = requests.get(f"{BASE_URL}/api/admin/migrations/timestamps", headers=self.headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["remaining"] >= 0
+        assert "status" in data
+    
+    def test_drug_migration_status(self):
+        """Test the drug entry migration reports its progress"""
+        response = requests.get(f"{BASE_URL}/api/admin/migrations/drugs", headers=self.headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["remaining"] >= 0
+        assert "status" in data
+    
+    def test_schema_writeback_status(self):
+        """Test the schema write-back reports the current schema version and its progress"""
+        response = requests.get(f"{BASE_URL}/api/admin/migrations/schema", headers=self.headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["current_version"] >= 1
+        assert data["remaining"] >= 0
+    
+    def test_archive_status(self):
+        """Test the archiver reports the prescriptions due for archiving and the archive size"""
+        response = requests.get(f"{BASE_URL}/api/admin/archive", headers=self.headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["remaining"] >= 0
+        assert data["archived_total"] >= 0
+        assert "status" in data
+
 class TestDeletePrescription:
     """Delete prescription tests"""
     
@@ -459,5 +993,74 @@ class TestDeletePrescription:
         assert response.status_code == 404
 
 
+class TestSync:
+    """Delta sync (changes feed) tests"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Get auth token"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "username": TEST_USERNAME,
+            "password": TEST_PASSWORD
+        })
+        self.token = login_response.json()["token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+    
+    def sync_all(self, since):
+        """Follow the feed from a token until it is caught up"""
+        prescriptions, deleted = {}, set()
+        while True:
+            page = requests.get(f"{BASE_URL}/api/sync", params={"since": since}, headers=self.headers).json()
+            for p in page["prescriptions"]:
+                prescriptions[p["id"]] = p
+                deleted.discard(p["id"])
+            for prescription_id in page["deleted"]:
+                prescriptions.pop(prescription_id, None)
+                deleted.add(prescription_id)
+            since = page["since"]
+            if not page["has_more"]:
+                return prescriptions, deleted, since
+    
+    def test_sync_returns_writes_and_tombstones(self):
+        """Test a created prescription syncs as changed and, once deleted, as a tombstone"""
+        prescription_data = {
+            "op_no": f"TEST-SYNC-{uuid.uuid4().hex[:8].upper()}",
+            "patient_name": "Test Patient Sync",
+            "diagnosis": "Test Diagnosis",
+            "clinical_history": "",
+            "drugs": [],
+            "review_after": "",
+            "doctor_id": "dr_prakashini"
+        }
+        created = requests.post(f"{BASE_URL}/api/prescriptions", json=prescription_data, headers=self.headers).json()
+        assert created["change_seq"] > 0
+        
+        prescriptions, deleted, since = self.sync_all(created["change_seq"] - 1)
+        assert created["id"] in prescriptions
+        assert since >= created["change_seq"]
+        
+        requests.delete(f"{BASE_URL}/api/prescriptions/{created['id']}", headers=self.headers)
+        prescriptions, deleted, _ = self.sync_all(since)
+        assert created["id"] in deleted
+        assert created["id"] not in prescriptions
+    
+    def test_sync_rejects_negative_token(self):
+        """Test an invalid sync token returns 422"""
+        response = requests.get(f"{BASE_URL}/api/sync", params={"since": -1}, headers=self.headers)
+        assert response.status_code == 422
+    
+    def test_event_stream_requires_token(self):
+        """Test the change notification stream rejects anonymous clients"""
+        response = requests.get(f"{BASE_URL}/api/events", timeout=10)
+        assert response.status_code == 401
+    
+    def test_event_stream_accepts_query_token(self):
+        """Test an EventSource-style client (token in the query string) gets an event stream"""
+        with requests.get(f"{BASE_URL}/api/events", params={"token": self.token}, stream=True, timeout=10) as response:
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            assert next(response.iter_lines(decode_unicode=True)).startswith("retry:")
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "--tb=short"])